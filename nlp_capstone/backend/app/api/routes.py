@@ -1,20 +1,26 @@
 import os
 
-import pandas as pd
-from flask import Blueprint, jsonify, Response
-from backend.app.schemas.song import SongDTO
+from flask import Blueprint, jsonify, Response, request, send_file
 from pathlib import Path
-import torch
-import numpy as np
-import random
+import threading
 
 from backend.app.services.core.LyricsDatasetService import LyricsDatasetService
-from backend.app.services.core.LyricsModelService import LyricsModelService
-from utils.bert_for_lyrics import BertForLyricsConfig
+from backend.app.services.core.LyricsModelService import InferenceBackend, LyricsModelService
+from backend.app.services.core.SongCatalogService import SongCatalog, SongCatalogService, serialize_song
+from utils.bert_for_lyrics_config import BertForLyricsConfig, InferenceMode
 
-DEVICE: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MODEL_PATH: Path = Path("models/xlm-roberta-base_1") # "models/xlm-roberta-base_1, models/xlm-roberta-base_new/xlm-roberta-base
+INFERENCE_MODE: InferenceMode = "fp32" # fp32, bf16 or int8 (cpu only), see benchmark_inference_modes.py
+INFERENCE_BACKEND: InferenceBackend = "torch" # onnx --> graphs from export_onnx.py, torch and transformers are not loaded
 CSV_FILE_PATH: Path = Path("song_labels/processed/")
+TOKEN_CACHE_DIR: Path = Path("cache/tokens")
+EMBEDDING_STORE_DIR: Path = Path("cache/embeddings")
+PROJECTION_DIR: Path = Path("cache/projections")
+INDEX_DIR: Path = Path("cache/index")
+MAX_SIMILAR_SONGS: int = 100
+SONGS_JSON_PATH: Path = Path("backend/data/songs_2.json").resolve()
+NUM_SONGS_PER_GAME: int = 60
+TSNE_PLOT_PATH: Path = Path("cache/plots/tsne.png").resolve()
 
 print(CSV_FILE_PATH.exists())
 
@@ -22,7 +28,8 @@ bert_config: BertForLyricsConfig = BertForLyricsConfig(
         model_name="xlm-roberta-base",
         num_labels=7,
         chunk_size=510,
-        stride=256
+        stride=256,
+        token_cache_dir=TOKEN_CACHE_DIR,
     )
 
 LABELS: list[str] = [
@@ -40,65 +47,163 @@ id2label: dict[int, str] = {i: l for i, l in enumerate(LABELS)}
 # services
 model_service: LyricsModelService | None = None
 dataset_service: LyricsDatasetService | None = None
+services_lock: threading.Lock = threading.Lock()
+
+# progress of the background warm-up, read by /api/status
+warmup_status: dict[str, bool | int | str | None] = {
+    "ready": False,
+    "encoded": 0,
+    "total": 0,
+    "error": None,
+    "tsne_plot_ready": False,
+}
+warmup_thread: threading.Thread | None = None
+
+# static songs from the json file and the model-backed songs once the warm-up is done
+catalog_service: SongCatalogService = SongCatalogService(SONGS_JSON_PATH)
+model_catalog: SongCatalog | None = None
+
+RETRY_AFTER_SECONDS: int = 10
 
 api_bp = Blueprint("api", __name__)
 
 def get_dataset_service() -> LyricsDatasetService:
     global model_service, dataset_service
 
-    if model_service is None:
-        model_service = LyricsModelService(
-            model_path=MODEL_PATH,
-            config=bert_config,
-            device=DEVICE,
-            id2label=id2label,
-        )
-
-    if dataset_service is None:
-        dataset_service = LyricsDatasetService(
-            csv_file_path=CSV_FILE_PATH,
-            model_service=model_service,
-        )
+    with services_lock:
+        if model_service is None:
+            model_service = LyricsModelService(
+                model_path=MODEL_PATH,
+                config=bert_config,
+                id2label=id2label,
+                inference_mode=INFERENCE_MODE,
+                backend=INFERENCE_BACKEND,
+            )
+
+        if dataset_service is None:
+            dataset_service = LyricsDatasetService(
+                csv_file_path=CSV_FILE_PATH,
+                model_service=model_service,
+                embedding_store_dir=EMBEDDING_STORE_DIR,
+                projection_dir=PROJECTION_DIR,
+                index_dir=INDEX_DIR,
+                on_progress=update_warmup_progress,
+            )
 
     return dataset_service
 
-@api_bp.get("/songs_from_model")
-def get_songs() -> Response:
-    dataset_service = get_dataset_service()
+def update_warmup_progress(encoded: int, total: int) -> None:
+    warmup_status["encoded"] = encoded
+    warmup_status["total"] = total
 
-    songs: list[SongDTO] = dataset_service.get_all_songs()
-    songs_json = []
+def warmup() -> None:
+    global model_catalog
 
-    for song in songs:
-        song_dict = song.model_dump()
-        if isinstance(song_dict["tsne_vector"], np.ndarray):
-            song_dict["tsne_vector"] = song_dict["tsne_vector"].tolist()
-        songs_json.append(song_dict)
+    try:
+        dataset_service = get_dataset_service()
+        model_catalog = SongCatalog(dataset_service.get_all_songs())
+        warmup_status["ready"] = True
+        print("Warm-up finished, model-backed songs are ready")
 
-    random.shuffle(songs_json)
-    songs_json = songs_json[:60]
+        # the plot is an offline artifact, it is rendered once after the embeddings are loaded
+        dataset_service.save_tsne_plot(TSNE_PLOT_PATH)
+        warmup_status["tsne_plot_ready"] = TSNE_PLOT_PATH.exists()
+    except Exception as e:
+        warmup_status["error"] = str(e)
+        print("Warm-up failed:", e)
 
-    dataset_service.plot_tsne()
+def start_warmup() -> None:
+    """loads the model and encodes the songs in a background thread, the api serves the static songs meanwhile"""
+    global warmup_thread
 
-    return jsonify(songs_json)
+    if warmup_thread is not None:
+        return
 
-@api_bp.get("/songs")
-def get_songs_json() -> Response:
-    json_song_path: Path = Path("backend/data/songs_2.json").resolve()
-    song_dataframe: pd.DataFrame = pd.read_json(json_song_path)
+    catalog_service.get_catalog()
 
-    songs: list[SongDTO] = [
-        SongDTO(**row) for row in song_dataframe.to_dict(orient="records")
-    ]
+    warmup_thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+    warmup_thread.start()
 
-    songs_json = []
-    for song in songs:
-        song_dict = song.model_dump()
-        if isinstance(song_dict.get("tsne_vector"), np.ndarray):
-            song_dict["tsne_vector"] = song_dict["tsne_vector"].tolist()
-        songs_json.append(song_dict)
+def json_response(body: bytes) -> Response:
+    return Response(body, mimetype="application/json")
 
-    random.shuffle(songs_json)
-    songs_json = songs_json[:60]
+def service_unavailable() -> Response:
+    """503 with Retry-After while the warm-up is running, 500 without it once the warm-up failed (it is not retried)"""
+    response: Response = jsonify(warmup_status)
+    if warmup_status["error"] is not None:
+        response.status_code = 500
+        return response
 
-    return jsonify(songs_json)
+    response.status_code = 503
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response
+
+@api_bp.get("/status")
+def get_status() -> Response:
+    return jsonify(warmup_status)
+
+@api_bp.get("/songs_from_model")
+def get_songs() -> Response:
+    if not warmup_status["ready"]:
+        return service_unavailable()
+
+    return json_response(model_catalog.sample_json(NUM_SONGS_PER_GAME))
+
+@api_bp.get("/songs")
+def get_songs_json() -> Response:
+    # the static songs are only a fallback until the model-backed songs are ready
+    catalog: SongCatalog = model_catalog if warmup_status["ready"] else catalog_service.get_catalog()
+    return json_response(catalog.sample_json(NUM_SONGS_PER_GAME))
+
+@api_bp.post("/songs")
+def add_song() -> Response:
+    """{"name": ..., "author": ..., "lyrics": ...} --> the predicted song, it is playable and searchable right away"""
+    if not warmup_status["ready"]:
+        return service_unavailable()
+
+    body: dict = request.get_json(silent=True) or {}
+    name, author, lyrics = body.get("name"), body.get("author"), body.get("lyrics")
+    if not all(isinstance(value, str) for value in (name, author, lyrics)) or not lyrics.strip():
+        response: Response = jsonify({"error": "name, author and non-empty lyrics are required"})
+        response.status_code = 400
+        return response
+
+    song, is_new = get_dataset_service().add_song(name, author, lyrics)
+    if is_new:
+        model_catalog.add(song)
+
+    response = json_response(serialize_song(song))
+    response.status_code = 201 if is_new else 200
+    return response
+
+@api_bp.get("/songs/<song_id>/similar")
+def get_similar_songs(song_id: str) -> Response:
+    if not warmup_status["ready"]:
+        return service_unavailable()
+
+    k: int = request.args.get("k", default=10, type=int)
+    if k < 1:
+        response: Response = jsonify({"error": "k must be at least 1"})
+        response.status_code = 400
+        return response
+    k = min(k, MAX_SIMILAR_SONGS)
+
+    try:
+        similar = get_dataset_service().get_similar_songs(song_id, k)
+    except KeyError:
+        return Response(status=404)
+
+    # {"similarity": ..., "song": {...}} per song, the songs are already serialized in the catalog format
+    body: bytes = b"[" + b",".join(
+        b'{"similarity":%.6f,"song":%s}' % (score, serialize_song(song))
+        for song, score in similar
+    ) + b"]"
+    return json_response(body)
+
+@api_bp.get("/tsne.png")
+def get_tsne_plot() -> Response:
+    if not warmup_status["tsne_plot_ready"]:
+        return service_unavailable()
+
+    # conditional responses with ETag/Last-Modified, the browser only downloads a new plot
+    return send_file(TSNE_PLOT_PATH, mimetype="image/png", conditional=True, max_age=60)
@@ -10,6 +10,7 @@ class SongDTO(BaseModel):
     lyrics_length: int
     lyrics: str
     tsne_vector: np.ndarray | None
+    id: str | None = None  # lyrics hash, only set for the model-backed songs
 
     class Config:
         arbitrary_types_allowed = True
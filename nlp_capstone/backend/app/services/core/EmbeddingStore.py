@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    content addressed store of the model outputs per song, keyed by the lyrics hash and the model fingerprint
+    embeddings and logits are memory-mapped .npy matrices, index.json maps the lyrics hash to the row
+    and holds the predicted labels
+    songs that are added later are appended to side files (one json line per song and raw float32 rows),
+    the matrices and index.json are only rewritten (compacted) once the side files hold as many songs as them
+    the backend threads share one store, every access holds the lock
+    """
+
+    INDEX_FILE: str = "index.json"
+    EMBEDDINGS_FILE: str = "embeddings.npy"
+    LOGITS_FILE: str = "logits.npy"
+    ADDED_INDEX_FILE: str = "added.jsonl"  # {"key": ..., "label": ...} per song
+    ADDED_EMBEDDINGS_FILE: str = "added_embeddings.f32"
+    ADDED_LOGITS_FILE: str = "added_logits.f32"
+
+    def __init__(self, store_dir: Path, fingerprint: str):
+        # every checkpoint gets its own directory, outputs of an old checkpoint are never mixed in
+        self.store_dir: Path = Path(store_dir) / fingerprint
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+        self.rows: dict[str, int] = {}
+        self.labels: list[str] = []
+        self.embeddings: np.ndarray | None = None
+        self.logits: np.ndarray | None = None
+        # rows of the side files, row self.num_saved + i is self.added_embeddings[i]
+        self.num_saved: int = 0
+        self.added_embeddings: list[np.ndarray] = []
+        self.added_logits: list[np.ndarray] = []
+        self._lock: threading.RLock = threading.RLock()
+        self._open()
+
+    def _open(self) -> None:
+        index_path: Path = self.store_dir / self.INDEX_FILE
+        if not index_path.exists():
+            return
+
+        with open(index_path, "r", encoding="utf-8") as f:
+            index: dict = json.load(f)
+
+        self.rows = index["rows"]
+        self.labels = index["labels"]
+        self.num_saved = len(self.labels)
+
+        # read only memory maps, the rows are only copied when they are accessed
+        self.embeddings = np.load(self.store_dir / self.EMBEDDINGS_FILE, mmap_mode="r")
+        self.logits = np.load(self.store_dir / self.LOGITS_FILE, mmap_mode="r")
+        self._open_added()
+
+    def _open_added(self) -> None:
+        index_path: Path = self.store_dir / self.ADDED_INDEX_FILE
+        embeddings_path: Path = self.store_dir / self.ADDED_EMBEDDINGS_FILE
+        logits_path: Path = self.store_dir / self.ADDED_LOGITS_FILE
+        if not index_path.exists() or not embeddings_path.exists() or not logits_path.exists():
+            return
+
+        # a crash during an append leaves a partial line or row, all three files are cut to the complete songs
+        index_bytes: bytes = index_path.read_bytes()
+        entries: list[dict] = [
+            json.loads(line)
+            for line in index_bytes[:index_bytes.rfind(b"\n") + 1].decode("utf-8").splitlines()
+        ]
+        embeddings: np.ndarray = np.fromfile(embeddings_path, dtype=np.float32)
+        logits: np.ndarray = np.fromfile(logits_path, dtype=np.float32)
+        hidden_size: int = self.embeddings.shape[1]
+        num_labels: int = self.logits.shape[1]
+        num_added: int = min(len(entries), embeddings.size // hidden_size, logits.size // num_labels)
+
+        entries = entries[:num_added]
+        embeddings = embeddings[:num_added * hidden_size].reshape(num_added, hidden_size)
+        logits = logits[:num_added * num_labels].reshape(num_added, num_labels)
+        if (
+            num_added != len(index_bytes.splitlines())
+            or embeddings.nbytes != embeddings_path.stat().st_size
+            or logits.nbytes != logits_path.stat().st_size
+        ):
+            index_path.write_text("".join(json.dumps(entry) + "\n" for entry in entries), encoding="utf-8")
+            os.truncate(embeddings_path, embeddings.nbytes)
+            os.truncate(logits_path, logits.nbytes)
+
+        # a crash between the compaction and the removal of the side files leaves songs that are in index.json
+        for entry, embedding, logit in zip(entries, embeddings, logits):
+            if entry["key"] in self.rows:
+                continue
+            self.rows[entry["key"]] = len(self.labels)
+            self.labels.append(entry["label"])
+            self.added_embeddings.append(embedding)
+            self.added_logits.append(logit)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self.rows
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self.rows)
+
+    def get(self, key: str) -> tuple[str, np.ndarray, np.ndarray]:
+        """Returns the predicted label, the logits and the embedding of the song with the given lyrics hash"""
+        with self._lock:
+            row: int = self.rows[key]
+            if row < self.num_saved:
+                return self.labels[row], self.logits[row], self.embeddings[row]
+            return self.labels[row], self.added_logits[row - self.num_saved], self.added_embeddings[row - self.num_saved]
+
+    def add(
+        self,
+        keys: list[str],
+        labels: list[str],
+        logits: np.ndarray,
+        embeddings: np.ndarray,
+    ) -> None:
+        """appends new songs, keys that are already stored are skipped, O(new songs) apart from the compaction"""
+        with self._lock:
+            new_rows: list[int] = []
+            seen: set[str] = set()
+            for i, key in enumerate(keys):
+                if key not in self.rows and key not in seen:
+                    new_rows.append(i)
+                    seen.add(key)
+            if not new_rows:
+                return
+
+            new_embeddings: np.ndarray = np.asarray(embeddings, dtype=np.float32)[new_rows]
+            new_logits: np.ndarray = np.asarray(logits, dtype=np.float32)[new_rows]
+
+            for i in new_rows:
+                self.rows[keys[i]] = len(self.labels)
+                self.labels.append(labels[i])
+            self.added_embeddings.extend(new_embeddings)
+            self.added_logits.extend(new_logits)
+
+            if len(self.added_embeddings) > self.num_saved:
+                self._compact()
+                return
+
+            # the rows first, a line of the index marks its rows as complete
+            with open(self.store_dir / self.ADDED_EMBEDDINGS_FILE, "ab") as f:
+                f.write(new_embeddings.tobytes())
+            with open(self.store_dir / self.ADDED_LOGITS_FILE, "ab") as f:
+                f.write(new_logits.tobytes())
+            with open(self.store_dir / self.ADDED_INDEX_FILE, "a", encoding="utf-8") as f:
+                f.write("".join(
+                    json.dumps({"key": keys[i], "label": labels[i]}) + "\n"
+                    for i in new_rows
+                ))
+
+    def _compact(self) -> None:
+        """rewrites the matrices and index.json with all songs, the side files are removed"""
+        self.embeddings = self._write_matrix(self.EMBEDDINGS_FILE, self.embeddings, self.added_embeddings)
+        self.logits = self._write_matrix(self.LOGITS_FILE, self.logits, self.added_logits)
+
+        # the index is written after the matrices, a crash before this point leaves the old index with valid rows
+        self._atomic_write(
+            self.INDEX_FILE,
+            lambda path: path.write_text(
+                json.dumps({"rows": self.rows, "labels": self.labels}),
+                encoding="utf-8",
+            ),
+        )
+        self.num_saved = len(self.labels)
+        self.added_embeddings = []
+        self.added_logits = []
+
+        for file_name in (self.ADDED_INDEX_FILE, self.ADDED_EMBEDDINGS_FILE, self.ADDED_LOGITS_FILE):
+            (self.store_dir / file_name).unlink(missing_ok=True)
+
+    def _write_matrix(
+        self,
+        file_name: str,
+        old: np.ndarray | None,
+        new: list[np.ndarray],
+    ) -> np.ndarray:
+        new_matrix: np.ndarray = np.vstack(new).astype(np.float32)
+        num_old: int = 0 if old is None else len(old)
+
+        def write(path: Path) -> None:
+            matrix: np.memmap = np.lib.format.open_memmap(
+                path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(num_old + len(new_matrix), new_matrix.shape[1]),
+            )
+            if num_old:
+                matrix[:num_old] = old
+            matrix[num_old:] = new_matrix
+            matrix.flush()
+            del matrix
+
+        self._atomic_write(file_name, write)
+        return np.load(self.store_dir / file_name, mmap_mode="r")
+
+    def _atomic_write(self, file_name: str, write: Callable[[Path], None]) -> None:
+        target: Path = self.store_dir / file_name
+        tmp_path: Path = target.with_name(f"{target.stem}.{os.getpid()}.tmp{target.suffix}")
+        write(tmp_path)
+        os.replace(tmp_path, target)
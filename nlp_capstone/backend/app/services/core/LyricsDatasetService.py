@@ -1,55 +1,112 @@
+import threading
+from collections.abc import Callable
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 from pandas import DataFrame
-from sklearn.manifold import TSNE
 
 from backend.app.schemas.song import SongDTO
-from backend.app.services.core.LyricsModelService import LyricsModelService
+from backend.app.services.core.EmbeddingStore import EmbeddingStore
+from backend.app.services.core.LyricsModelService import BatchPrediction, LyricsModelService
+from backend.app.services.core.SongIndex import SongIndex
+from backend.app.services.core.SongProjection import SongProjection
+from utils.hashing import lyrics_hash
+from utils.song_labels_dataset import read_song_labels
 
 
 class LyricsDatasetService:
     """loads the songs form the csv and generated the songDTOs with embeddings"""
 
-    def __init__(self, csv_file_path: Path, model_service: LyricsModelService):
+    def __init__(
+        self,
+        csv_file_path: Path,
+        model_service: LyricsModelService,
+        embedding_store_dir: Path | None = None,
+        projection_dir: Path | None = None,
+        index_dir: Path | None = None,
+        on_progress: Callable[[int, int], None] | None = None,
+    ):
+        """on_progress is called with (encoded songs, total songs) while the songs are loaded"""
         self.csv_file_path: Path = csv_file_path
         self.model_service: LyricsModelService = model_service
+        self.on_progress: Callable[[int, int], None] | None = on_progress
+        self.embedding_store: EmbeddingStore | None = None
+        if embedding_store_dir is not None:
+            self.embedding_store = EmbeddingStore(embedding_store_dir, model_service.fingerprint)
+        self.projection: SongProjection = SongProjection(projection_dir, model_service.fingerprint)
+        self.index_dir: Path | None = index_dir
+        self.song_index: SongIndex | None = None
         self.songs: list[SongDTO] = []
+        self.songs_by_id: dict[str, SongDTO] = {}
+        self._add_lock: threading.Lock = threading.Lock()
         self._load()
 
     def load_csv_files(self) -> DataFrame:
-        csv_files: list[Path] = list(self.csv_file_path.glob("*.csv"))
-
-        if not csv_files:
-            raise RuntimeError(f"No CSV files found in {self.csv_file_path}")
-
-        dfs: list[DataFrame] = [
-            pd.read_csv(csv_file)
-            for csv_file in csv_files
-        ]
-
-        df: DataFrame = pd.concat(dfs, ignore_index=True)
-        return df
+        """the columns of the songs from the compiled dataset of the csv files (memory-mapped, built on the first call)"""
+        return read_song_labels(
+            self.csv_file_path,
+            columns=["Song Name", "Author", "lyrics_available", "lyrics", "lyrics_hash"],
+        )
 
     def _load(self) -> None:
         if not self.csv_file_path.exists():
             raise FileNotFoundError(self.csv_file_path)
 
         df: DataFrame = self.load_csv_files()
-        df = df[df["lyrics_available"] == True].reset_index(drop=True)
+        df = df[df["lyrics_available"] & df["lyrics_hash"].ne("")].reset_index(drop=True)
 
         embeddings: list[np.ndarray] = []
+        keys: list[str] = []
         temp_songs: list[SongDTO] = []
 
-        for _, row in df.iterrows():
-            lyrics = str(row["lyrics"]).strip()
-            if not lyrics:
+        # the lyrics hash is part of the dataset, no hashing per start of the backend
+        rows: list[tuple[pd.Series, str, str]] = [
+            (row, str(row["lyrics"]).strip(), row["lyrics_hash"])
+            for _, row in df.iterrows()
+        ]
+
+        # only songs that are not in the embedding store yet go through the model
+        outputs: dict[str, tuple[str, np.ndarray]] = {}
+        new_lyrics: dict[str, str] = {}
+
+        for _, lyrics, key in rows:
+            if key in outputs or key in new_lyrics:
                 continue
 
-            # maybe a faster fix is to predict all texts at once
-            pred_label, embedding = self.model_service.predict(lyrics)
+            if self.embedding_store is not None and key in self.embedding_store:
+                pred_label, _, embedding = self.embedding_store.get(key)
+                outputs[key] = (pred_label, embedding)
+            else:
+                new_lyrics[key] = lyrics
+
+        new_keys: list[str] = list(new_lyrics)
+        num_stored: int = len(outputs)
+        num_total: int = num_stored + len(new_keys)
+        self._report_progress(num_stored, num_total)
+
+        if new_keys:
+            prediction: BatchPrediction = self.model_service.predict_batch(
+                new_lyrics.values(),
+                on_progress=lambda done, _: self._report_progress(num_stored + done, num_total),
+            )
+
+            for key, pred_label, embedding in zip(new_keys, prediction.labels, prediction.embeddings):
+                outputs[key] = (pred_label, embedding)
+
+            if self.embedding_store is not None:
+                self.embedding_store.add(
+                    keys=new_keys,
+                    labels=prediction.labels.tolist(),
+                    logits=prediction.logits,
+                    embeddings=prediction.embeddings,
+                )
+
+        print(f"Encoded {len(new_keys)} new songs, {len(outputs) - len(new_keys)} loaded from the embedding store")
+
+        for row, lyrics, key in rows:
+            pred_label, embedding = outputs[key]
 
             song = SongDTO(
                 name=row.get("Song Name"),
@@ -59,41 +116,125 @@ class LyricsDatasetService:
                 lyrics_length=len(lyrics),
                 lyrics=lyrics,
                 tsne_vector=np.zeros(2), # will be set later
+                id=key,
             )
 
             embeddings.append(embedding)
+            keys.append(key)
             temp_songs.append(song)
 
         if not embeddings:
             return
 
-        tsne = TSNE(
-            n_components=2,
-            perplexity=min(30, len(embeddings) - 1),
-            random_state=42,
-            init="pca",
-            learning_rate="auto",
-        )
-
-        tsne_vectors = tsne.fit_transform(np.vstack(embeddings))
+        # fitted once and persisted, only songs that are not on the map yet are placed out-of-sample
+        tsne_vectors = self.projection.project(keys, np.vstack(embeddings))
 
         for song, vec in zip(temp_songs, tsne_vectors):
             song.tsne_vector = vec.tolist()
             self.songs.append(song)
+            self.songs_by_id.setdefault(song.id, song)
+
+        # one entry per distinct song, duplicates from several annotators share their lyrics hash
+        index_keys: list[str] = list(self.songs_by_id)
+        self.song_index = SongIndex(
+            index_dir=self.index_dir,
+            fingerprint=self.model_service.fingerprint,
+            keys=index_keys,
+            embeddings=np.vstack([outputs[key][1] for key in index_keys]),
+        )
+
+    def add_song(self, name: str, author: str, lyrics: str) -> tuple[SongDTO, bool]:
+        """
+        predicts a single new song, places it on the existing map without moving the other songs
+        and adds it to the similar songs index
+
+        Returns:
+        - the song (the existing one for lyrics that are already loaded)
+        - whether the song is new
+        """
+        lyrics = lyrics.strip()
+        key: str = lyrics_hash(lyrics)
+
+        existing: SongDTO | None = self.songs_by_id.get(key)
+        if existing is not None:
+            return existing, False
+
+        if self.embedding_store is not None and key in self.embedding_store:
+            pred_label, _, embedding = self.embedding_store.get(key)
+        else:
+            prediction: BatchPrediction = self.model_service.predict_batch([lyrics])
+            pred_label, embedding = prediction.labels[0], prediction.embeddings[0]
+
+            if self.embedding_store is not None:
+                self.embedding_store.add(
+                    keys=[key],
+                    labels=[pred_label],
+                    logits=prediction.logits,
+                    embeddings=prediction.embeddings,
+                )
+
+        # the model runs outside of the lock, the map, the index and the song lists are updated together
+        with self._add_lock:
+            existing = self.songs_by_id.get(key)
+            if existing is not None:
+                return existing, False
+
+            tsne_vector: np.ndarray = self.projection.project([key], embedding[np.newaxis, :])[0]
+
+            song = SongDTO(
+                name=name,
+                author=author,
+                classname=pred_label,
+                lyrics_available=True,
+                lyrics_length=len(lyrics),
+                lyrics=lyrics,
+                tsne_vector=tsne_vector.tolist(),
+                id=key,
+            )
+
+            if self.song_index is None:
+                self.song_index = SongIndex(
+                    index_dir=None,
+                    fingerprint=self.model_service.fingerprint,
+                    keys=[key],
+                    embeddings=np.asarray(embedding)[np.newaxis, :],
+                )
+            else:
+                self.song_index.add(key, np.asarray(embedding))
+
+            self.songs.append(song)
+            self.songs_by_id[key] = song
+
+        return song, True
+
+    def get_similar_songs(self, song_id: str, k: int = 10) -> list[tuple[SongDTO, float]]:
+        """the k songs with the most similar lyrics embedding and their cosine similarity"""
+        if self.song_index is None or song_id not in self.song_index:
+            raise KeyError(song_id)
+
+        return [
+            (self.songs_by_id[key], score)
+            for key, score in self.song_index.similar(song_id, k)
+        ]
+
+    def _report_progress(self, encoded: int, total: int) -> None:
+        if self.on_progress is not None:
+            self.on_progress(encoded, total)
 
     def get_all_songs(self) -> list[SongDTO]:
         return self.songs
 
-    def plot_tsne(self) -> None:
-        """Plot t-SNE vectors of all songs, colored by class."""
+    def save_tsne_plot(self, output_path: Path) -> None:
+        """Render the t-SNE vectors of all songs, colored by class, to a png file."""
         if not self.songs:
             print("No songs to plot!")
             return
 
-        plt.figure(figsize=(10, 8))
+        # a plain Figure without pyplot needs no gui backend and can be rendered from any thread
+        fig: Figure = Figure(figsize=(10, 8))
+        ax = fig.subplots()
 
         classes: list[str] = sorted(set(song.classname for song in self.songs))
-        class_to_color: dict[str, int] = {cls: i for i, cls in enumerate(classes)}
 
         for cls in classes:
             xs: list[float] = [
@@ -107,16 +248,20 @@ class LyricsDatasetService:
                 if song.classname == cls
             ]
 
-            plt.scatter(
+            ax.scatter(
                 xs,
                 ys,
                 label=cls,
                 alpha=0.7
             )
 
-        plt.title("t-SNE Visualization of Songs by Class")
-        plt.legend(title="Class")
-        plt.xlabel("t-SNE 1")
-        plt.ylabel("t-SNE 2")
-        plt.tight_layout()
-        plt.show()
\ No newline at end of file
+        ax.set_title("t-SNE Visualization of Songs by Class")
+        ax.legend(title="Class")
+        ax.set_xlabel("t-SNE 1")
+        ax.set_ylabel("t-SNE 2")
+        fig.tight_layout()
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path: Path = output_path.with_name(f"{output_path.stem}.tmp{output_path.suffix}")
+        fig.savefig(tmp_path, format="png")
+        tmp_path.replace(output_path)
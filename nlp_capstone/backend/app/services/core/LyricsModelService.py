@@ -1,7 +1,28 @@
+import hashlib
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
 from pathlib import Path
-import torch
+from typing import TYPE_CHECKING, Literal
 import numpy as np
-from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.bert_for_lyrics_config import BertForLyricsConfig, InferenceMode
+
+# torch and transformers (BertForLyrics) are only imported for the torch backend, the onnx backend does not load them
+if TYPE_CHECKING:
+    import torch
+    from utils.bert_for_lyrics import BertForLyrics
+    from utils.onnx_lyrics_model import OnnxLyricsModel
+
+
+@dataclass
+class BatchPrediction:
+    labels: np.ndarray  # (num_songs,) predicted class names
+    label_ids: np.ndarray  # (num_songs,)
+    probabilities: np.ndarray  # (num_songs, num_labels)
+    logits: np.ndarray  # (num_songs, num_labels)
+    embeddings: np.ndarray  # (num_songs, hidden_size)
+
+
+type InferenceBackend = Literal["torch", "onnx"]
 
 
 class LyricsModelService:
@@ -11,32 +32,152 @@ class LyricsModelService:
         self,
         model_path: Path,
         config: BertForLyricsConfig,
-        device: torch.device,
         id2label: dict[int, str],
+        device: "torch.device | None" = None,
+        inference_mode: InferenceMode = "fp32",
+        backend: InferenceBackend = "torch",
     ):
-        self.device: torch.device = device
+        """
+        backend "onnx" runs the graphs from export_onnx.py with onnx runtime on the cpu,
+        device (None --> cuda if available) and inference_mode only apply to torch
+        """
+        self.device: "torch.device | None" = device
         self.id2label : dict[int, str]= id2label
+        self.model_path: Path = model_path
+        self.config: BertForLyricsConfig = config
+        self.inference_mode: InferenceMode = inference_mode
+        self.backend: InferenceBackend = backend
+
+        self.model: "BertForLyrics | OnnxLyricsModel"
+        match backend:
+            case "torch":
+                import torch
+                from utils.bert_for_lyrics import BertForLyrics
+
+                if self.device is None:
+                    self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+                self.model = BertForLyrics.load_model(
+                    path=model_path,
+                    config=config,
+                    device=self.device,
+                    inference_mode=inference_mode,
+                )
+                self.model.eval()
+            case "onnx":
+                # imported here, so the torch backend does not need onnxruntime installed
+                from utils.onnx_lyrics_model import OnnxLyricsModel
 
-        self.model: BertForLyrics = BertForLyrics.load_model(
-            path=model_path,
-            config=config,
-            device=device,
+                self.model = OnnxLyricsModel(
+                    model_dir=model_path,
+                    chunk_size=config.chunk_size,
+                    stride=config.stride,
+                    use_max_pooling=config.use_max_pooling,
+                    max_chunks_per_call=config.max_chunks_per_call,
+                    token_cache_dir=config.token_cache_dir,
+                )
+            case _:
+                raise ValueError(f"inference backend {backend} is not supported")
+
+        self.fingerprint: str = self.checkpoint_fingerprint()
+
+    def checkpoint_fingerprint(self) -> str:
+        """
+        identifies the checkpoint and every config value that changes the model outputs,
+        the files are identified by name, size and modification time instead of hashing gigabytes of weights
+        """
+        h = hashlib.sha1()
+        h.update(
+            f"{self.config.model_name}|{self.config.chunk_size}|{self.config.stride}|{self.config.use_max_pooling}".encode()
         )
-        self.model.eval()
 
-    @torch.no_grad()
-    def predict(self, lyrics: str) -> tuple[str, np.ndarray]:
+        files: list[Path] = [file for file in self.model_path.iterdir() if file.is_file()]
+        match self.backend:
+            case "torch":
+                h.update(f"torch|{self.inference_mode}".encode())
+            case "onnx":
+                # the exported graphs are only part of the checkpoint for the onnx backend
+                h.update(b"onnx")
+                files += [file for file in (self.model_path / "onnx").iterdir() if file.is_file()]
+
+        for file in sorted(files):
+            stat = file.stat()
+            h.update(f"{file.relative_to(self.model_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+
+        return h.hexdigest()[:16]
+
+    def _predict(
+        self,
+        lyrics: list[str],
+        batch_size: int,
+        on_progress: Callable[[int, int], None] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """logits and embeddings of both backends as numpy arrays"""
+        if self.backend == "onnx":
+            return self.model.predict_batch(lyrics, batch_size=batch_size, on_progress=on_progress)
+
+        import torch
+
+        with torch.no_grad():
+            logits, embeddings = self.model.predict_batch(
+                lyrics,
+                batch_size=batch_size,
+                on_progress=on_progress,
+            )
+        return logits.cpu().numpy(), embeddings.cpu().numpy()
+
+    def encode(self, lyrics: str) -> tuple[np.ndarray, np.ndarray]:
         """
         Returns:
-        - predicted class
+        - logits (num_labels,)
         - embedding (hidden_size,)
         """
         if not lyrics:
             raise ValueError("Empty lyrics")
 
-        logits, embedding = self.model([lyrics])
+        logits, embeddings = self._predict([lyrics], batch_size=1)
+
+        return logits[0], embeddings[0]
+
+    def predict(self, lyrics: str) -> tuple[str, np.ndarray]:
+        """
+        Returns:
+        - predicted class
+        - embedding (hidden_size,)
+        """
+        logits, embedding = self.encode(lyrics)
 
-        pred_id: int = torch.argmax(logits, dim=1).item()
+        pred_id: int = int(np.argmax(logits))
         pred_label: str = self.id2label[pred_id]
 
-        return pred_label, embedding.squeeze(0).cpu().numpy()
\ No newline at end of file
+        return pred_label, embedding
+
+    def predict_batch(
+        self,
+        lyrics: Iterable[str],
+        batch_size: int = 16,
+        on_progress: Callable[[int, int], None] | None = None,
+    ) -> BatchPrediction:
+        """
+        predicts many songs at once, the songs are sorted by their token length and processed
+        in micro batches of batch_size songs, the results are in the order of the input
+        on_progress is called after every micro batch with (done songs, total songs)
+        """
+        lyrics = list(lyrics)
+        if not lyrics or not all(lyrics):
+            raise ValueError("Empty lyrics")
+
+        logits, embeddings = self._predict(lyrics, batch_size=batch_size, on_progress=on_progress)
+
+        # softmax in numpy, shifted by the max for numerical stability
+        exp_logits: np.ndarray = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities: np.ndarray = exp_logits / exp_logits.sum(axis=1, keepdims=True)
+        label_ids: np.ndarray = logits.argmax(axis=1)
+
+        return BatchPrediction(
+            labels=np.array([self.id2label[int(i)] for i in label_ids], dtype=object),
+            label_ids=label_ids,
+            probabilities=probabilities,
+            logits=logits,
+            embeddings=embeddings,
+        )
@@ -0,0 +1,66 @@
+import json
+import random
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backend.app.schemas.song import SongDTO
+
+
+def serialize_song(song: SongDTO) -> bytes:
+    song_dict = song.model_dump()
+    if isinstance(song_dict.get("tsne_vector"), np.ndarray):
+        song_dict["tsne_vector"] = song_dict["tsne_vector"].tolist()
+    return json.dumps(song_dict).encode("utf-8")
+
+
+class SongCatalog:
+    """every song is serialized once, a request only samples indices and joins the cached json bytes"""
+
+    def __init__(self, songs: list[SongDTO]):
+        self.songs_json: list[bytes] = [serialize_song(song) for song in songs]
+
+    def __len__(self) -> int:
+        return len(self.songs_json)
+
+    def add(self, song: SongDTO) -> None:
+        self.songs_json.append(serialize_song(song))
+
+    def sample_json(self, k: int) -> bytes:
+        """json array of k random songs (all songs in random order if there are fewer)"""
+        indices: list[int] = random.sample(range(len(self.songs_json)), min(k, len(self.songs_json)))
+        return b"[" + b",".join(self.songs_json[i] for i in indices) + b"]"
+
+
+class SongCatalogService:
+    """song catalog of a json file, it is built once and only rebuilt when the file modification time changes"""
+
+    def __init__(self, json_path: Path):
+        self.json_path: Path = json_path
+        self._catalog: SongCatalog | None = None
+        self._mtime_ns: int | None = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def get_catalog(self) -> SongCatalog:
+        mtime_ns: int = self.json_path.stat().st_mtime_ns
+        if self._catalog is not None and mtime_ns == self._mtime_ns:
+            return self._catalog
+
+        with self._lock:
+            # another request may have rebuilt the catalog while this one was waiting
+            if self._catalog is None or mtime_ns != self._mtime_ns:
+                self._catalog = self._load()
+                self._mtime_ns = mtime_ns
+                print(f"Song catalog loaded from {self.json_path} ({len(self._catalog)} songs)")
+
+        return self._catalog
+
+    def _load(self) -> SongCatalog:
+        song_dataframe: pd.DataFrame = pd.read_json(self.json_path)
+
+        songs: list[SongDTO] = [
+            SongDTO(**row) for row in song_dataframe.to_dict(orient="records")
+        ]
+        return SongCatalog(songs)
@@ -0,0 +1,218 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms: np.ndarray = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """indices of the k largest scores, sorted descending"""
+    if k < 1:
+        raise ValueError(f"k must be at least 1, got {k}")
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    candidates: np.ndarray = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class ExactIndex:
+    """brute force cosine similarity with one matrix vector product, exact and fast enough for small corpora"""
+
+    kind: str = "exact"
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors: np.ndarray = normalize(vectors)
+
+    def search(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the row indices and cosine similarities of the k most similar vectors"""
+        scores: np.ndarray = self.vectors @ normalize(query)
+        indices: np.ndarray = top_k(scores, k)
+        return indices, scores[indices]
+
+    def save(self, index_dir: Path) -> None:
+        np.save(index_dir / "vectors.npy", self.vectors)
+
+    @classmethod
+    def load(cls, index_dir: Path, meta: dict) -> 'ExactIndex':
+        index = cls.__new__(cls)
+        index.vectors = np.load(index_dir / "vectors.npy", mmap_mode="r")
+        return index
+
+
+class IVFIndex:
+    """
+    inverted file index: the vectors are clustered with k-means, a query only scores the vectors
+    of the n_probe closest clusters, the vectors are stored sorted by cluster so every list is one slice
+    """
+
+    kind: str = "ivf"
+
+    def __init__(self, vectors: np.ndarray, n_lists: int | None = None, n_probe: int = 8):
+        vectors = normalize(vectors)
+        self.n_lists: int = n_lists or max(1, int(np.sqrt(len(vectors))))
+        self.n_probe: int = n_probe
+
+        kmeans = MiniBatchKMeans(
+            n_clusters=self.n_lists,
+            random_state=42,
+            batch_size=4096,
+            n_init=3,
+        )
+        assignments: np.ndarray = kmeans.fit_predict(vectors)
+        self.centroids: np.ndarray = normalize(kmeans.cluster_centers_)
+
+        order: np.ndarray = np.argsort(assignments, kind="stable")
+        self.ids: np.ndarray = order.astype(np.int64)  # row index of every stored vector
+        self.vectors: np.ndarray = vectors[order]
+        self.offsets: np.ndarray = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+
+    def search(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the row indices and cosine similarities of the (approximately) k most similar vectors"""
+        query = normalize(query)
+        lists: np.ndarray = top_k(self.centroids @ query, self.n_probe)
+
+        candidates: np.ndarray = np.concatenate([
+            np.arange(self.offsets[i], self.offsets[i + 1])
+            for i in lists
+        ])
+        scores: np.ndarray = self.vectors[candidates] @ query
+        best: np.ndarray = top_k(scores, k)
+        return self.ids[candidates[best]], scores[best]
+
+    def save(self, index_dir: Path) -> None:
+        np.save(index_dir / "vectors.npy", self.vectors)
+        np.save(index_dir / "ids.npy", self.ids)
+        np.save(index_dir / "offsets.npy", self.offsets)
+        np.save(index_dir / "centroids.npy", self.centroids)
+
+    @classmethod
+    def load(cls, index_dir: Path, meta: dict) -> 'IVFIndex':
+        index = cls.__new__(cls)
+        index.n_lists = meta["n_lists"]
+        index.n_probe = meta["n_probe"]
+        index.vectors = np.load(index_dir / "vectors.npy", mmap_mode="r")
+        index.ids = np.load(index_dir / "ids.npy")
+        index.offsets = np.load(index_dir / "offsets.npy")
+        index.centroids = np.load(index_dir / "centroids.npy")
+        return index
+
+
+type VectorIndex = ExactIndex | IVFIndex
+
+
+class SongIndex:
+    """
+    nearest neighbour index over the song embeddings, keyed by the lyrics hash
+    small corpora use the exact index, larger ones the approximate IVF index
+    the index is persisted per checkpoint fingerprint and only rebuilt when the songs change,
+    songs that are added at runtime (add) are compared exactly next to it, the index files are not rewritten
+    """
+
+    META_FILE: str = "meta.json"
+
+    def __init__(
+        self,
+        index_dir: Path | None,
+        fingerprint: str,
+        keys: list[str],
+        embeddings: np.ndarray,
+        exact_threshold: int = 20_000,
+    ):
+        self.keys: list[str] = list(keys)
+        self.embeddings: np.ndarray = embeddings
+        self.rows: dict[str, int] = {key: i for i, key in enumerate(keys)}
+        self.num_indexed: int = len(keys)
+        self.added_vectors: np.ndarray = np.zeros((0, embeddings.shape[1]), dtype=np.float32)  # l2 normalized
+        self.index_dir: Path | None = None if index_dir is None else Path(index_dir) / fingerprint
+
+        self.index: VectorIndex | None = self._open()
+        if self.index is None:
+            self.index = (
+                ExactIndex(embeddings)
+                if len(keys) <= exact_threshold
+                else IVFIndex(embeddings)
+            )
+            self._save()
+
+    def _open(self) -> VectorIndex | None:
+        if self.index_dir is None or not (self.index_dir / self.META_FILE).exists():
+            return None
+
+        with open(self.index_dir / self.META_FILE, "r", encoding="utf-8") as f:
+            meta: dict = json.load(f)
+
+        # the stored index belongs to another set of songs
+        if meta["keys"] != self.keys[:self.num_indexed]:
+            return None
+
+        match meta["kind"]:
+            case ExactIndex.kind:
+                return ExactIndex.load(self.index_dir, meta)
+            case IVFIndex.kind:
+                return IVFIndex.load(self.index_dir, meta)
+            case _:
+                return None
+
+    def _save(self) -> None:
+        if self.index_dir is None:
+            return
+
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        (self.index_dir / self.META_FILE).unlink(missing_ok=True)
+        self.index.save(self.index_dir)
+
+        meta: dict = {"kind": self.index.kind, "keys": self.keys[:self.num_indexed]}
+        if isinstance(self.index, IVFIndex):
+            meta.update(n_lists=self.index.n_lists, n_probe=self.index.n_probe)
+
+        # the meta file is written last, it marks the index files as complete
+        tmp_path: Path = self.index_dir / f"{self.META_FILE}.{os.getpid()}.tmp"
+        tmp_path.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp_path, self.index_dir / self.META_FILE)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def add(self, key: str, embedding: np.ndarray) -> None:
+        """adds one song, O(added songs) per search instead of rebuilding the index"""
+        if key in self.rows:
+            return
+
+        self.added_vectors = np.vstack([self.added_vectors, normalize(embedding[np.newaxis, :])])
+        self.keys.append(key)
+        self.rows[key] = len(self.keys) - 1
+
+    def _embedding(self, row: int) -> np.ndarray:
+        if row < self.num_indexed:
+            return np.asarray(self.embeddings[row])
+        return self.added_vectors[row - self.num_indexed]
+
+    def similar(self, key: str, k: int) -> list[tuple[str, float]]:
+        """the k most similar songs to the song with the given key (without the song itself)"""
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+        row: int = self.rows[key]
+        query: np.ndarray = self._embedding(row)
+
+        indices, scores = self.index.search(query, k + 1)
+
+        added_vectors: np.ndarray = self.added_vectors
+        if len(added_vectors):
+            indices = np.concatenate([indices, self.num_indexed + np.arange(len(added_vectors))])
+            scores = np.concatenate([scores, added_vectors @ normalize(query)])
+            best: np.ndarray = top_k(scores, k + 1)
+            indices, scores = indices[best], scores[best]
+
+        return [
+            (self.keys[i], float(score))
+            for i, score in zip(indices, scores)
+            if i != row
+        ][:k]
@@ -0,0 +1,190 @@
+import os
+from pathlib import Path
+
+import numpy as np
+from sklearn.manifold import TSNE
+
+
+class SongProjection:
+    """
+    2d map of the song embeddings for the frontend
+    t-SNE is fitted once and persisted, songs that are added later are placed out-of-sample
+    by interpolating the coordinates of their nearest neighbours, so existing songs keep their coordinates
+    the added songs are appended to two side files instead of rewriting the npz per song,
+    the npz is rewritten (compacted) once the side files hold as many songs as the npz
+    """
+
+    FILE: str = "projection.npz"
+    ADDED_KEYS_FILE: str = "added_keys.txt"
+    ADDED_ROWS_FILE: str = "added_rows.f32"  # per song x, y and the unit embedding as float32
+
+    def __init__(
+        self,
+        projection_dir: Path | None,
+        fingerprint: str,
+        n_neighbors: int = 5,
+    ):
+        self.projection_path: Path | None = None
+        if projection_dir is not None:
+            self.projection_path = Path(projection_dir) / fingerprint / self.FILE
+        self.n_neighbors: int = n_neighbors
+
+        self.keys: list[str] = []
+        self.rows: dict[str, int] = {}
+        self.coords: np.ndarray = np.zeros((0, 2), dtype=np.float32)
+        self.unit_embeddings: np.ndarray | None = None  # l2 normalized, for the cosine neighbours
+        self._num_saved: int = 0  # songs in the npz, the rest is in the side files
+        self._open()
+
+    def _open(self) -> None:
+        if self.projection_path is None or not self.projection_path.exists():
+            return
+
+        data = np.load(self.projection_path)
+        self.keys = data["keys"].tolist()
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.coords = data["coords"]
+        self.unit_embeddings = data["unit_embeddings"]
+        self._num_saved = len(self.keys)
+        self._open_added()
+
+    def _open_added(self) -> None:
+        keys_path: Path = self.projection_path.with_name(self.ADDED_KEYS_FILE)
+        rows_path: Path = self.projection_path.with_name(self.ADDED_ROWS_FILE)
+        if not keys_path.exists() or not rows_path.exists():
+            return
+
+        # a crash during an append leaves a partial key line or row, both files are cut to the complete songs
+        keys_bytes: bytes = keys_path.read_bytes()
+        added_keys: list[str] = keys_bytes[:keys_bytes.rfind(b"\n") + 1].decode("utf-8").splitlines()
+        row_size: int = 2 + self.unit_embeddings.shape[1]
+        rows: np.ndarray = np.fromfile(rows_path, dtype=np.float32)
+        num_added: int = min(len(added_keys), rows.size // row_size)
+
+        added_keys = added_keys[:num_added]
+        rows = rows[:num_added * row_size].reshape(num_added, row_size)
+        if num_added != len(keys_bytes.splitlines()) or rows.nbytes != rows_path.stat().st_size:
+            keys_path.write_text("".join(f"{key}\n" for key in added_keys), encoding="utf-8")
+            os.truncate(rows_path, rows.nbytes)
+
+        # a crash between the compaction and the removal of the side files leaves songs that are in the npz
+        known: np.ndarray = np.array([key not in self.rows for key in added_keys], dtype=bool)
+        for key in added_keys:
+            if key not in self.rows:
+                self.rows[key] = len(self.keys)
+                self.keys.append(key)
+
+        self.coords = np.vstack([self.coords, rows[known, :2]])
+        self.unit_embeddings = np.vstack([self.unit_embeddings, rows[known, 2:]])
+
+    def save(self) -> None:
+        """rewrites the npz with all songs, the side files are emptied"""
+        if self.projection_path is None:
+            return
+
+        self.projection_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path: Path = self.projection_path.with_name(f"projection.{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=np.array(self.keys),
+            coords=self.coords,
+            unit_embeddings=self.unit_embeddings,
+        )
+        os.replace(tmp_path, self.projection_path)
+        self._num_saved = len(self.keys)
+
+        self.projection_path.with_name(self.ADDED_ROWS_FILE).unlink(missing_ok=True)
+        self.projection_path.with_name(self.ADDED_KEYS_FILE).unlink(missing_ok=True)
+
+    def _save_added(self, keys: list[str]) -> None:
+        """appends the given (already appended) songs to the side files, O(new songs) instead of O(all songs)"""
+        if self.projection_path is None:
+            return
+
+        if len(self.keys) - self._num_saved > self._num_saved:
+            self.save()
+            return
+
+        rows: np.ndarray = np.hstack([
+            self.coords[-len(keys):],
+            self.unit_embeddings[-len(keys):],
+        ]).astype(np.float32)
+
+        # the rows first, a key line marks its row as complete
+        with open(self.projection_path.with_name(self.ADDED_ROWS_FILE), "ab") as f:
+            f.write(rows.tobytes())
+        with open(self.projection_path.with_name(self.ADDED_KEYS_FILE), "a", encoding="utf-8") as f:
+            f.write("".join(f"{key}\n" for key in keys))
+
+    def project(self, keys: list[str], embeddings: np.ndarray) -> np.ndarray:
+        """
+        Returns the 2d coordinates (num_songs, 2) for the given songs,
+        the first call fits t-SNE, every unknown song afterwards is placed out-of-sample
+        """
+        new: dict[str, int] = {}
+        for i, key in enumerate(keys):
+            if key not in self.rows and key not in new:
+                new[key] = i
+
+        if new:
+            new_embeddings: np.ndarray = np.asarray(embeddings, dtype=np.float32)[list(new.values())]
+
+            if self.unit_embeddings is None:
+                self._fit(list(new), new_embeddings)
+                self.save()
+            else:
+                self._append(list(new), new_embeddings, self.transform(new_embeddings))
+                self._save_added(list(new))
+
+        return self.coords[[self.rows[key] for key in keys]]
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        """out-of-sample placement: distance weighted mean of the coordinates of the nearest fitted songs"""
+        if self.unit_embeddings is None:
+            raise RuntimeError("projection is not fitted yet")
+
+        similarities: np.ndarray = _normalize(embeddings) @ self.unit_embeddings.T
+        k: int = min(self.n_neighbors, len(self.keys))
+
+        # (num_songs, k) indices of the most similar fitted songs, not sorted
+        neighbors: np.ndarray = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        neighbor_similarities: np.ndarray = np.take_along_axis(similarities, neighbors, axis=1)
+
+        weights: np.ndarray = 1.0 / (1.0 - neighbor_similarities + 1e-6)
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        return np.einsum("nk,nkd->nd", weights, self.coords[neighbors]).astype(np.float32)
+
+    def _fit(self, keys: list[str], embeddings: np.ndarray) -> None:
+        if len(keys) < 3:
+            # t-SNE needs a few songs for its neighbourhoods
+            coords: np.ndarray = np.zeros((len(keys), 2), dtype=np.float32)
+        else:
+            tsne = TSNE(
+                n_components=2,
+                perplexity=min(30, len(keys) - 1),
+                random_state=42,
+                init="pca",
+                learning_rate="auto",
+            )
+            coords = tsne.fit_transform(embeddings).astype(np.float32)
+
+        self.keys = []
+        self.rows = {}
+        self.coords = np.zeros((0, 2), dtype=np.float32)
+        self.unit_embeddings = np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+        self._append(keys, embeddings, coords)
+
+    def _append(self, keys: list[str], embeddings: np.ndarray, coords: np.ndarray) -> None:
+        for key in keys:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+
+        self.coords = np.vstack([self.coords, coords])
+        self.unit_embeddings = np.vstack([self.unit_embeddings, _normalize(embeddings)])
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms: np.ndarray = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
@@ -0,0 +1,95 @@
+import time
+from pathlib import Path
+
+import pandas as pd
+import torch
+from torch.optim import AdamW
+from torch.utils.data import DataLoader, Dataset
+from transformers import DataCollatorForLanguageModeling, XLMRobertaForMaskedLM, XLMRobertaTokenizerFast
+
+from benchmark_forward import load_lyrics
+from dapt_pretrain_lyrics import build_mlm_dataset, num_real_tokens
+
+# useful (non padding) tokens/sec of the padded DAPT pipeline vs. the packed 512 token blocks
+MODEL_NAME: str = "xlm-roberta-base"
+CSV_DIR: Path = Path("song_labels/processed")
+NUM_LYRICS: int = 200
+BATCH_SIZE: int = 2
+NUM_STEPS: int = 20
+
+
+def run(dataset: Dataset, tokenizer: XLMRobertaTokenizerFast, device: torch.device) -> dict:
+    torch.manual_seed(42)
+    model: XLMRobertaForMaskedLM = XLMRobertaForMaskedLM.from_pretrained(MODEL_NAME).to(device)
+    model.train()
+    optimizer: AdamW = AdamW(model.parameters(), lr=5e-5)
+
+    dataloader: DataLoader = DataLoader(
+        dataset,
+        batch_size=BATCH_SIZE,
+        shuffle=True,
+        collate_fn=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=True, mlm_probability=0.15),
+    )
+
+    real_tokens: int = 0
+    total_tokens: int = 0
+    start: float = time.perf_counter()
+
+    for step, batch in enumerate(dataloader):
+        if step == NUM_STEPS:
+            break
+
+        batch = {k: v.to(device) for k, v in batch.items()}
+        model(**batch).loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+        real_tokens += num_real_tokens(batch)
+        total_tokens += batch["input_ids"].numel()
+
+    elapsed: float = time.perf_counter() - start
+    return {
+        "useful_tokens_per_sec": real_tokens / elapsed,
+        "padding_fraction": 1 - real_tokens / total_tokens,
+        "steps": min(NUM_STEPS, len(dataloader)),
+    }
+
+
+def main() -> None:
+    device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Device:", device)
+
+    lyrics: list[str] = load_lyrics(CSV_DIR, NUM_LYRICS)
+    tokenizer: XLMRobertaTokenizerFast = XLMRobertaTokenizerFast.from_pretrained(MODEL_NAME)
+    max_length: int = 512
+
+    # tokens of the full lyrics, the padded pipeline only sees the first max_length of every song
+    corpus_tokens: int = sum(len(ids) for ids in tokenizer(lyrics, verbose=False)["input_ids"])
+
+    rows: list[dict] = []
+    for packed in (False, True):
+        start: float = time.perf_counter()
+        dataset: Dataset = build_mlm_dataset(lyrics, tokenizer, max_length=max_length, packed=packed)
+        build_time: float = time.perf_counter() - start
+
+        # tokens per epoch that are not padding
+        epoch_tokens: int = (
+            dataset.blocks.numel()
+            if packed
+            else sum(min(len(ids), max_length) for ids in tokenizer(lyrics, verbose=False)["input_ids"])
+        )
+
+        rows.append({
+            "pipeline": "packed" if packed else "padded",
+            "rows_per_epoch": len(dataset),
+            "corpus_tokens_used": epoch_tokens / corpus_tokens,
+            "build_time_s": build_time,
+            **run(dataset, tokenizer, device),
+        })
+        print(rows[-1])
+
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.3f"))
+
+
+if __name__ == "__main__":
+    main()
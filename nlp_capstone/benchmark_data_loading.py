@@ -0,0 +1,118 @@
+import time
+from collections import Counter
+from pathlib import Path
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.optim import AdamW
+from torch.utils.data import DataLoader
+
+from bert_train import LABELS, NUM_WORKERS, TOKEN_CACHE_DIR, build_train_loader, load_splits, set_seed, train_one_epoch
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.lyrics_dataset import LyricsDataset
+
+# epoch time of the shuffled raw text DataLoader vs. the length bucketed chunk DataLoader of bert_train.py
+MODEL_NAME: str = "xlm-roberta-base"
+CSV_DIR: Path = Path("song_labels/processed")
+NUM_SONGS: int = 128
+BATCH_SIZE: int = 8
+LR: float = 2e-5
+
+
+def raw_text_epoch(model: BertForLyrics, dataloader: DataLoader, optimizer: AdamW, loss_fn: nn.Module) -> list[int]:
+    """the old training loop: raw texts, tokenization and chunking in the training process"""
+    model.train()
+    labels_seen: list[int] = []
+
+    for batch in dataloader:
+        optimizer.zero_grad()
+        logits, _ = model(batch["text"])
+        labels: torch.Tensor = batch["label"].to(model.device)
+        loss_fn(logits, labels).backward()
+        optimizer.step()
+        labels_seen.extend(labels.tolist())
+
+    return labels_seen
+
+
+def padding_ratio(dataloader: DataLoader, max_chunks_per_call: int) -> float:
+    """padded tokens / real tokens over all encoder calls of one epoch"""
+    padded: int = 0
+    real: int = 0
+
+    for batch in dataloader:
+        lengths: torch.Tensor = batch["attention_mask"].sum(dim=1)
+        for start in range(0, len(lengths), max_chunks_per_call):
+            call_lengths: torch.Tensor = lengths[start:start + max_chunks_per_call]
+            padded += int(call_lengths.max() * len(call_lengths) - call_lengths.sum())
+            real += int(call_lengths.sum())
+
+    return padded / real
+
+
+def main() -> None:
+    device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Device:", device)
+
+    X_train, _, y_train, _ = load_splits(CSV_DIR)
+    X_train, y_train = X_train.head(NUM_SONGS), y_train.head(NUM_SONGS)
+    expected_labels: Counter = Counter(y_train.tolist())
+
+    set_seed()
+    model: BertForLyrics = BertForLyrics(
+        config=BertForLyricsConfig(
+            model_name=MODEL_NAME,
+            num_labels=len(LABELS),
+            chunk_size=510,
+            stride=256,
+            token_cache_dir=TOKEN_CACHE_DIR,
+        ),
+        device=device,
+    ).to(device)
+    model.tokenize_texts(X_train.tolist())
+
+    optimizer: AdamW = AdamW(model.parameters(), lr=LR)
+    loss_fn: nn.Module = nn.CrossEntropyLoss()
+    rows: list[dict] = []
+
+    raw_loader: DataLoader = DataLoader(LyricsDataset(X_train, y_train), batch_size=BATCH_SIZE, shuffle=True)
+    start: float = time.perf_counter()
+    labels_seen: list[int] = raw_text_epoch(model, raw_loader, optimizer, loss_fn)
+    rows.append({
+        "loader": "shuffled raw text",
+        "epoch_time_s": time.perf_counter() - start,
+        "padding_ratio": float("nan"),
+        "same_labels_per_epoch": Counter(labels_seen) == expected_labels,
+    })
+    print(rows[-1])
+
+    for num_workers in sorted({0, NUM_WORKERS}):
+        bucketed_loader: DataLoader = build_train_loader(
+            model,
+            X_train,
+            y_train,
+            batch_size=BATCH_SIZE,
+            num_workers=num_workers,
+        )
+        bucketed_labels: list[int] = [
+            label
+            for batch in bucketed_loader
+            for label in batch["label"].tolist()
+        ]
+
+        start = time.perf_counter()
+        train_one_epoch(model, bucketed_loader, optimizer, loss_fn, device)
+        rows.append({
+            "loader": f"bucketed chunks, {num_workers} workers",
+            "epoch_time_s": time.perf_counter() - start,
+            "padding_ratio": padding_ratio(bucketed_loader, model.config.max_chunks_per_call),
+            "same_labels_per_epoch": Counter(bucketed_labels) == expected_labels,
+        })
+        print(rows[-1])
+
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.3f"))
+
+
+if __name__ == "__main__":
+    main()
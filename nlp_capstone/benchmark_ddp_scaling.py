@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import AdamW
+from torch.utils.data import DataLoader
+
+from bert_train import (
+    LABELS,
+    TOKEN_CACHE_DIR,
+    ChunkForward,
+    build_train_loader,
+    load_splits,
+    set_seed,
+    train_one_epoch,
+)
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.distributed import barrier, cleanup_distributed, init_distributed
+
+# strong scaling of the data parallel training of bert_train.py on one machine:
+# the same songs are trained for one epoch with 1, 2 and 4 processes, every process is started by torchrun
+MODEL_NAME: str = "xlm-roberta-base"
+CSV_DIR: Path = Path("song_labels/processed")
+RESULTS_DIR: Path = Path("cache/ddp_scaling")
+NUM_SONGS: int = 64
+BATCH_SIZE: int = 4  # per process
+NUM_PROCESSES: list[int] = [1, 2, 4]
+
+
+def worker() -> None:
+    """one torchrun process, the first process writes the epoch time"""
+    rank, world_size = init_distributed()
+    set_seed()
+    device: torch.device = torch.device("cpu")
+
+    X_train, _, y_train, _ = load_splits(CSV_DIR)
+    X_train, y_train = X_train.head(NUM_SONGS), y_train.head(NUM_SONGS)
+
+    model: BertForLyrics = BertForLyrics(
+        config=BertForLyricsConfig(
+            model_name=MODEL_NAME,
+            num_labels=len(LABELS),
+            chunk_size=510,
+            stride=256,
+            use_max_pooling=True,
+            token_cache_dir=TOKEN_CACHE_DIR,
+        ),
+        device=device,
+    ).to(device)
+    model.tokenize_texts(X_train.tolist())
+    train_loader: DataLoader = build_train_loader(model, X_train, y_train, batch_size=BATCH_SIZE, num_workers=0)
+
+    ddp_model: DistributedDataParallel | None = (
+        DistributedDataParallel(ChunkForward(model), find_unused_parameters=True)
+        if world_size > 1
+        else None
+    )
+    optimizer: AdamW = AdamW(model.parameters(), lr=2e-5)
+
+    barrier()
+    start: float = time.perf_counter()
+    train_one_epoch(
+        model=model,
+        dataloader=train_loader,
+        optimizer=optimizer,
+        loss_fn=nn.CrossEntropyLoss(),
+        device=device,
+        ddp_model=ddp_model,
+    )
+    barrier()
+    epoch_time: float = time.perf_counter() - start
+
+    if rank == 0:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        (RESULTS_DIR / f"processes_{world_size}.json").write_text(json.dumps({
+            "processes": world_size,
+            "threads_per_process": torch.get_num_threads(),
+            "epoch_time_s": epoch_time,
+        }))
+
+    cleanup_distributed()
+
+
+def main() -> None:
+    rows: list[dict] = []
+
+    for num_processes in NUM_PROCESSES:
+        subprocess.run(
+            [
+                sys.executable, "-m", "torch.distributed.run",
+                "--standalone",
+                f"--nproc_per_node={num_processes}",
+                __file__,
+            ],
+            check=True,
+        )
+        rows.append(json.loads((RESULTS_DIR / f"processes_{num_processes}.json").read_text()))
+        print(rows[-1])
+
+    report: pd.DataFrame = pd.DataFrame(rows)
+    report["songs_per_sec"] = NUM_SONGS / report["epoch_time_s"]
+    report["speedup"] = report["epoch_time_s"].iloc[0] / report["epoch_time_s"]
+    report["efficiency"] = report["speedup"] / (report["processes"] / report["processes"].iloc[0])
+    print(report.to_string(index=False, float_format="%.3f"))
+
+
+if __name__ == "__main__":
+    # torchrun sets RANK for every process it starts
+    if "RANK" in os.environ:
+        worker()
+    else:
+        main()
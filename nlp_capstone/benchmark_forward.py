@@ -0,0 +1,68 @@
+import time
+from pathlib import Path
+
+import torch
+from pandas import DataFrame
+
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.song_labels_dataset import read_song_labels
+
+# compares the per chunk forward pass (batch size 1 per chunk) with the batched chunk encoding
+MODEL_NAME: str = "xlm-roberta-base"
+CSV_DIR: Path = Path("song_labels/processed")
+NUM_SONGS: int = 200
+BATCH_SIZE: int = 8
+MAX_CHUNKS_PER_CALL: int = 32
+
+
+def load_lyrics(csv_dir: Path, n: int) -> list[str]:
+    df: DataFrame = read_song_labels(csv_dir, columns=["lyrics", "lyrics_available", "is_duplicate"])
+    df = df[df["lyrics_available"] & ~df["is_duplicate"]]
+    return df["lyrics"].astype(str).head(n).tolist()
+
+
+@torch.no_grad()
+def run(model: BertForLyrics, lyrics: list[str], batch_size: int) -> tuple[torch.Tensor, float]:
+    embeddings: list[torch.Tensor] = []
+
+    start: float = time.perf_counter()
+    for i in range(0, len(lyrics), batch_size):
+        _, emb = model(lyrics[i:i + batch_size])
+        embeddings.append(emb.cpu())
+    elapsed: float = time.perf_counter() - start
+
+    return torch.cat(embeddings), len(lyrics) / elapsed
+
+
+def main() -> None:
+    device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Device:", device)
+
+    lyrics: list[str] = load_lyrics(CSV_DIR, NUM_SONGS)
+    print(f"Loaded {len(lyrics)} lyrics")
+
+    model_config: BertForLyricsConfig = BertForLyricsConfig(
+        model_name=MODEL_NAME,
+        num_labels=7,
+        chunk_size=510,
+        stride=256,
+        use_batched_forward=False,
+        max_chunks_per_call=MAX_CHUNKS_PER_CALL,
+    )
+    model: BertForLyrics = BertForLyrics(config=model_config, device=device).to(device)
+    model.eval()
+
+    per_chunk_embeddings, per_chunk_songs_per_sec = run(model, lyrics, BATCH_SIZE)
+    print(f"per chunk: {per_chunk_songs_per_sec:.2f} songs/sec")
+
+    model.config.use_batched_forward = True
+    batched_embeddings, batched_songs_per_sec = run(model, lyrics, BATCH_SIZE)
+    print(f"batched:   {batched_songs_per_sec:.2f} songs/sec (max {MAX_CHUNKS_PER_CALL} chunks per call)")
+
+    max_diff: float = (per_chunk_embeddings - batched_embeddings).abs().max().item()
+    print(f"speedup: {batched_songs_per_sec / per_chunk_songs_per_sec:.2f}x")
+    print(f"max abs difference of the song embeddings: {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
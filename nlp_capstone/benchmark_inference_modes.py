@@ -0,0 +1,79 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from pandas import DataFrame
+from sklearn.metrics import accuracy_score, f1_score
+
+from bert_train import LABELS, load_splits
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig, InferenceMode
+
+# accuracy/latency comparison of the inference modes on the validation split of bert_train.py
+MODEL_PATH: Path = Path("models/xlm-roberta-base_1")
+CSV_DIR: Path = Path("song_labels/processed")
+REPORT_PATH: Path = MODEL_PATH / "inference_modes.csv"
+BATCH_SIZE: int = 8
+MODES: list[InferenceMode] = ["fp32", "bf16", "int8"]
+
+
+def main() -> None:
+    device: torch.device = torch.device("cpu")
+    print("Device:", device, "| threads:", torch.get_num_threads())
+
+    _, X_val, _, y_val = load_splits(CSV_DIR)
+    texts: list[str] = X_val.tolist()
+    y_true: np.ndarray = y_val.to_numpy().astype(int)
+
+    model_config: BertForLyricsConfig = BertForLyricsConfig(
+        model_name="xlm-roberta-base",
+        num_labels=len(LABELS),
+        chunk_size=510,
+        stride=256,
+    )
+
+    rows: list[dict] = []
+    reference_probs: np.ndarray | None = None
+
+    for mode in MODES:
+        model: BertForLyrics = BertForLyrics.load_model(
+            path=MODEL_PATH,
+            config=model_config,
+            device=device,
+            inference_mode=mode,
+        )
+        model.eval()
+
+        # warm up, the first call includes one time costs like the token cache
+        model.predict_batch(texts[:BATCH_SIZE], batch_size=BATCH_SIZE)
+
+        start: float = time.perf_counter()
+        logits, _ = model.predict_batch(texts, batch_size=BATCH_SIZE)
+        elapsed: float = time.perf_counter() - start
+
+        probs: np.ndarray = torch.softmax(logits, dim=1).cpu().numpy()
+        y_pred: np.ndarray = probs.argmax(axis=1)
+        if reference_probs is None:
+            reference_probs = probs
+
+        rows.append({
+            "mode": mode,
+            "accuracy": accuracy_score(y_true, y_pred),
+            "macro_f1": f1_score(y_true, y_pred, average="macro"),
+            "agreement_with_fp32": (y_pred == reference_probs.argmax(axis=1)).mean(),
+            "max_prob_diff_to_fp32": np.abs(probs - reference_probs).max(),
+            "songs_per_sec": len(texts) / elapsed,
+            "ms_per_song": elapsed / len(texts) * 1000,
+        })
+        print(rows[-1])
+
+    report: DataFrame = pd.DataFrame(rows)
+    print(report.to_string(index=False, float_format="%.4f"))
+
+    report.to_csv(REPORT_PATH, index=False)
+    print(f"Report saved to {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from utils.genius_stub_server import GeniusStubServer
+from utils.lyrics_cache import LyricsCache
+from utils.lyrics_fetcher import HttpLyricsSource, LyricsFetcher
+
+# songs/sec of the lyrics crawl against the local genius stub (latency, 429 with Retry-After, 503s)
+# sequential like the old loop vs. the thread pool, and a second run that is answered by the sqlite cache
+NUM_SONGS: int = 100
+SERVER_RATE_PER_SEC: float = 20.0
+LATENCY_S: float = 0.1
+ERROR_RATE: float = 0.05
+
+# name, threads, client requests/sec (above the server rate --> 429s), cold or warm cache
+MODES: list[tuple[str, int, float, bool]] = [
+    ("sequential", 1, 100.0, False),
+    ("8 threads", 8, 18.0, False),
+    ("8 threads, too fast", 8, 100.0, False),
+    ("8 threads, warm cache", 8, 18.0, True),
+]
+
+
+def songs(n: int) -> list[tuple[str, str]]:
+    # every 10th song is a duplicate, like the same track in several MuSe rows
+    return [(f"artist {i % 37}", f"track {i - i % 10 if i % 10 == 9 else i}") for i in range(n)]
+
+
+def main() -> None:
+    rows: list[dict] = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, workers, requests_per_sec, warm in MODES:
+            cache_path: Path = Path(tmp_dir) / ("warm.sqlite" if warm else f"{name}.sqlite")
+            if warm:
+                # fill the cache with a first crawl
+                with GeniusStubServer(rate_per_sec=1000, burst=1000, latency_s=0) as stub:
+                    fetcher = LyricsFetcher(HttpLyricsSource(stub.url), LyricsCache(cache_path), max_workers=workers, requests_per_sec=1000, burst=1000)
+                    for _ in fetcher.fetch(songs(NUM_SONGS)):
+                        pass
+
+            with GeniusStubServer(rate_per_sec=SERVER_RATE_PER_SEC, burst=5, latency_s=LATENCY_S, error_rate=ERROR_RATE) as stub:
+                fetcher: LyricsFetcher = LyricsFetcher(
+                    source=HttpLyricsSource(stub.url),
+                    cache=LyricsCache(cache_path),
+                    max_workers=workers,
+                    requests_per_sec=requests_per_sec,
+                    burst=workers,
+                    base_delay=0.2,
+                )
+
+                start: float = time.perf_counter()
+                results = list(fetcher.fetch(songs(NUM_SONGS)))
+                elapsed: float = time.perf_counter() - start
+
+                rows.append({
+                    "mode": name,
+                    "songs_per_sec": NUM_SONGS / elapsed,
+                    "found": sum(r.lyrics is not None for r in results),
+                    "failed": sum(r.error is not None for r in results),
+                    "from_cache": sum(r.from_cache for r in results),
+                    **stub.stats,
+                })
+                print(rows[-1])
+
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.2f"))
+
+
+if __name__ == "__main__":
+    main()
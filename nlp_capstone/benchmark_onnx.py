@@ -0,0 +1,71 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from benchmark_forward import load_lyrics
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.onnx_lyrics_model import OnnxLyricsModel
+
+# parity check and throughput of the onnx runtime backend against the torch backend, run export_onnx.py first
+MODEL_PATH: Path = Path("models/xlm-roberta-base_1")
+CSV_DIR: Path = Path("song_labels/processed")
+NUM_SONGS: int = 100
+BATCH_SIZE: int = 8
+MAX_ABS_DIFF: float = 1e-3
+
+
+def main() -> None:
+    lyrics: list[str] = load_lyrics(CSV_DIR, NUM_SONGS)
+    print(f"Loaded {len(lyrics)} lyrics | threads: {torch.get_num_threads()}")
+
+    model_config: BertForLyricsConfig = BertForLyricsConfig(
+        model_name="xlm-roberta-base",
+        num_labels=7,
+        chunk_size=510,
+        stride=256,
+    )
+
+    torch_model: BertForLyrics = BertForLyrics.load_model(
+        path=MODEL_PATH,
+        config=model_config,
+        device=torch.device("cpu"),
+    )
+    torch_model.eval()
+
+    onnx_model: OnnxLyricsModel = OnnxLyricsModel(
+        model_dir=MODEL_PATH,
+        chunk_size=model_config.chunk_size,
+        stride=model_config.stride,
+        use_max_pooling=model_config.use_max_pooling,
+        max_chunks_per_call=model_config.max_chunks_per_call,
+    )
+
+    # tokenization is identical for both backends, it is done once up front so only inference is timed
+    torch_model.tokenize_texts(lyrics)
+    onnx_model.tokenize_texts(lyrics)
+
+    start: float = time.perf_counter()
+    torch_logits, torch_embeddings = torch_model.predict_batch(lyrics, batch_size=BATCH_SIZE)
+    torch_songs_per_sec: float = len(lyrics) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    onnx_logits, onnx_embeddings = onnx_model.predict_batch(lyrics, batch_size=BATCH_SIZE)
+    onnx_songs_per_sec: float = len(lyrics) / (time.perf_counter() - start)
+
+    embedding_diff: float = np.abs(torch_embeddings.numpy() - onnx_embeddings).max()
+    logit_diff: float = np.abs(torch_logits.numpy() - onnx_logits).max()
+    agreement: float = (torch_logits.numpy().argmax(axis=1) == onnx_logits.argmax(axis=1)).mean()
+
+    print(f"torch: {torch_songs_per_sec:.2f} songs/sec")
+    print(f"onnx:  {onnx_songs_per_sec:.2f} songs/sec ({onnx_songs_per_sec / torch_songs_per_sec:.2f}x)")
+    print(f"max abs diff embeddings: {embedding_diff:.2e} | logits: {logit_diff:.2e} | label agreement: {agreement:.3f}")
+
+    if embedding_diff > MAX_ABS_DIFF or logit_diff > MAX_ABS_DIFF:
+        raise SystemExit(f"Parity check failed, difference above {MAX_ABS_DIFF}")
+    print("Parity check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+
+from backend.app.services.core.SongIndex import ExactIndex, IVFIndex
+
+# compares the exact and the approximate (IVF) song index on synthetic clustered 768-d embeddings
+NUM_SONGS: int = 100_000
+HIDDEN_SIZE: int = 768
+NUM_CLUSTERS: int = 500
+NUM_QUERIES: int = 500
+K: int = 10
+
+
+def make_embeddings(rng: np.random.Generator) -> np.ndarray:
+    # song embeddings are not uniform noise, they form groups of similar songs
+    centers: np.ndarray = rng.normal(size=(NUM_CLUSTERS, HIDDEN_SIZE)).astype(np.float32)
+    assignments: np.ndarray = rng.integers(0, NUM_CLUSTERS, size=NUM_SONGS)
+    noise: np.ndarray = rng.normal(scale=0.6, size=(NUM_SONGS, HIDDEN_SIZE)).astype(np.float32)
+    return centers[assignments] + noise
+
+
+def run(index: ExactIndex | IVFIndex, queries: np.ndarray) -> tuple[list[np.ndarray], np.ndarray]:
+    results: list[np.ndarray] = []
+    latencies: list[float] = []
+
+    for query in queries:
+        start: float = time.perf_counter()
+        indices, _ = index.search(query, K)
+        latencies.append(time.perf_counter() - start)
+        results.append(indices)
+
+    return results, np.array(latencies) * 1000
+
+
+def main() -> None:
+    rng: np.random.Generator = np.random.default_rng(42)
+    embeddings: np.ndarray = make_embeddings(rng)
+    queries: np.ndarray = embeddings[rng.choice(NUM_SONGS, size=NUM_QUERIES, replace=False)]
+
+    start: float = time.perf_counter()
+    exact: ExactIndex = ExactIndex(embeddings)
+    print(f"exact index built in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    ivf: IVFIndex = IVFIndex(embeddings)
+    print(f"ivf index built in {time.perf_counter() - start:.1f}s ({ivf.n_lists} lists, n_probe {ivf.n_probe})")
+
+    exact_results, exact_latencies = run(exact, queries)
+    ivf_results, ivf_latencies = run(ivf, queries)
+
+    recall: float = np.mean([
+        len(set(a.tolist()) & set(b.tolist())) / K
+        for a, b in zip(exact_results, ivf_results)
+    ])
+
+    for name, latencies in [("exact", exact_latencies), ("ivf", ivf_latencies)]:
+        print(
+            f"{name:5s} | mean {latencies.mean():.2f} ms | "
+            f"p50 {np.percentile(latencies, 50):.2f} ms | p99 {np.percentile(latencies, 99):.2f} ms"
+        )
+    print(f"ivf recall@{K}: {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
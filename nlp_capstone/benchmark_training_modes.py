@@ -0,0 +1,117 @@
+import multiprocessing as mp
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.optim import AdamW
+from torch.utils.data import DataLoader
+
+from bert_train import (
+    LABELS,
+    TOKEN_CACHE_DIR,
+    build_train_loader,
+    load_splits,
+    peak_memory_mb,
+    set_seed,
+    train_one_epoch,
+)
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+
+# loss curve, step time and peak memory of the training modes of bert_train.py
+# every mode runs in its own process, so the peak memory of one mode does not hide the others
+MODEL_NAME: str = "xlm-roberta-base"
+CSV_DIR: Path = Path("song_labels/processed")
+NUM_SONGS: int = 64
+EPOCHS: int = 3
+LR: float = 2e-5
+
+# the same effective batch size of 8 for every mode, so the loss curves are comparable
+MODES: list[dict] = [
+    {"name": "fp32", "precision": "fp32", "batch_size": 8, "grad_accum_steps": 1, "gradient_checkpointing": False},
+    {"name": "bf16", "precision": "bf16", "batch_size": 8, "grad_accum_steps": 1, "gradient_checkpointing": False},
+    {"name": "fp32 + accum 4x2", "precision": "fp32", "batch_size": 2, "grad_accum_steps": 4, "gradient_checkpointing": False},
+    {"name": "fp32 + checkpointing", "precision": "fp32", "batch_size": 8, "grad_accum_steps": 1, "gradient_checkpointing": True},
+    {"name": "bf16 + checkpointing + accum 4x2", "precision": "bf16", "batch_size": 2, "grad_accum_steps": 4, "gradient_checkpointing": True},
+]
+
+
+def run_mode(mode: dict) -> dict:
+    set_seed()
+    device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    X_train, _, y_train, _ = load_splits(CSV_DIR)
+    X_train, y_train = X_train.head(NUM_SONGS), y_train.head(NUM_SONGS)
+
+    model: BertForLyrics = BertForLyrics(
+        config=BertForLyricsConfig(
+            model_name=MODEL_NAME,
+            num_labels=len(LABELS),
+            chunk_size=510,
+            stride=256,
+            token_cache_dir=TOKEN_CACHE_DIR,
+        ),
+        device=device,
+    ).to(device)
+
+    if mode["gradient_checkpointing"]:
+        model.bert.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    model.tokenize_texts(X_train.tolist())
+    train_loader: DataLoader = build_train_loader(model, X_train, y_train, batch_size=mode["batch_size"])
+    optimizer: AdamW = AdamW(model.parameters(), lr=LR)
+    loss_fn: nn.Module = nn.CrossEntropyLoss()
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    losses: list[float] = []
+    step_times: list[float] = []
+    for _ in range(EPOCHS):
+        loss, _, step_time = train_one_epoch(
+            model=model,
+            dataloader=train_loader,
+            optimizer=optimizer,
+            loss_fn=loss_fn,
+            device=device,
+            precision=mode["precision"],
+            grad_accum_steps=mode["grad_accum_steps"],
+        )
+        losses.append(loss)
+        step_times.append(step_time)
+
+    return {
+        "mode": mode["name"],
+        "losses": losses,
+        "step_time_s": float(np.mean(step_times)),
+        "peak_memory_mb": peak_memory_mb(device),
+    }
+
+
+def main() -> None:
+    ctx = mp.get_context("spawn")
+    results: list[dict] = []
+
+    for mode in MODES:
+        with ctx.Pool(1) as pool:
+            result: dict = pool.apply(run_mode, (mode,))
+        print(result)
+        results.append(result)
+
+    baseline: np.ndarray = np.array(results[0]["losses"])
+    report: pd.DataFrame = pd.DataFrame([
+        {
+            "mode": result["mode"],
+            "final_loss": result["losses"][-1],
+            "max_loss_diff_to_fp32": float(np.abs(np.array(result["losses"]) - baseline).max()),
+            "step_time_s": result["step_time_s"],
+            "peak_memory_mb": result["peak_memory_mb"],
+        }
+        for result in results
+    ])
+    print(report.to_string(index=False, float_format="%.4f"))
+
+
+if __name__ == "__main__":
+    main()
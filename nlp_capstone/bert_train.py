@@ -1,33 +1,59 @@
-import pickle
+import time
+from collections.abc import Callable
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
+from typing import Literal
 
 import numpy as np
-import pandas as pd
 import torch
 import random
 import matplotlib.pyplot as plt
-from pandas import DataFrame
+from pandas import DataFrame, Series
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 from torch.nn.modules.loss import _Loss
 
 from torch.utils.data import DataLoader
 import torch.nn as nn
 from torch.optim import AdamW, Optimizer
+from torch.nn.parallel import DistributedDataParallel
 
 from sklearn.model_selection import train_test_split
 from sklearn.utils.class_weight import compute_class_weight
 from sklearn.manifold import TSNE
 
 from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
-from utils.lyrics_dataset import LyricsDataset
+from utils.bucket_sampler import BucketBatchSampler
+from utils.checkpoint_manager import CheckpointManager, restore_training_state, training_state
+from utils.chunk_feature_cache import ChunkFeatureCache, feature_cache_fingerprint
+from utils.distributed import all_reduce_sum, cleanup_distributed, init_distributed, rank_and_world_size
+from utils.head_training import HeadTrainingConfig, train_head
+from utils.lyrics_dataset import LyricsDataset, TokenizedLyricsDataset, collate_chunks
+from utils.metrics_log import METRICS_LOG_FILE, MetricsLog, peak_memory_mb
+from utils.song_labels_dataset import read_song_labels
+
+type Precision = Literal["fp32", "bf16"]
 
 # Config
-# xlm-roberta-base, distilbert-base-multilingual-cased, bert-base-multilingual-cased, xlm-roberta-large (too large to train)
+# xlm-roberta-base, distilbert-base-multilingual-cased, bert-base-multilingual-cased, xlm-roberta-large (only with GRADIENT_CHECKPOINTING and bf16)
 MODEL_NAME: str = "xlm-roberta-base"
 MAX_LEN: int = 256
 BATCH_SIZE: int = 8 # 4 --> unstable training, when the batch size is too small and the learning rate too large, then one batch has a huge influence on the training and can lead to unstable training
 EPOCHS: int = 12
 LR: float = 2e-5
+TOKEN_CACHE_DIR: Path = Path("cache/tokens")
+PRECISION: Precision = "fp32" # bf16 --> autocast of the forward pass, the weights and the optimizer stay in fp32
+GRAD_ACCUM_STEPS: int = 1 # effective batch size = BATCH_SIZE * GRAD_ACCUM_STEPS
+GRADIENT_CHECKPOINTING: bool = False # recompute the encoder activations in the backward pass, needed for xlm-roberta-large
+NUM_WORKERS: int = 2 # DataLoader workers for the tokenization and chunking, 0 --> in the training process
+BUCKET_SIZE_MULTIPLIER: int = 20 # songs are sorted by their number of chunks within pools of BATCH_SIZE * BUCKET_SIZE_MULTIPLIER songs
+FREEZE_ENCODER: bool = False # feature extraction mode: the encoder runs once per chunk, only the classifier is trained on the cached features
+FEATURE_CACHE_DIR: Path = Path("cache/chunk_features")
+HEAD_LR: float = 1e-3
+HEAD_EPOCHS: int = 100
+CHECKPOINT_EVERY_STEPS: int = 100 # optimizer steps between two checkpoints, written in a background thread
+KEEP_TOP_K_CHECKPOINTS: int = 3 # checkpoints with the lowest validation loss, the latest one is always kept for the resume
+RESUME: bool = True # continue from the latest checkpoint in save_model_path / "checkpoints"
 
 LABELS: list[str] = [
     "selfdetermination",
@@ -59,63 +85,253 @@ def set_seed(seed: int = 42) -> None:
     torch.backends.cudnn.benchmark = False
 
 def evaluate(
-    model: nn.Module,
-    dataloader: DataLoader,
+    model: BertForLyrics,
+    dataset: LyricsDataset,
     loss_fn: nn.Module,
     device: torch.device
 ) -> tuple[float, float]:
+    """with torchrun every process evaluates every world_size-th song and the sums are synchronized"""
     model.eval()
+    rank, world_size = rank_and_world_size()
+
+    texts: list[str] = dataset.texts[rank::world_size]
+    sums: list[float] = [0.0, 0.0, 0.0, 0.0]
+
+    # with fewer songs than processes a shard is empty, it only contributes zeros to the sums
+    if texts:
+        logits, _ = model.predict_batch(texts, batch_size=BATCH_SIZE)
+        labels: torch.Tensor = torch.tensor(dataset.labels[rank::world_size], dtype=torch.long).to(device)
+
+        loss: torch.Tensor = loss_fn(logits, labels)
+
+        # the weighted cross entropy is sum(w * l) / sum(w), so the sums are synchronized and not the means
+        weight_sum: float = (
+            loss_fn.weight[labels].sum().item()
+            if getattr(loss_fn, "weight", None) is not None
+            else len(labels)
+        )
+        sums = [
+            loss.item() * weight_sum,
+            weight_sum,
+            (torch.argmax(logits, dim=1) == labels).sum().item(),
+            len(labels),
+        ]
+
+    loss_sum, weight_sum, correct, count = all_reduce_sum(sums)
+
+    return loss_sum / weight_sum, correct / count
+
+class ChunkForward(nn.Module):
+    """DistributedDataParallel only synchronizes through forward(), so the chunk forward gets its own module"""
+
+    def __init__(self, model: BertForLyrics):
+        super().__init__()
+        self.model: BertForLyrics = model
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        text_index: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        return self.model.forward_chunks(input_ids, attention_mask, text_index)
+
+def train_one_epoch(
+    model: BertForLyrics,
+    dataloader: DataLoader,
+    optimizer: Optimizer,
+    loss_fn: nn.Module,
+    device: torch.device,
+    precision: Precision = "fp32",
+    grad_accum_steps: int = 1,
+    on_step: Callable[[int, dict[str, float]], None] | None = None,
+    ddp_model: DistributedDataParallel | None = None,
+) -> tuple[float, float, float]:
+    """
+    on_step is called after every optimizer step with the number of batches of this call so far (e.g. for checkpoints)
+    and the metrics of the step (loss, acc, step_time_s, songs_per_sec, tokens_per_sec) of this process
+    ddp_model: DistributedDataParallel(ChunkForward(model)), its forward synchronizes the gradients between the processes
+
+    Returns:
+    - mean train loss
+    - mean train accuracy
+    - mean seconds per optimizer step
+    """
+    model.train()
     total_loss: float = 0.0
     total_acc: float = 0.0
+    optimizer.zero_grad()
+
+    forward: Callable[..., tuple[torch.Tensor, torch.Tensor]] = model.forward_chunks if ddp_model is None else ddp_model
+
+    start: float = time.perf_counter()
+    num_steps: int = 0
+    # batches of this epoch (without the skipped batches of a resume), read once before the sampler starts
+    num_batches: int = len(dataloader)
+
+    # batches since the last optimizer step
+    step_start: float = start
+    step_loss: float = 0.0
+    step_correct: int = 0
+    step_songs: int = 0
+    step_tokens: int = 0
+    step_batches: int = 0
+
+    for i, batch in enumerate(dataloader):
+        is_step: bool = (i + 1) % grad_accum_steps == 0 or (i + 1) == num_batches
+
+        autocast = (
+            torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+            if precision == "bf16"
+            else nullcontext()
+        )
+        # the gradients are only synchronized in the backward pass of the last batch before an optimizer step
+        no_sync = ddp_model.no_sync() if ddp_model is not None and not is_step else nullcontext()
+
+        with no_sync:
+            with autocast:
+                logits, _ = forward(
+                    input_ids=batch["input_ids"],
+                    attention_mask=batch["attention_mask"],
+                    text_index=batch["text_index"],
+                )
+                labels: torch.Tensor = batch["label"].to(device)
+                loss: torch.Tensor = loss_fn(logits.float(), labels)
+
+            # the gradients of grad_accum_steps batches are summed up before one optimizer step
+            (loss / grad_accum_steps).backward()
+
+        batch_loss: float = loss.item()
+        batch_correct: int = (torch.argmax(logits, dim=1) == labels).sum().item()
+        total_loss += batch_loss
+        total_acc += batch_correct / len(labels)
+
+        step_loss += batch_loss
+        step_correct += batch_correct
+        step_songs += len(labels)
+        step_tokens += int(batch["attention_mask"].sum().item())
+        step_batches += 1
+
+        if is_step:
+            optimizer.step()
+            optimizer.zero_grad()
+            num_steps += 1
 
-    with torch.no_grad():
-        for batch in dataloader:
-            logits, _ = model(batch["text"])
-            labels: torch.Tensor = batch["label"].to(device)
+            if on_step is not None:
+                step_end: float = time.perf_counter()
+                step_seconds: float = step_end - step_start
+                on_step(i + 1, {
+                    "loss": step_loss / step_batches,
+                    "acc": step_correct / step_songs,
+                    "step_time_s": step_seconds,
+                    "songs_per_sec": step_songs / step_seconds,
+                    "tokens_per_sec": step_tokens / step_seconds,
+                })
+                step_start = step_end
 
-            loss: torch.Tensor = loss_fn(logits, labels)
+            step_loss, step_correct, step_songs, step_tokens, step_batches = 0.0, 0, 0, 0, 0
 
-            total_loss += loss.item()
-            total_acc += accuracy(logits, labels)
+    step_time: float = (time.perf_counter() - start) / max(num_steps, 1)
 
     return (
-        total_loss / len(dataloader),
-        total_acc / len(dataloader)
+        total_loss / max(num_batches, 1),
+        total_acc / max(num_batches, 1),
+        step_time,
     )
 
-# Main
-def main() -> None:
-    use_dapt_model: bool = False
-    use_separate_learning_rate_for_bert_and_cl: bool = False
-    dapt_model_path: Path = Path(f"models/dapt_10_epoch")
-    save_model_path: Path = Path(f"models/xlm-roberta-base_new_2")
+def build_train_loader(
+    model: BertForLyrics,
+    X_train: Series,
+    y_train: Series,
+    batch_size: int,
+    num_workers: int = NUM_WORKERS,
+) -> DataLoader:
+    """
+    DataLoader of padded chunk batches for train_one_epoch:
+    - songs with a similar number of chunks share a batch, the batch order stays random every epoch
+    - the workers tokenize (or read the token cache) and pad, pinned memory makes the copy to the gpu asynchronous
+    - with torchrun every process gets its own share of the batches
+    """
+    rank, world_size = rank_and_world_size()
+    train_ds: TokenizedLyricsDataset = TokenizedLyricsDataset(
+        X_train,
+        y_train,
+        tokenizer=model.tokenizer,
+        chunk_size=model.config.chunk_size,
+        stride=model.config.stride,
+        token_cache_dir=model.config.token_cache_dir,
+    )
 
-    print("Device:", device)
-    csv_dir: Path = Path("song_labels/processed")
+    return DataLoader(
+        train_ds,
+        batch_sampler=BucketBatchSampler(
+            train_ds.num_chunks(),
+            batch_size=batch_size,
+            bucket_size_multiplier=BUCKET_SIZE_MULTIPLIER,
+            num_replicas=world_size,
+            rank=rank,
+        ),
+        collate_fn=partial(collate_chunks, pad_token_id=model.tokenizer.pad_token_id),
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0,
+        # own generator for the worker seeds, so creating the iterator does not advance the global rng (exact resume)
+        generator=torch.Generator().manual_seed(42),
+    )
 
-    csv_files: list[Path] = list(csv_dir.glob("*.csv"))
-    if not csv_files:
-        raise RuntimeError(f"No CSV files found in {csv_dir}")
+def train_frozen_head(
+    model: BertForLyrics,
+    model_source: str | Path,
+    train_ds: LyricsDataset,
+    val_ds: LyricsDataset,
+) -> dict[str, dict[str, list[float]]]:
+    """
+    feature extraction mode: the chunk [CLS] vectors of the frozen encoder are cached once on disk,
+    afterwards every epoch only pools the cached features and trains the classifier of the model
+    """
+    model.eval()
+    cache: ChunkFeatureCache = ChunkFeatureCache(FEATURE_CACHE_DIR, feature_cache_fingerprint(model_source, model))
+    cache.build(model, train_ds.texts + val_ds.texts, batch_size=BATCH_SIZE)
+
+    use_max_pooling: bool = model.config.use_max_pooling
+    classifier, metrics = train_head(
+        x_train=cache.pooled(train_ds.texts, use_max_pooling),
+        y_train=torch.tensor(train_ds.labels, dtype=torch.long),
+        x_val=cache.pooled(val_ds.texts, use_max_pooling),
+        y_val=torch.tensor(val_ds.labels, dtype=torch.long),
+        num_labels=model.config.num_labels,
+        config=HeadTrainingConfig(lr=HEAD_LR, epochs=HEAD_EPOCHS, batch_size=BATCH_SIZE),
+    )
+    model.classifier.load_state_dict(classifier.state_dict())
+
+    for epoch in range(HEAD_EPOCHS):
+        print(
+            f"Epoch {epoch+1:03d} | "
+            f"Train Loss: {metrics['train']['loss'][epoch]:.4f} | "
+            f"Train Acc: {metrics['train']['acc'][epoch]:.4f} | "
+            f"Val Loss: {metrics['val']['loss'][epoch]:.4f} | "
+            f"Val Acc: {metrics['val']['acc'][epoch]:.4f}"
+        )
 
-    dfs: list[DataFrame] = [
-        pd.read_csv(csv_file)
-        for csv_file in csv_files
-    ]
+    return metrics
 
-    df: DataFrame = pd.concat(dfs, ignore_index=True)
+def load_splits(csv_dir: Path) -> tuple[Series, Series, Series, Series]:
+    """labeled lyrics from the annotator csv files, split into X_train, X_val, y_train, y_val"""
+    # compiled dataset of the csv files, only the columns that are needed are read
+    df: DataFrame = read_song_labels(
+        csv_dir,
+        columns=["lyrics", "Classname", "lyrics_available", "lyrics_length", "is_duplicate"],
+    )
 
     df: DataFrame = df[
-        (df["lyrics_available"] == True) &
-        (df["lyrics_length"] > 500)
-    ][["lyrics", "Classname"]]
-
-    # drop duplicates
-    df = df.drop_duplicates(subset=["lyrics"]).reset_index(drop=True)
+        df["lyrics_available"] &
+        (df["lyrics_length"] > 500) &
+        ~df["is_duplicate"]
+    ][["lyrics", "Classname"]].reset_index(drop=True)
 
     print(len(df))
 
     label2id: dict[str, int] = {l: i for i, l in enumerate(LABELS)}
-    id2label: dict[int, str] = {i: l for l, i in label2id.items()}
     df["label"] = df["Classname"].map(label2id)
     df = df.dropna()
 
@@ -126,19 +342,33 @@ def main() -> None:
         stratify=df["label"],
         random_state=42
     )
+    return X_train, X_val, y_train, y_val
+
+# Main
+def main() -> None:
+    use_dapt_model: bool = False
+    use_separate_learning_rate_for_bert_and_cl: bool = False
+    dapt_model_path: Path = Path(f"models/dapt_10_epoch")
+    save_model_path: Path = Path(f"models/xlm-roberta-base_new_2")
+
+    # torchrun --nproc_per_node=N bert_train.py --> data parallel training with N processes (gloo)
+    rank, world_size = init_distributed()
+    is_main: bool = rank == 0
+
+    print("Device:", device, f"| Process {rank + 1}/{world_size}")
+
+    X_train, X_val, y_train, y_val = load_splits(Path("song_labels/processed"))
 
     train_ds: LyricsDataset = LyricsDataset(X_train, y_train)
     val_ds: LyricsDataset = LyricsDataset(X_val, y_val)
 
-    train_loader: DataLoader = DataLoader(train_ds, batch_size=BATCH_SIZE, shuffle=True)
-    val_loader: DataLoader = DataLoader(val_ds, batch_size=BATCH_SIZE, shuffle=False)
-
     model_config: BertForLyricsConfig = BertForLyricsConfig(
         model_name=MODEL_NAME,
         num_labels=len(LABELS),
         chunk_size=510,
         stride=256,
-        use_max_pooling=True
+        use_max_pooling=True,
+        token_cache_dir=TOKEN_CACHE_DIR,
     )
 
     model: BertForLyrics
@@ -155,6 +385,20 @@ def main() -> None:
             device=device,
         ).to(device)
 
+    if GRADIENT_CHECKPOINTING:
+        model.bert.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    # tokenize all lyrics once, every epoch afterwards only reads the token cache
+    model.tokenize_texts(train_ds.texts + val_ds.texts)
+    train_loader: DataLoader = build_train_loader(model, X_train, y_train, batch_size=BATCH_SIZE)
+
+    # the pooler of the encoder is not part of the loss, so it has no gradients
+    ddp_model: DistributedDataParallel | None = (
+        DistributedDataParallel(ChunkForward(model), find_unused_parameters=True)
+        if world_size > 1
+        else None
+    )
+
     optimizer: Optimizer | AdamW
     if use_separate_learning_rate_for_bert_and_cl:
         # when the training is too unstable then a smaller learning rate for the encoder is relevant
@@ -188,202 +432,262 @@ def main() -> None:
         }
     }
 
-    # Training
-    # todo: only save the best model depending on the best validation loss
-    for epoch in range(EPOCHS):
-        model.train()
-        total_loss: float = 0.0
-        total_acc: float = 0.0
-
-        for batch in train_loader:
-            optimizer.zero_grad()
-
-            logits, _ = model(batch["text"])
-            labels: torch.Tensor = batch["label"].to(device)
-
-            loss: torch.Tensor = loss_fn(logits, labels)
-            loss.backward()
-            optimizer.step()
-
-            total_loss += loss.item()
-            total_acc += accuracy(logits, labels)
+    # per step and per epoch metrics, appended while the run is going (python plot_metrics.py follows the file)
+    metrics_log: MetricsLog | None = MetricsLog(save_model_path / METRICS_LOG_FILE) if is_main else None
 
-        train_loss: float = total_loss / len(train_loader)
-        train_acc: float = total_acc / len(train_loader)
-
-        val_loss, val_acc = evaluate(
-            model=model,
-            dataloader=val_loader,
-            loss_fn=loss_fn,
-            device=device
-        )
-
-        metrics["train"]["loss"].append(train_loss)
-        metrics["train"]["acc"].append(train_acc)
-        metrics["val"]["loss"].append(val_loss)
-        metrics["val"]["acc"].append(val_acc)
-
-        print(
-            f"Epoch {epoch+1:02d} | "
-            f"Train Loss: {train_loss:.4f} | "
-            f"Train Acc: {train_acc:.4f} | "
-            f"Val Loss: {val_loss:.4f} | "
-            f"Val Acc: {val_acc:.4f}"
+    # Training
+    if FREEZE_ENCODER:
+        model_source: str | Path = dapt_model_path if use_dapt_model else MODEL_NAME
+        metrics = train_frozen_head(model, model_source, train_ds, val_ds)
+
+        if metrics_log is not None:
+            for epoch in range(len(metrics["train"]["loss"])):
+                metrics_log.log(
+                    "epoch",
+                    epoch=epoch + 1,
+                    step=epoch + 1,
+                    train_loss=metrics["train"]["loss"][epoch],
+                    train_acc=metrics["train"]["acc"][epoch],
+                    val_loss=metrics["val"]["loss"][epoch],
+                    val_acc=metrics["val"]["acc"][epoch],
+                )
+    else:
+        checkpoints: CheckpointManager = CheckpointManager(
+            save_model_path / "checkpoints",
+            save_every=CHECKPOINT_EVERY_STEPS,
+            keep_top_k=KEEP_TOP_K_CHECKPOINTS,
+            # only the main process clears the checkpoints of an earlier run
+            resume=RESUME or not is_main,
         )
-
+        start_epoch: int = 0
+        start_batch: int = 0
+        global_step: int = 0
+
+        state: dict | None = checkpoints.load_latest() if RESUME else None
+        if state is not None:
+            progress: dict = restore_training_state(state, model, optimizer)
+            start_epoch, start_batch, global_step = progress["epoch"], progress["batches_done"], progress["global_step"]
+            metrics = progress["metrics"]
+            print(f"Resumed from step {global_step} (epoch {start_epoch + 1}, batch {start_batch})")
+
+        if is_main:
+            print(
+                f"Precision: {PRECISION} | "
+                f"Effective batch size: {BATCH_SIZE * GRAD_ACCUM_STEPS * world_size} "
+                f"({BATCH_SIZE} x {GRAD_ACCUM_STEPS} x {world_size} processes) | "
+                f"Gradient checkpointing: {GRADIENT_CHECKPOINTING}"
+            )
+
+        for epoch in range(start_epoch, EPOCHS):
+            epoch_start_batch: int = start_batch if epoch == start_epoch else 0
+            # the sampler order only depends on the epoch, a resumed epoch skips the batches it has already seen
+            train_loader.batch_sampler.set_epoch(epoch, epoch_start_batch)
+
+            def on_step(batches: int, step_metrics: dict[str, float]) -> None:
+                nonlocal global_step
+                global_step += 1
+                if metrics_log is not None:
+                    metrics_log.log(
+                        "train_step",
+                        epoch=epoch + 1,
+                        step=global_step,
+                        **step_metrics,
+                        lr=optimizer.param_groups[0]["lr"],
+                        peak_memory_mb=peak_memory_mb(device),
+                    )
+
+                # all processes hold the same weights, only the first one writes checkpoints
+                if is_main and checkpoints.should_save(global_step):
+                    checkpoints.save(global_step, training_state(
+                        model,
+                        optimizer,
+                        epoch=epoch,
+                        batches_done=epoch_start_batch + batches,
+                        global_step=global_step,
+                        metrics=metrics,
+                    ))
+
+            train_loss, train_acc, step_time = train_one_epoch(
+                model=model,
+                dataloader=train_loader,
+                optimizer=optimizer,
+                loss_fn=loss_fn,
+                device=device,
+                precision=PRECISION,
+                grad_accum_steps=GRAD_ACCUM_STEPS,
+                on_step=on_step,
+                ddp_model=ddp_model,
+            )
+            # mean over the processes, every process trained on the same number of batches
+            train_loss, train_acc = (value / world_size for value in all_reduce_sum([train_loss, train_acc]))
+
+            val_loss, val_acc = evaluate(
+                model=model,
+                dataset=val_ds,
+                loss_fn=loss_fn,
+                device=device
+            )
+
+            metrics["train"]["loss"].append(train_loss)
+            metrics["train"]["acc"].append(train_acc)
+            metrics["val"]["loss"].append(val_loss)
+            metrics["val"]["acc"].append(val_acc)
+
+            if not is_main:
+                continue
+
+            metrics_log.log(
+                "epoch",
+                epoch=epoch + 1,
+                step=global_step,
+                train_loss=train_loss,
+                train_acc=train_acc,
+                val_loss=val_loss,
+                val_acc=val_acc,
+                step_time_s=step_time,
+                peak_memory_mb=peak_memory_mb(device),
+            )
+
+            # every epoch ends with a checkpoint that competes for the top k validation losses
+            checkpoints.save(
+                global_step,
+                training_state(
+                    model,
+                    optimizer,
+                    epoch=epoch + 1,
+                    batches_done=0,
+                    global_step=global_step,
+                    metrics=metrics,
+                ),
+                val_loss=val_loss,
+            )
+
+            print(
+                f"Epoch {epoch+1:02d} | "
+                f"Train Loss: {train_loss:.4f} | "
+                f"Train Acc: {train_acc:.4f} | "
+                f"Val Loss: {val_loss:.4f} | "
+                f"Val Acc: {val_acc:.4f} | "
+                f"Step Time: {step_time:.2f}s | "
+                f"Peak Memory: {peak_memory_mb(device):.0f} MB"
+            )
+
+        # only the model of the epoch with the lowest validation loss is saved
+        best: dict | None = checkpoints.load_best() if is_main else None
+        if best is not None:
+            model.load_state_dict(best["model"])
+            print(f"Best checkpoint: step {best['progress']['global_step']} (epoch {best['progress']['epoch']})")
+
+    # the saving and the analysis run only in the first process
+    if not is_main:
+        return
+    metrics_log.close()
 
     # safe the model
     model.save_model(save_model_path)
     print(f"Model saved to {save_model_path}")
 
-    # save metrics
-    metrics_path = save_model_path / "metrics.pkl"
-    metrics_path.parent.mkdir(parents=True, exist_ok=True)
-
-    with open(metrics_path, "wb") as f:
-        pickle.dump(metrics, f)
-
-    print(f"Metrics saved to {metrics_path}")
+    print(f"Metrics saved to {save_model_path / METRICS_LOG_FILE}")
 
-    # Validation + t-SNE
+    # one inference pass per split, the metrics and all plots are derived from the cached predictions
     model.eval()
-    embeddings = []
-    embed_labels = []
-    val_loss = 0.0
-    val_acc = 0.0
-    steps = 0
-    real_labels = [val_ds[i]["label"].item() for i in range(len(val_ds))]
-
-    with torch.no_grad():
-        for batch in val_ds:
-            texts = [batch["text"]]
-            labels = batch["label"].unsqueeze(0).to(device)
+    plots_dir: Path = save_model_path / "plots"
+    predictions: dict[str, dict[str, np.ndarray]] = {
+        split: predict_split(model, dataset, save_model_path / f"predictions_{split}.npz")
+        for split, dataset in (("train", train_ds), ("val", val_ds))
+    }
 
-            logits, emb = model(texts)
+    for split, split_predictions in predictions.items():
+        split_loss, split_acc = split_metrics(split_predictions, loss_fn)
+        print(f"{split.capitalize()} Loss: {split_loss:.4f} | {split.capitalize()} Accuracy: {split_acc:.4f}")
 
-            loss = loss_fn(logits, labels)
+    # here the classes from the data set are taken not the model predictions
+    plot_tsne(predictions["val"], "t-SNE – Full Song (Sliding Window + Max Pool)", plots_dir / "tsne_val.png")
+    plot_tsne(predictions["train"], "t-SNE – Training Set (Full Song, Sliding Window + Max Pool)", plots_dir / "tsne_train.png")
+
+    plot_training_curves(metrics, plots_dir / "training_curves.png")
+
+    plot_confusion_matrix(predictions["train"], LABELS, "Confusion Matrix – Train Set", plots_dir / "confusion_matrix_train.png")
+    plot_confusion_matrix(predictions["val"], LABELS, "Confusion Matrix – Validation Set", plots_dir / "confusion_matrix_val.png")
+    print(f"Plots saved to {plots_dir}")
+
+def predict_split(model: BertForLyrics, dataset: LyricsDataset, cache_path: Path) -> dict[str, np.ndarray]:
+    """
+    batched inference over the whole split, the logits, embeddings and labels are also written to cache_path (npz),
+    so the plots can be redone without the encoder
+    """
+    logits, embeddings = model.predict_batch(dataset.texts, batch_size=BATCH_SIZE)
+    predictions: dict[str, np.ndarray] = {
+        "logits": logits.float().cpu().numpy(),
+        "embeddings": embeddings.float().cpu().numpy(),
+        "labels": np.asarray(dataset.labels, dtype=np.int64),
+    }
 
-            val_loss += loss.item()
-            val_acc += accuracy(logits, labels)
-            steps += 1
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path, **predictions)
+    return predictions
 
-            embeddings.append(emb.cpu().numpy())
-            embed_labels.extend(labels.cpu().numpy())
+def split_metrics(predictions: dict[str, np.ndarray], loss_fn: nn.Module) -> tuple[float, float]:
+    logits: torch.Tensor = torch.from_numpy(predictions["logits"]).to(device)
+    labels: torch.Tensor = torch.from_numpy(predictions["labels"]).to(device)
+    return loss_fn(logits, labels).item(), accuracy(logits, labels)
 
-    print(f"Validation Loss: {val_loss / steps:.4f}")
-    print(f"Validation Accuracy: {val_acc / steps:.4f}")
+def save_figure(fig: plt.Figure, path: Path) -> None:
+    """the plots are written to files, plt.show() would block the script until the window is closed"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fig.tight_layout()
+    fig.savefig(path, dpi=150)
+    plt.close(fig)
 
-    # here the classes from the data set are taken not the model predictions
+def plot_tsne(predictions: dict[str, np.ndarray], title: str, path: Path) -> None:
     X_2d = TSNE(
         n_components=2,
         perplexity=30,
         random_state=42
-    ).fit_transform(np.vstack(embeddings))
-
-    plt.figure(figsize=(10, 8))
-    plt.scatter(X_2d[:, 0], X_2d[:, 1], c=real_labels, cmap="tab10", alpha=0.7) # embed_labels
-    plt.title("t-SNE – Full Song (Sliding Window + Max Pool)")
-    plt.show()
-
-    model.eval()
-    train_embeddings = []
-    train_labels = []
-
-    with torch.no_grad():
-        for batch in train_ds:
-            texts = [batch["text"]]
-            labels = batch["label"].unsqueeze(0).to(device)
-
-            _, emb = model(texts)
+    ).fit_transform(predictions["embeddings"])
 
-            train_embeddings.append(emb.cpu().numpy())
-            train_labels.extend(labels.cpu().numpy())
+    fig, ax = plt.subplots(figsize=(10, 8))
+    ax.scatter(X_2d[:, 0], X_2d[:, 1], c=predictions["labels"], cmap="tab10", alpha=0.7)
+    ax.set_title(title)
+    save_figure(fig, path)
 
-    X_train_2d = TSNE(n_components=2, perplexity=30, random_state=42).fit_transform(
-        np.vstack(train_embeddings)
-    )
+def plot_training_curves(metrics: dict[str, dict[str, list[float]]], path: Path) -> None:
+    """loss and accuracy per epoch for train and validation"""
+    fig, (loss_ax, acc_ax) = plt.subplots(1, 2, figsize=(12, 4))
 
-    plt.figure(figsize=(10, 8))
-    plt.scatter(X_train_2d[:, 0], X_train_2d[:, 1], c=train_labels, cmap="tab10", alpha=0.7)
-    plt.title("t-SNE – Training Set (Full Song, Sliding Window + Max Pool)")
-    plt.show()
-
-
-    # training plots for train and validation
-    plt.figure(figsize=(12, 4))
-
-    # Loss
-    plt.subplot(1, 2, 1)
-    plt.plot(metrics["train"]["loss"], label="Train")
-    plt.plot(metrics["val"]["loss"], label="Val")
-    plt.title("Loss")
-    plt.xlabel("Epoch")
-    plt.ylabel("Loss")
-    plt.legend()
-
-    # Accuracy
-    plt.subplot(1, 2, 2)
-    plt.plot(metrics["train"]["acc"], label="Train")
-    plt.plot(metrics["val"]["acc"], label="Val")
-    plt.title("Accuracy")
-    plt.xlabel("Epoch")
-    plt.ylabel("Accuracy")
-    plt.legend()
-
-    plt.tight_layout()
-    plt.show()
-
-    plot_confusion_matrix(
-        model=model,
-        dataset=train_ds,
-        label_names=LABELS,
-        device=device,
-        title="Confusion Matrix – Train Set"
-    )
+    for ax, metric, title in ((loss_ax, "loss", "Loss"), (acc_ax, "acc", "Accuracy")):
+        ax.plot(metrics["train"][metric], label="Train")
+        ax.plot(metrics["val"][metric], label="Val")
+        ax.set_title(title)
+        ax.set_xlabel("Epoch")
+        ax.set_ylabel(title)
+        ax.legend()
 
-    plot_confusion_matrix(
-        model=model,
-        dataset=val_ds,
-        label_names=LABELS,
-        device=device,
-        title="Confusion Matrix – Validation Set"
-    )
+    save_figure(fig, path)
 
 def plot_confusion_matrix(
-    model: nn.Module,
-    dataset: LyricsDataset,
+    predictions: dict[str, np.ndarray],
     label_names: list[str],
-    device: torch.device,
-    title: str
-):
-    model.eval()
-    y_true = []
-    y_pred = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            texts = [batch["text"]]
-            label = batch["label"].item()
-
-            logits, _ = model(texts)
-            pred = torch.argmax(logits, dim=1).item()
-
-            y_true.append(label)
-            y_pred.append(pred)
-
-    cm = confusion_matrix(y_true, y_pred)
+    title: str,
+    path: Path,
+) -> None:
+    y_pred: np.ndarray = predictions["logits"].argmax(axis=1)
+    cm = confusion_matrix(predictions["labels"], y_pred, labels=range(len(label_names)))
 
     disp = ConfusionMatrixDisplay(
         confusion_matrix=cm,
         display_labels=label_names
     )
 
-    disp.plot(cmap="Blues", xticks_rotation=45)
-    plt.title(title)
-    plt.tight_layout()
-    plt.show()
+    fig, ax = plt.subplots(figsize=(10, 8))
+    disp.plot(ax=ax, cmap="Blues", xticks_rotation=45)
+    ax.set_title(title)
+    save_figure(fig, path)
 
 
 if __name__ == "__main__":
     set_seed()
-    main()
+    try:
+        main()
+    finally:
+        cleanup_distributed()
@@ -1,13 +1,19 @@
+import itertools
 import math
-import pickle
+import time
 from pathlib import Path
 
 import kagglehub
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
-from transformers import XLMRobertaTokenizer, PreTrainedTokenizerBase
+
+from utils.checkpoint_manager import CheckpointManager, restore_training_state, training_state
+from utils.metrics_log import METRICS_LOG_FILE, MetricsLog, peak_memory_mb
+from utils.token_shards import TokenShardDataset, build_token_shards
+from transformers import XLMRobertaTokenizerFast, PreTrainedTokenizerBase
 import torch
 from torch.optim import AdamW
 from torch.utils.data import Dataset, DataLoader
@@ -46,11 +52,88 @@ class LyricsMLMDataset(Dataset):
             "attention_mask": encoding["attention_mask"].squeeze(0),
         }
 
+class PackedLyricsMLMDataset(Dataset):
+    """
+    all lyrics are tokenized once and concatenated into one token stream, every song is wrapped with <s> ... </s>
+    as separator, the stream is cut into blocks of exactly block_size tokens,
+    so no block needs padding and the text of long songs is not truncated (only the incomplete last block is dropped)
+    """
+
+    def __init__(
+        self,
+        lyrics: list[str],
+        tokenizer: PreTrainedTokenizerBase,
+        block_size: int,
+    ):
+        # one batched call, the fast tokenizer encodes the lyrics in parallel
+        input_ids: list[list[int]] = tokenizer(
+            lyrics,
+            add_special_tokens=True,
+            verbose=False,  # no warning for lyrics longer than the model, they are split over several blocks
+        )["input_ids"]
+
+        stream: np.ndarray = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int64)
+        num_blocks: int = len(stream) // block_size
+
+        self.num_tokens: int = len(stream)
+        self.blocks: torch.Tensor = torch.from_numpy(stream[:num_blocks * block_size].reshape(num_blocks, block_size))
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __getitem__(self, idx: int) -> dict:
+        return {"input_ids": self.blocks[idx]}
+
+def build_mlm_dataset(
+    lyrics: list[str],
+    tokenizer: PreTrainedTokenizerBase,
+    max_length: int,
+    packed: bool,
+) -> Dataset:
+    if packed:
+        return PackedLyricsMLMDataset(lyrics=lyrics, tokenizer=tokenizer, block_size=max_length)
+    return LyricsMLMDataset(lyrics=lyrics, tokenizer=tokenizer, max_length=max_length)
+
+def num_real_tokens(batch: dict[str, torch.Tensor]) -> int:
+    """tokens without padding"""
+    if "attention_mask" in batch:
+        return int(batch["attention_mask"].sum().item())
+    return batch["input_ids"].numel()
+
+def epoch_train_loader(
+    dataset: Dataset,
+    batch_size: int,
+    collate_fn: DataCollatorForLanguageModeling,
+    epoch: int,
+    start_batch: int = 0,
+    seed: int = 42,
+) -> DataLoader:
+    """the shuffle order only depends on the epoch, so a resumed epoch skips exactly the batches it has already seen"""
+    # own generators, so creating the loader does not advance the global rng of the masking
+    generator: torch.Generator = torch.Generator().manual_seed(seed + epoch)
+
+    if isinstance(dataset, TokenShardDataset):
+        # the shards shuffle themselves per epoch
+        dataset.load_state_dict({"epoch": epoch, "start_block": start_batch * batch_size})
+        return DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, generator=generator)
+
+    order: torch.Tensor = torch.randperm(len(dataset), generator=generator)
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=order[start_batch * batch_size:].tolist(),
+        collate_fn=collate_fn,
+        generator=generator,
+    )
+
 def evaluate_mlm(
     model: XLMRobertaForMaskedLM,
     dataloader: DataLoader,
     device: torch.device,
 ) -> tuple[float, float, float ]:
+    if len(dataloader) == 0:
+        raise ValueError("The validation set has no batches")
+
     model.eval()
 
     total_loss = 0.0
@@ -81,7 +164,7 @@ def evaluate_mlm(
     return perplexity, masked_acc, avg_loss
 
 def train_dapt_with_config(
-    lyrics: list[str],
+    lyrics: list[str] | None,
     model_name: str,
     output_dir: Path,
     device: torch.device,
@@ -89,7 +172,20 @@ def train_dapt_with_config(
     batch_size: int = 8,
     lr: float = 5e-5,
     mlm_probability: float = 0.15,
+    packed: bool = True,
+    shard_dir: Path | None = None,
+    checkpoint_every: int = 500,
+    keep_top_k: int = 3,
+    resume: bool = True,
 ):
+    """
+    packed: concatenated 512 token blocks (PackedLyricsMLMDataset), otherwise one padded and truncated song per row
+    shard_dir: token shards of build_token_shards instead of the lyrics list, the blocks are streamed from disk
+    checkpoint_every: optimizer steps between two checkpoints in output_dir / "checkpoints",
+    the keep_top_k checkpoints with the lowest validation loss are kept and the best one is saved as the final model
+    resume: continue from the latest checkpoint
+    the metrics of every step and every epoch are appended to output_dir / metrics.jsonl (plot_metrics.py)
+    """
 
     mlm_model = XLMRobertaForMaskedLM.from_pretrained(
         model_name
@@ -97,31 +193,43 @@ def train_dapt_with_config(
     tokenizer = mlm_model.get_input_embeddings().weight.device
     tokenizer = None
 
-    tokenizer = XLMRobertaTokenizer.from_pretrained(model_name)
+    tokenizer = XLMRobertaTokenizerFast.from_pretrained(model_name)
 
     mlm_model.to(device)
     mlm_model.train()
 
-    lyrics_train, lyrics_val = train_test_split(
-        lyrics,
-        test_size=0.1,
-        random_state=42
-    )
+    max_length: int = mlm_model.config.max_position_embeddings - 2
+    train_dataset: Dataset
+    val_dataset: Dataset
+
+    if shard_dir is not None:
+        train_dataset = TokenShardDataset(shard_dir, block_size=max_length, split="train")
+        val_dataset = TokenShardDataset(shard_dir, block_size=max_length, split="val", shuffle=False)
+        print(f"Train blocks: {len(train_dataset)}")
+        print(f"Val blocks:   {len(val_dataset)}")
+    else:
+        lyrics_train, lyrics_val = train_test_split(
+            lyrics,
+            test_size=0.1,
+            random_state=42
+        )
 
-    print(f"Train lyrics: {len(lyrics_train)}")
-    print(f"Val lyrics:   {len(lyrics_val)}")
+        print(f"Train lyrics: {len(lyrics_train)}")
+        print(f"Val lyrics:   {len(lyrics_val)}")
 
-    train_dataset: LyricsMLMDataset = LyricsMLMDataset(
-        lyrics=lyrics_train,
-        tokenizer=tokenizer,
-        max_length=mlm_model.config.max_position_embeddings - 2,
-    )
+        train_dataset = build_mlm_dataset(
+            lyrics=lyrics_train,
+            tokenizer=tokenizer,
+            max_length=max_length,
+            packed=packed,
+        )
 
-    val_dataset: LyricsMLMDataset = LyricsMLMDataset(
-        lyrics=lyrics_val,
-        tokenizer=tokenizer,
-        max_length=mlm_model.config.max_position_embeddings - 2,
-    )
+        val_dataset = build_mlm_dataset(
+            lyrics=lyrics_val,
+            tokenizer=tokenizer,
+            max_length=max_length,
+            packed=packed,
+        )
 
     data_collator: DataCollatorForLanguageModeling = DataCollatorForLanguageModeling(
         tokenizer=tokenizer,
@@ -129,12 +237,9 @@ def train_dapt_with_config(
         mlm_probability=mlm_probability, # percentage of token erasing for masked language modeling
     )
 
-    train_loader: DataLoader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        collate_fn=data_collator,
-    )
+    # packing drops the last partial block, a validation set below max_length tokens has no blocks at all
+    if len(val_dataset) == 0:
+        raise ValueError(f"The packed validation set has no blocks of {max_length} tokens, use more validation lyrics")
 
     val_loader: DataLoader = DataLoader(
         val_dataset,
@@ -150,6 +255,7 @@ def train_dapt_with_config(
             "loss": [],
             "perplexity": [],
             "masked_acc": [],
+            "tokens_per_sec": [],
         },
         "val": {
             "loss": [],
@@ -158,16 +264,46 @@ def train_dapt_with_config(
         }
     }
 
-    for epoch in range(epochs):
+    checkpoints: CheckpointManager = CheckpointManager(
+        output_dir / "checkpoints",
+        save_every=checkpoint_every,
+        keep_top_k=keep_top_k,
+        resume=resume,
+    )
+    start_epoch: int = 0
+    start_batch: int = 0
+    global_step: int = 0
+
+    state: dict | None = checkpoints.load_latest() if resume else None
+    if state is not None:
+        progress: dict = restore_training_state(state, mlm_model, optimizer)
+        start_epoch, start_batch, global_step = progress["epoch"], progress["batches_done"], progress["global_step"]
+        metrics = progress["metrics"]
+        print(f"Resumed from step {global_step} (epoch {start_epoch + 1}, batch {start_batch})")
+
+    metrics_log: MetricsLog = MetricsLog(output_dir / METRICS_LOG_FILE)
+
+    for epoch in range(start_epoch, epochs):
         mlm_model.train()
+        epoch_start_batch: int = start_batch if epoch == start_epoch else 0
+        train_loader: DataLoader = epoch_train_loader(
+            train_dataset,
+            batch_size=batch_size,
+            collate_fn=data_collator,
+            epoch=epoch,
+            start_batch=epoch_start_batch,
+        )
 
         total_loss = 0.0
         total_correct = 0
         total_masked = 0
+        total_tokens = 0
+        start = time.perf_counter()
+        step_start = start
 
         progress_bar = tqdm(train_loader, desc=f"Epoch {epoch + 1}")
 
-        for batch in progress_bar:
+        for i, batch in enumerate(progress_bar):
             batch = {k: v.to(device) for k, v in batch.items()}
 
             outputs = mlm_model(**batch)
@@ -178,7 +314,21 @@ def train_dapt_with_config(
             optimizer.step()
             optimizer.zero_grad()
 
-            total_loss += loss.item()
+            global_step += 1
+            if checkpoints.should_save(global_step):
+                checkpoints.save(global_step, training_state(
+                    mlm_model,
+                    optimizer,
+                    epoch=epoch,
+                    batches_done=epoch_start_batch + i + 1,
+                    global_step=global_step,
+                    metrics=metrics,
+                ))
+
+            step_loss = loss.item()
+            step_tokens = num_real_tokens(batch)
+            total_loss += step_loss
+            total_tokens += step_tokens
 
             # Masked Token Accuracy
             labels = batch["labels"]
@@ -192,14 +342,31 @@ def train_dapt_with_config(
             total_masked += masked
 
             acc = correct / masked if masked > 0 else 0.0
+
+            step_end = time.perf_counter()
+            metrics_log.log(
+                "train_step",
+                epoch=epoch + 1,
+                step=global_step,
+                loss=step_loss,
+                masked_acc=acc,
+                step_time_s=step_end - step_start,
+                tokens_per_sec=step_tokens / (step_end - step_start),
+                lr=optimizer.param_groups[0]["lr"],
+                peak_memory_mb=peak_memory_mb(device),
+            )
+            step_start = step_end
+
             progress_bar.set_postfix(
-                loss=f"{loss.item():.4f}",
+                loss=f"{step_loss:.4f}",
                 masked_acc=f"{acc:.3f}",
+                tokens_per_sec=f"{total_tokens / (time.perf_counter() - start):.0f}",
             )
 
-        avg_loss = total_loss / len(train_loader)
+        tokens_per_sec = total_tokens / (time.perf_counter() - start)
+        avg_loss = total_loss / max(len(train_loader), 1)
         perplexity = math.exp(avg_loss)
-        masked_accuracy = total_correct / total_masked
+        masked_accuracy = total_correct / total_masked if total_masked > 0 else 0.0
 
         val_ppl, val_acc, val_loss = evaluate_mlm(
             model=mlm_model,
@@ -210,47 +377,93 @@ def train_dapt_with_config(
         metrics["train"]["loss"].append(avg_loss)
         metrics["train"]["perplexity"].append(perplexity)
         metrics["train"]["masked_acc"].append(masked_accuracy)
+        metrics["train"]["tokens_per_sec"].append(tokens_per_sec)
 
         metrics["val"]["perplexity"].append(val_ppl)
         metrics["val"]["masked_acc"].append(val_acc)
         metrics["val"]["loss"].append(val_loss)
 
+        metrics_log.log(
+            "epoch",
+            epoch=epoch + 1,
+            step=global_step,
+            train_loss=avg_loss,
+            train_perplexity=perplexity,
+            train_masked_acc=masked_accuracy,
+            tokens_per_sec=tokens_per_sec,
+            val_loss=val_loss,
+            val_perplexity=val_ppl,
+            val_masked_acc=val_acc,
+            peak_memory_mb=peak_memory_mb(device),
+        )
+
+        # every epoch ends with a checkpoint that competes for the top k validation losses
+        checkpoints.save(
+            global_step,
+            training_state(
+                mlm_model,
+                optimizer,
+                epoch=epoch + 1,
+                batches_done=0,
+                global_step=global_step,
+                metrics=metrics,
+            ),
+            val_loss=val_loss,
+        )
+
         print(
             f"Epoch {epoch + 1} finished | "
             f"Loss: {metrics['train']['loss'][-1]:.4f} | "
             f"Perplexity: {metrics['train']['perplexity'][-1]:.2f} | "
             f"Masked Acc: {metrics['train']['masked_acc'][-1]:.3f} | "
+            f"Tokens/sec: {metrics['train']['tokens_per_sec'][-1]:.0f} | "
             f"Validation Loss: {metrics['val']['loss'][-1]:.4f} | "
             f"Validation Perplexity: {metrics['val']['perplexity'][-1]:.2f} | "
             f"Validation Masked Acc: {metrics['val']['masked_acc'][-1]:.3f}"
         )
 
+    # the final model is the one of the epoch with the lowest validation loss
+    best: dict | None = checkpoints.load_best()
+    if best is not None:
+        mlm_model.load_state_dict(best["model"])
+        print(f"Best checkpoint: step {best['progress']['global_step']} (epoch {best['progress']['epoch']})")
+
     output_dir.mkdir(parents=True, exist_ok=True)
     mlm_model.save_pretrained(output_dir)
     tokenizer.save_pretrained(output_dir)
     print(f"DAPT finished. Model saved to {output_dir}")
 
-    metrics_path = output_dir / "metrics.pkl"
-    with open(metrics_path, "wb") as f:
-        pickle.dump(metrics, f)
-    print(f"Metrics saved to {metrics_path}")
+    metrics_log.close()
+    print(f"Metrics saved to {output_dir / METRICS_LOG_FILE}")
 
 
 def main() -> None:
     device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     epochs: int = 10
+    # stream all ~57k songs from token shards on disk instead of sampling n songs into memory
+    use_streaming_corpus: bool = True
+    shard_dir: Path = Path("cache/dapt_shards/xlm-roberta-base")
 
     dataset_path = kagglehub.dataset_download("joebeachcapital/57651-spotify-songs")
     print(f"Dataset downloaded to: {dataset_path}")
 
     csv_file = Path(dataset_path) / "Spotify Million Song Dataset_exported.csv"
 
-    df: DataFrame = pd.read_csv(csv_file)
-    df = df[df["text"].notna() & (df["text"].str.len() > 50)]
-    # here only n songs get loaded, increase if needed
-    lyrics = df["text"].sample(n=2000, random_state=42).tolist()
+    lyrics: list[str] | None = None
+    if use_streaming_corpus:
+        # only the chunks that are not tokenized yet are processed, a finished corpus is skipped
+        index: dict = build_token_shards(csv_file, shard_dir, tokenizer_name="xlm-roberta-base")
+        print(
+            f"Token shards: {sum(shard['train']['num_songs'] for shard in index['shards'])} train songs, "
+            f"{sum(shard['val']['num_songs'] for shard in index['shards'])} val songs in {shard_dir}"
+        )
+    else:
+        df: DataFrame = pd.read_csv(csv_file)
+        df = df[df["text"].notna() & (df["text"].str.len() > 50)]
+        # here only n songs get loaded, increase if needed
+        lyrics = df["text"].sample(n=2000, random_state=42).tolist()
 
-    print(f"Loaded {len(lyrics)} lyrics")
+        print(f"Loaded {len(lyrics)} lyrics")
 
     train_dapt_with_config(
         lyrics=lyrics,
@@ -259,6 +472,7 @@ def main() -> None:
         device=device,
         epochs=epochs,
         batch_size=2,
+        shard_dir=shard_dir if use_streaming_corpus else None,
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from benchmark_forward import load_lyrics
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.onnx_lyrics_model import OnnxLyricsModel
+
+MODEL_NAME: str = "xlm-roberta-base"
+NUM_LABELS: int = 7
+MODEL_PATH: Path = Path("models/xlm-roberta-base_1")
+CSV_DIR: Path = Path("song_labels/processed")
+PARITY_NUM_SONGS: int = 20 # songs that both backends predict after the export
+MAX_ABS_DIFF: float = 1e-3
+
+
+def onnx_parity(model: BertForLyrics, model_path: Path, lyrics: list[str], batch_size: int = 8) -> dict[str, float]:
+    """
+    predicts the lyrics with the torch model and the exported onnx graphs in model_path / "onnx"
+
+    Returns the max abs difference of the embeddings and the logits and the share of equal labels
+    """
+    onnx_model: OnnxLyricsModel = OnnxLyricsModel(
+        model_dir=model_path,
+        chunk_size=model.config.chunk_size,
+        stride=model.config.stride,
+        use_max_pooling=model.config.use_max_pooling,
+        max_chunks_per_call=model.config.max_chunks_per_call,
+    )
+
+    model.eval()
+    with torch.no_grad():
+        torch_logits, torch_embeddings = model.predict_batch(lyrics, batch_size=batch_size)
+    onnx_logits, onnx_embeddings = onnx_model.predict_batch(lyrics, batch_size=batch_size)
+
+    torch_logits_np: np.ndarray = torch_logits.cpu().numpy()
+    return {
+        "embeddings": float(np.abs(torch_embeddings.cpu().numpy() - onnx_embeddings).max()),
+        "logits": float(np.abs(torch_logits_np - onnx_logits).max()),
+        "label_agreement": float((torch_logits_np.argmax(axis=1) == onnx_logits.argmax(axis=1)).mean()),
+    }
+
+
+def main() -> None:
+    model_config: BertForLyricsConfig = BertForLyricsConfig(
+        model_name=MODEL_NAME,
+        num_labels=NUM_LABELS,
+        chunk_size=510,
+        stride=256
+    )
+
+    # exported on the cpu, the onnx backend only runs on the cpu execution provider
+    model: BertForLyrics = BertForLyrics.load_model(
+        path=MODEL_PATH,
+        config=model_config,
+        device=torch.device("cpu"),
+    )
+
+    model.export_onnx(MODEL_PATH / "onnx")
+
+    # the export is only used when both backends agree
+    parity: dict[str, float] = onnx_parity(model, MODEL_PATH, load_lyrics(CSV_DIR, PARITY_NUM_SONGS))
+    print(f"Parity: {parity}")
+    if parity["embeddings"] > MAX_ABS_DIFF or parity["logits"] > MAX_ABS_DIFF:
+        raise RuntimeError(f"Parity check failed, difference above {MAX_ABS_DIFF}")
+
+
+if __name__ == "__main__":
+    main()
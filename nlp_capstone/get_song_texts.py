@@ -3,10 +3,11 @@ from typing import Hashable
 
 import pandas as pd
 from pathlib import Path
-import lyricsgenius
 from dotenv import load_dotenv
-from lyricsgenius.types import Song
-from pandas import DataFrame, Series
+from pandas import DataFrame
+
+from utils.lyrics_cache import LyricsCache
+from utils.lyrics_fetcher import GeniusLyricsSource, LyricsFetcher
 
 # Paths & ENV
 NAME: str = "paul"
@@ -15,6 +16,9 @@ OUTPUT_DIR: Path = DATE_DIR / Path("processed")
 ENV_PATH: Path = Path(".env")
 SONGS_PATH: Path = Path(F"songs_{NAME}.csv")
 SONGS_PATH_OUTPUT: Path = Path(f"songs_{NAME}_processed.csv")
+LYRICS_CACHE_PATH: Path = Path("cache/genius_lyrics.sqlite")
+FETCH_WORKERS: int = 8
+GENIUS_SEARCHES_PER_SEC: float = 2.0
 
 def main():
     # Load ENV
@@ -24,14 +28,12 @@ def main():
     if not genius_token:
         raise RuntimeError("GENIUS_CLIENT_ACCESS_TOKEN missing")
 
-    # Genius Client
-    genius: lyricsgenius.Genius = lyricsgenius.Genius(
-        genius_token,
-        skip_non_songs=True,
-        remove_section_headers=True,
-        verbose=False,
-        timeout=15,
-        retries=3
+    # Genius Fetcher
+    fetcher: LyricsFetcher = LyricsFetcher(
+        source=GeniusLyricsSource(genius_token, timeout=15),
+        cache=LyricsCache(LYRICS_CACHE_PATH),
+        max_workers=FETCH_WORKERS,
+        requests_per_sec=GENIUS_SEARCHES_PER_SEC,
     )
 
     # Load CSV
@@ -48,27 +50,21 @@ def main():
         df["lyrics"] = ""
 
     # Check Songs
-    for idx, row in df.iterrows():
-        idx: Hashable = idx
-        row_series: Series = row
-        artist: str = str(row_series["Author"])
-        title: str = str(row_series["Song Name"])
-
-        print(f"Checking: {artist} – {title}")
-
-        song: Song | None
-        try:
-            song = genius.search_song(title, artist)
-        except Exception as e:
-            print("  Genius error:", e)
-            continue
+    indices: list[Hashable] = df.index.tolist()
+    songs: list[tuple[str, str]] = list(zip(df["Author"].astype(str), df["Song Name"].astype(str)))
 
-        if song and song.lyrics and song.lyrics.strip():
-            lyrics_text: str  = song.lyrics.strip()
+    for result in fetcher.fetch(songs):
+        idx: Hashable = indices[result.index]
+        print(f"Checking: {result.artist} – {result.track}")
+
+        if result.error is not None:
+            print("  Genius error:", result.error)
+            continue
 
+        if result.lyrics:
             df.at[idx, "lyrics_available"] = True
-            df.at[idx, "lyrics_length"] = len(lyrics_text)
-            df.at[idx, "lyrics"] = lyrics_text
+            df.at[idx, "lyrics_length"] = len(result.lyrics)
+            df.at[idx, "lyrics"] = result.lyrics
 
             print("✔ Lyrics found")
         else:
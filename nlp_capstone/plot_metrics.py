@@ -1,45 +1,92 @@
-import pickle
 import matplotlib.pyplot as plt
+import pandas as pd
 from pathlib import Path
 
-def plot_metrics(metrics_path: Path):
-    with open(metrics_path, "rb") as f:
-        metrics = pickle.load(f)
+from utils.metrics_log import METRICS_LOG_FILE, MetricsLogTail, metrics_frame
 
-    epochs = range(1, len(metrics["train"]["loss"]) + 1)
+SMOOTHING_STEPS: int = 50 # rolling mean over the noisy per step values
 
-    plt.figure(figsize=(15, 5))
+
+def draw_metrics(axes: list[plt.Axes], frame: pd.DataFrame) -> None:
+    """metrics.jsonl of dapt_pretrain_lyrics.py (masked_acc) and of bert_train.py (acc) over the optimizer steps"""
+    steps: pd.DataFrame = frame[frame["event"] == "train_step"]
+    epochs: pd.DataFrame = frame[frame["event"] == "epoch"]
+    acc_column: str = "masked_acc" if "masked_acc" in frame else "acc"
+
+    for ax in axes:
+        ax.clear()
+        ax.set_xlabel("Step")
+
+    def plot_steps(ax: plt.Axes, column: str, label: str) -> None:
+        if column not in steps or steps.empty:
+            return
+        ax.plot(steps["step"], steps[column], alpha=0.3, label=label)
+        ax.plot(steps["step"], steps[column].rolling(SMOOTHING_STEPS, min_periods=1).mean(), label=f"{label} (mean)")
+
+    def plot_epochs(ax: plt.Axes, column: str, label: str) -> None:
+        if column not in epochs or epochs.empty:
+            return
+        ax.plot(epochs["step"], epochs[column], marker="o", label=label)
 
     # Loss
-    plt.subplot(1, 3, 1)
-    plt.plot(epochs, metrics["train"]["loss"], label="Train Loss")
-    plt.plot(epochs, metrics["val"]["loss"], label="Val Loss")
-    plt.xlabel("Epoch")
-    plt.ylabel("Loss")
-    plt.legend()
-    plt.title("Loss")
-
-    # Perplexity
-    plt.subplot(1, 3, 2)
-    plt.plot(epochs, metrics["train"]["perplexity"], label="Train PPL")
-    plt.plot(epochs, metrics["val"]["perplexity"], label="Val PPL")
-    plt.xlabel("Epoch")
-    plt.ylabel("Perplexity")
-    plt.legend()
-    plt.title("Perplexity")
-
-    # Masked Accuracy
-    plt.subplot(1, 3, 3)
-    plt.plot(epochs, metrics["train"]["masked_acc"], label="Train Masked Acc")
-    plt.plot(epochs, metrics["val"]["masked_acc"], label="Val Masked Acc")
-    plt.xlabel("Epoch")
-    plt.ylabel("Accuracy")
-    plt.legend()
-    plt.title("Masked Token Accuracy")
-
-    plt.tight_layout()
-    plt.show()
+    plot_steps(axes[0], "loss", "Train Loss")
+    plot_epochs(axes[0], "val_loss", "Val Loss")
+    axes[0].set_title("Loss")
+
+    # (Masked) Accuracy
+    plot_steps(axes[1], acc_column, "Train Acc")
+    plot_epochs(axes[1], f"val_{acc_column}", "Val Acc")
+    axes[1].set_title("Masked Token Accuracy" if acc_column == "masked_acc" else "Accuracy")
+
+    # Throughput
+    plot_steps(axes[2], "tokens_per_sec", "Tokens/sec")
+    axes[2].set_title("Throughput")
+
+    plot_steps(axes[3], "step_time_s", "Step Time")
+    axes[3].set_title("Step Time (s)")
+
+    plot_steps(axes[4], "peak_memory_mb", "Peak Memory")
+    axes[4].set_title("Peak Memory (MB)")
+
+    plot_steps(axes[5], "lr", "Learning Rate")
+    axes[5].set_title("Learning Rate")
+
+    for ax in axes:
+        if ax.lines:
+            ax.legend()
+
+
+def plot_metrics(metrics_path: Path, follow: bool = False, refresh_seconds: float = 5.0):
+    """
+    follow: live mode for a running training, only the lines that were appended since the last refresh are read,
+    the plot is redrawn every refresh_seconds until the window is closed
+    """
+    tail: MetricsLogTail = MetricsLogTail(metrics_path)
+    records: list[dict] = tail.read_new()
+
+    fig, axes = plt.subplots(2, 3, figsize=(18, 8))
+    axes = list(axes.flat)
+
+    if not follow:
+        draw_metrics(axes, metrics_frame(records))
+        plt.tight_layout()
+        plt.show()
+        return
+
+    plt.ion()
+    changed: bool = True
+
+    while plt.fignum_exists(fig.number):
+        if changed and records:
+            draw_metrics(axes, metrics_frame(records))
+            fig.suptitle(f"{metrics_path} – step {records[-1].get('step', '?')}")
+            fig.tight_layout()
+
+        plt.pause(refresh_seconds)
+        new_records: list[dict] = tail.read_new()
+        records.extend(new_records)
+        changed = bool(new_records)
 
 
 if __name__ == "__main__":
-    plot_metrics(Path("./models/dapt_10_epoch/metrics.pkl"))
+    plot_metrics(Path("./models/dapt_10_epoch") / METRICS_LOG_FILE, follow=True)
@@ -1,13 +1,18 @@
 import ast
 import os
 import re
+from collections import deque
+from collections.abc import Iterator
 from pathlib import Path
+from typing import Hashable
 
 import kagglehub
-import lyricsgenius
 import pandas as pd
 from dotenv import load_dotenv
-from lyricsgenius.types import Song
+
+from utils.lyrics_cache import LyricsCache, normalize_text
+from utils.lyrics_fetcher import GeniusLyricsSource, LyricsFetcher
+from utils.lyrics_result_log import LyricsResultLog, read_lyrics_results
 
 SEED_TO_LABEL: dict[str, str] = {
     "acerbic": "heartbroken",
@@ -288,40 +293,122 @@ SEED_TO_LABEL: dict[str, str] = {
     "yearning": "loneliness"
 }
 
-CSV_OUTPUT_FILE = Path("muse_with_classname_and_lyrics.csv")
+CSV_OUTPUT_FILE = Path("muse_with_classname_and_lyrics.csv") # compacted from RESULTS_LOG_FILE at the end of a run
+RESULTS_LOG_FILE = Path("muse_lyrics_results.jsonl") # one line per searched song, written while crawling
 ENV_PATH = Path(".env")
+LYRICS_CACHE_PATH = Path("cache/genius_lyrics.sqlite") # every search (lyrics or miss), a restarted crawl only searches new songs
+FETCH_WORKERS = 8
+GENIUS_SEARCHES_PER_SEC = 2.0 # one search_song makes ~3 requests to genius
+SONGS_PER_CLASS: int | None = None # lyrics per class the training needs, the crawl stops early when every class has them
+
+# the seeds cells are python string lists like "['sad', 'bittersweet']"
+SEED_PATTERN: re.Pattern = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+LABEL_DTYPE: pd.CategoricalDtype = pd.CategoricalDtype(sorted(set(SEED_TO_LABEL.values())))
+
+def parse_seed_list(seed_entry: str) -> list[str]:
+    """regex instead of ast.literal_eval, escaped quotes are the only case that still needs literal_eval"""
+    if "\\" in seed_entry:
+        seed_list = ast.literal_eval(seed_entry)
+        return [str(seed) for seed in seed_list] if isinstance(seed_list, list) else []
+
+    return [single or double for single, double in SEED_PATTERN.findall(seed_entry)]
+
+def seeds_to_labels(seeds: pd.Series) -> tuple[pd.Series, list[str]]:
+    """
+    every distinct seeds string is parsed once, the labels of all its seeds are looked up in SEED_TO_LABEL at once
+    and the most frequent label wins (tie --> the label of the first seed), songs without a known seed get NaN
+
+    Returns:
+    - the label of every row as categorical column
+    - all seeds that occur in the column
+    """
+    distinct: pd.Series = pd.Series(seeds.dropna().unique())
+    distinct = distinct[distinct.map(lambda entry: isinstance(entry, str))].reset_index(drop=True)
+
+    # one row per (distinct string, seed), the index is the position of the string in distinct
+    seed_per_string: pd.Series = distinct.map(parse_seed_list).explode().dropna()
+    label_per_seed: pd.Series = seed_per_string.map(SEED_TO_LABEL)
+
+    votes: pd.DataFrame = pd.DataFrame({
+        "string": label_per_seed.index,
+        "label": label_per_seed.to_numpy(),
+        "position": range(len(label_per_seed)),
+    }).dropna(subset=["label"])
+    votes = (
+        votes.groupby(["string", "label"], sort=False)
+        .agg(count=("position", "size"), first=("position", "min"))
+        .reset_index()
+        .sort_values(["count", "first"], ascending=[False, True])
+        .drop_duplicates("string")
+    )
+    label_per_string: pd.Series = pd.Series(votes["label"].to_numpy(), index=distinct.to_numpy()[votes["string"].to_numpy()])
+
+    labels: pd.Series = seeds.map(label_per_string).astype(LABEL_DTYPE)
+    return labels, sorted(set(seed_per_string))
+
+def first_column(df: pd.DataFrame, names: list[str]) -> pd.Series:
+    for name in names:
+        if name in df.columns:
+            return df[name]
+    return pd.Series("", index=df.index)
+
+def class_balanced_order(
+    queues: dict[str, deque[Hashable]],
+    found: dict[str, int],
+    songs_per_class: int | None,
+) -> Iterator[tuple[str, Hashable]]:
+    """
+    one song per class and round, a class drops out when its queue is empty or when it has songs_per_class lyrics
+    found is updated by the caller while the songs are fetched, so the schedule ends once every class is done
+    """
+    active: deque[str] = deque(cls for cls, queue in queues.items() if queue)
+    while active:
+        cls = active.popleft()
+        if songs_per_class is not None and found[cls] >= songs_per_class:
+            continue
+
+        yield cls, queues[cls].popleft()
+        if queues[cls]:
+            active.append(cls)
+
+def apply_lyrics_results(df: pd.DataFrame, results: pd.DataFrame) -> None:
+    """writes the results of read_lyrics_results into the lyrics columns of df (rows = positions in the MuSe csv)"""
+    for col, default in [("lyrics_available", False), ("lyrics_length", 0), ("lyrics", "")]:
+        if col not in df.columns:
+            df[col] = default
 
-
-def map_seeds_to_label(seed_entry: str) -> str:
-    seed_list = ast.literal_eval(seed_entry)
-    if not isinstance(seed_list, list):
-        raise ValueError()
-
-    for seed in seed_list:
-        if seed in SEED_TO_LABEL:
-            return SEED_TO_LABEL[seed]
-        else:
-            raise ValueError()
-
-    raise ValueError()
-
-def normalize_text(s: str) -> str:
-    s = s.lower()
-    s = re.sub(r"\(.*?\)", "", s)      # (feat. ..), (remastered)
-    s = re.sub(r"\[.*?\]", "", s)
-    s = re.sub(r"[-–—].*$", "", s)     # - live, - remastered
-    s = s.replace("’", "'")
-    s = re.sub(r"[^\w\s']", "", s)
-    return s.strip()
-
-def fetch_lyrics(df: pd.DataFrame, genius_token: str) -> pd.DataFrame:
-    genius = lyricsgenius.Genius(
-        genius_token,
-        skip_non_songs=True,
-        remove_section_headers=True,
-        verbose=False,
-        timeout=15,
-        retries=3
+    if results.empty:
+        return
+
+    lyrics: pd.Series = results["lyrics"].fillna("")
+    df.loc[lyrics.index, "lyrics"] = lyrics
+    df.loc[lyrics.index, "lyrics_length"] = lyrics.str.len()
+    df.loc[lyrics.index, "lyrics_available"] = lyrics.str.len() > 0
+
+def compact_lyrics_results(df: pd.DataFrame, csv_path: Path) -> None:
+    """the full dataset with lyrics as csv, written to a temp file first, so a crash never leaves a half written csv"""
+    tmp_path: Path = csv_path.with_name(f"{csv_path.name}.{os.getpid()}.tmp")
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, csv_path)
+
+def fetch_lyrics(
+    df: pd.DataFrame,
+    genius_token: str,
+    songs_per_class: int | None = None,
+    result_log: LyricsResultLog | None = None,
+    searched_rows: pd.Index | None = None,
+) -> pd.DataFrame:
+    """
+    songs_per_class: stop fetching a class once it has that many lyrics (songs that already have lyrics count),
+    None --> every song, the songs still in flight when a class is done can exceed the quota by a few
+    result_log: every answered search is appended to it right away
+    searched_rows: rows with an answer from an earlier run (the result log), also the misses are not queued again
+    """
+    fetcher: LyricsFetcher = LyricsFetcher(
+        source=GeniusLyricsSource(genius_token, timeout=15),
+        cache=LyricsCache(LYRICS_CACHE_PATH),
+        max_workers=FETCH_WORKERS,
+        requests_per_sec=GENIUS_SEARCHES_PER_SEC,
     )
 
     # add new columns
@@ -329,69 +416,64 @@ def fetch_lyrics(df: pd.DataFrame, genius_token: str) -> pd.DataFrame:
         if col not in df.columns:
             df[col] = default
 
-    # extract all classes
+    # most of the data has a bad quality, so the names of the artist and track need to be normalized with some techniques
+    artists: pd.Series = first_column(df, ["artist", "Artist"]).astype(str).map(normalize_text)
+    tracks: pd.Series = first_column(df, ["track", "Track", "Song Name"]).astype(str).map(normalize_text)
+
+    available: pd.Series = df["lyrics_available"].eq(True)
+    pending: pd.Series = df["Classname"].notna() & ~available & (artists != "") & (tracks != "")
+    if searched_rows is not None:
+        pending &= ~df.index.isin(searched_rows)
+
+    # lyrics per class, the songs with lyrics from an earlier run count for the quota
     classes = df["Classname"].dropna().unique()
-    class_counters = {cls: 0 for cls in classes}
-
-    # collect songs per class
-    class_groups = {cls: df[df["Classname"] == cls].index.tolist() for cls in classes}
-
-    more_songs = True
-    while more_songs:
-        more_songs = False
-        for cls in classes:
-            # Indexliste der Songs dieser Klasse filtern, die noch keine Lyrics haben
-            pending = [idx for idx in class_groups[cls] if not df.at[idx, "lyrics_available"]]
-            if not pending:
-                continue
-
-            more_songs = True  # there are still songs left
-            idx = pending[0]  # take next song for class
-            row = df.loc[idx]
-            artist = str(row.get("artist", row.get("Artist", "")))
-            track = str(row.get("track", row.get("Track", row.get("Song Name", ""))))
-
-            # most of the data has a bad quality, so the names of the artist and track need to be normalized with some techniques
-            artist = normalize_text(artist)
-            track  = normalize_text(track)
-
-            if not artist or not track:
-                continue
-
-            print(f"Checking lyrics ({cls}): {artist} – {track}")
-
-            try:
-                song: Song | None = genius.search_song(track, artist)
-            except Exception as e:
-                err_msg = str(e)
-                if "429" in err_msg or "error code: 1015" in err_msg:
-                    try:
-                        print(err_msg)
-                        retry_after = int(err_msg.split("Retry-After': '")[1].split("'")[0])
-                        minutes = retry_after // 60
-                        seconds = retry_after % 60
-                        print(f"Rate limit reached! Retry after {retry_after} seconds (~{minutes} min {seconds} sec).")
-                    except Exception:
-                        print("Rate limit reached! Retry-After konnte nicht ausgelesen werden.")
-                    df.to_csv(CSV_OUTPUT_FILE, index=False)
-                    raise SystemExit("Rate Limit reached, stopping execution.")
-                else:
-                    print("  Genius error:", e)
-                    continue
-
-            if song and song.lyrics and song.lyrics.strip():
-                lyrics_text = song.lyrics.strip()
-                df.at[idx, "lyrics_available"] = True
-                df.at[idx, "lyrics_length"] = len(lyrics_text)
-                df.at[idx, "lyrics"] = lyrics_text
-                class_counters[cls] += 1
-                print(f"✔ Lyrics found ({class_counters[cls]} for class {cls})")
-            else:
-                df.at[idx, "lyrics_available"] = False
-                df.at[idx, "lyrics_length"] = 0
-                df.at[idx, "lyrics"] = ""
-                print(f"✘ No lyrics for {cls}")
+    class_counters: dict[str, int] = {cls: 0 for cls in classes}
+    class_counters.update(df.loc[available, "Classname"].value_counts().to_dict())
+
+    # one work queue per class, built once
+    class_queues: dict[str, deque[Hashable]] = {cls: deque() for cls in classes}
+    pending_classes: pd.Series = df.loc[pending, "Classname"]
+    for cls, indices in pending_classes.groupby(pending_classes, observed=True).groups.items():
+        class_queues[cls].extend(indices)
+
+    print(
+        f"Fetching lyrics for up to {int(pending.sum())} songs "
+        f"({FETCH_WORKERS} threads, quota per class: {songs_per_class}, cache: {LYRICS_CACHE_PATH})"
+    )
+
+    # the classes take turns, so an interrupted run is still balanced
+    scheduled: list[Hashable] = []
 
+    def songs() -> Iterator[tuple[str, str]]:
+        for _, idx in class_balanced_order(class_queues, class_counters, songs_per_class):
+            scheduled.append(idx)
+            yield artists[idx], tracks[idx]
+
+    # the results arrive in the order the searches finish, the dataframe and the counters are only written in this thread
+    for result in fetcher.fetch(songs()):
+        idx = scheduled[result.index]
+        cls = df.at[idx, "Classname"]
+
+        if result.error is not None:
+            print(f"  Genius error ({result.artist} – {result.track}):", result.error)
+            continue
+
+        if result_log is not None:
+            result_log.append(int(idx), result.lyrics)
+
+        if result.lyrics:
+            df.at[idx, "lyrics_available"] = True
+            df.at[idx, "lyrics_length"] = len(result.lyrics)
+            df.at[idx, "lyrics"] = result.lyrics
+            class_counters[cls] += 1
+            print(f"✔ Lyrics found ({class_counters[cls]} for class {cls}): {result.artist} – {result.track}")
+        else:
+            df.at[idx, "lyrics_available"] = False
+            df.at[idx, "lyrics_length"] = 0
+            df.at[idx, "lyrics"] = ""
+            print(f"✘ No lyrics for {cls}: {result.artist} – {result.track}")
+
+    print(f"Searched {len(scheduled)} songs, lyrics per class: {class_counters}")
     return df
 
 # path = kagglehub.dataset_download("ziya07/ai-powered-music-recommendation-system")
@@ -404,47 +486,52 @@ def main() -> None:
 
     df = pd.read_csv(csv_file)
 
-    if CSV_OUTPUT_FILE.exists():
-        print(f"Resuming from existing CSV: {CSV_OUTPUT_FILE}")
-        df_existing = pd.read_csv(CSV_OUTPUT_FILE)
-        df = df_existing.combine_first(df)
+    if CSV_OUTPUT_FILE.exists() and not RESULTS_LOG_FILE.exists():
+        # csv of a run before the result log, its lyrics become the first lines of the log
+        df_existing = pd.read_csv(CSV_OUTPUT_FILE, usecols=["lyrics_available", "lyrics"])
+        found = df_existing[df_existing["lyrics_available"].eq(True)]
+        with LyricsResultLog(RESULTS_LOG_FILE) as result_log:
+            for row, lyrics in found["lyrics"].items():
+                result_log.append(int(row), lyrics)
 
+    # resume: only the results of the log are written into the dataset, no merge of two full dataframes
+    results: pd.DataFrame = read_lyrics_results(RESULTS_LOG_FILE)
+    apply_lyrics_results(df, results)
+    if not results.empty:
+        print(f"Resuming with {len(results)} searched songs from {RESULTS_LOG_FILE}")
 
     if "seeds" not in df.columns:
             raise ValueError(
                 f"'seeds' column not found. Available columns: {list(df.columns)}"
             )
 
-    all_seeds: set[str] = set()
-
-    for entry in df["seeds"].dropna():
-        if isinstance(entry, str):
-            try:
-                seed_list = ast.literal_eval(entry)
-                if isinstance(seed_list, list):
-                    all_seeds.update(seed_list)
-            except Exception:
-                continue
-
-    seeds = sorted(all_seeds)
+    df["Classname"], seeds = seeds_to_labels(df["seeds"])
 
     print("\nFound seed categories:\n")
     for seed in seeds:
         print(seed)
 
     print(f"\nTotal number of seed categories: {len(seeds)}")
-
-    df["Classname"] = df["seeds"].apply(map_seeds_to_label)
+    print(f"Songs without a known seed: {df['Classname'].isna().sum()}")
 
     load_dotenv(ENV_PATH)
     genius_token = os.getenv("GENIUS_CLIENT_ACCESS_TOKEN")
     if not genius_token:
         raise RuntimeError("GENIUS_CLIENT_ACCESS_TOKEN missing in .env")
 
-    df = fetch_lyrics(df, genius_token)
-
-    df.to_csv(CSV_OUTPUT_FILE, index=False)
-    print(f"\nDone. CSV saved: {CSV_OUTPUT_FILE.resolve()}")
+    try:
+        with LyricsResultLog(RESULTS_LOG_FILE) as result_log:
+            df = fetch_lyrics(
+                df,
+                genius_token,
+                songs_per_class=SONGS_PER_CLASS,
+                result_log=result_log,
+                searched_rows=results.index,
+            )
+    finally:
+        # also after a crash or ctrl+c, the log already holds every finished song
+        compact_lyrics_results(df, CSV_OUTPUT_FILE)
+        print(f"\nDone. CSV saved: {CSV_OUTPUT_FILE.resolve()}")
 
 if __name__ == "__main__":
     main()
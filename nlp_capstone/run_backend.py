@@ -1,5 +1,7 @@
+import os
+
 from flask import Flask, send_from_directory, request
-from backend.app.api.routes import api_bp
+from backend.app.api.routes import api_bp, start_warmup
 
 from pathlib import Path
 from dotenv import load_dotenv
@@ -8,6 +10,7 @@ import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 
 ENV_PATH: Path = Path('.env')
+DEBUG: bool = True
 
 def main() -> None:
     
@@ -22,6 +25,10 @@ def main() -> None:
 
     app.register_blueprint(api_bp, url_prefix="/api")
 
+    # with the debug reloader main() runs in two processes, the model is only loaded in the serving one
+    if not DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warmup()
+
     @app.route('/spsearch')
     def spotify_search(): #proxy for spotify web api search that returns URI of top result
         artist = request.args.get('artist')
@@ -39,7 +46,7 @@ def main() -> None:
 
     print("Starting Flask server...")
 
-    app.run(debug=True)
+    app.run(debug=DEBUG)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import pandas as pd
+import torch
+from pandas import DataFrame
+
+from bert_train import BATCH_SIZE, FEATURE_CACHE_DIR, LABELS, TOKEN_CACHE_DIR, load_splits, set_seed
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.chunk_feature_cache import ChunkFeatureCache, feature_cache_fingerprint
+from utils.head_training import sweep_heads
+
+# head-only sweep on the cached chunk features of a frozen encoder, only the first run has to encode the songs
+MODEL_SOURCE: str | Path = "xlm-roberta-base" # a model name or the path of a saved (e.g. dapt) model
+CSV_DIR: Path = Path("song_labels/processed")
+REPORT_PATH: Path = Path("cache/head_sweep.csv")
+LEARNING_RATES: list[float] = [1e-4, 3e-4, 1e-3, 3e-3]
+USE_MAX_POOLING: list[bool] = [True, False]
+USE_CLASS_WEIGHTS: list[bool] = [True, False]
+EPOCHS: int = 100
+
+
+def main() -> None:
+    set_seed()
+    device: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Device:", device)
+
+    X_train, X_val, y_train, y_val = load_splits(CSV_DIR)
+    train_texts: list[str] = X_train.tolist()
+    val_texts: list[str] = X_val.tolist()
+
+    model_config: BertForLyricsConfig = BertForLyricsConfig(
+        model_name="xlm-roberta-base",
+        num_labels=len(LABELS),
+        chunk_size=510,
+        stride=256,
+        token_cache_dir=TOKEN_CACHE_DIR,
+    )
+    model: BertForLyrics = (
+        BertForLyrics.load_model(path=MODEL_SOURCE, config=model_config, device=device)
+        if Path(MODEL_SOURCE).exists()
+        else BertForLyrics(config=model_config, device=device).to(device)
+    )
+    model.eval()
+
+    cache: ChunkFeatureCache = ChunkFeatureCache(FEATURE_CACHE_DIR, feature_cache_fingerprint(MODEL_SOURCE, model))
+    cache.build(model, train_texts + val_texts, batch_size=BATCH_SIZE)
+
+    results: list[dict] = sweep_heads(
+        x_train_per_pooling={pooling: cache.pooled(train_texts, pooling) for pooling in USE_MAX_POOLING},
+        y_train=torch.tensor(y_train.tolist(), dtype=torch.long),
+        x_val_per_pooling={pooling: cache.pooled(val_texts, pooling) for pooling in USE_MAX_POOLING},
+        y_val=torch.tensor(y_val.tolist(), dtype=torch.long),
+        num_labels=len(LABELS),
+        learning_rates=LEARNING_RATES,
+        use_class_weights=USE_CLASS_WEIGHTS,
+        epochs=EPOCHS,
+    )
+
+    report: DataFrame = pd.DataFrame(results).sort_values("val_loss")
+    print(report.to_string(index=False, float_format="%.4f"))
+
+    REPORT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    report.to_csv(REPORT_PATH, index=False)
+    print(f"Report saved to {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import json
+from pathlib import Path
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast
+
+from benchmark_forward import load_lyrics
+from export_onnx import CSV_DIR, MAX_ABS_DIFF, MODEL_NAME, MODEL_PATH, NUM_LABELS, onnx_parity
+from utils.bert_for_lyrics import BertForLyrics, BertForLyricsConfig
+from utils.onnx_lyrics_model import FastTokenizer
+from utils.token_cache import tokenize_with_cache
+
+# python -m pytest test_onnx_parity.py
+# the model test needs the trained model and its export (python export_onnx.py), it is skipped without them
+
+
+def save_tiny_tokenizer(path: Path) -> None:
+    vocab: dict[str, int] = {"<s>": 0, "<pad>": 1, "</s>": 2, "<unk>": 3}
+    for word in "hello world the song love me you".split():
+        vocab[word] = len(vocab)
+
+    tokenizer: Tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A </s>",
+        special_tokens=[("<s>", 0), ("</s>", 2)],
+    )
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        cls_token="<s>",
+        sep_token="</s>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+    ).save_pretrained(path)
+
+
+def test_fast_tokenizer_matches_transformers(tmp_path: Path) -> None:
+    save_tiny_tokenizer(tmp_path)
+    texts: list[str] = ["hello world the song", "love me you unknown", ""]
+
+    reference = PreTrainedTokenizerFast.from_pretrained(tmp_path)
+    tokenizer: FastTokenizer = FastTokenizer(tmp_path)
+
+    assert tokenize_with_cache(tokenizer, texts, None) == tokenize_with_cache(reference, texts, None)
+    assert tokenizer(texts)["input_ids"] == reference(texts)["input_ids"]
+    assert (tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id) == (
+        reference.cls_token_id,
+        reference.sep_token_id,
+        reference.pad_token_id,
+    )
+
+
+def test_fast_tokenizer_reads_special_tokens_map(tmp_path: Path) -> None:
+    save_tiny_tokenizer(tmp_path)
+    config_path: Path = tmp_path / "tokenizer_config.json"
+    config: dict = json.loads(config_path.read_text(encoding="utf-8"))
+    special_tokens: dict = {name: {"content": config.pop(name)} for name in ("cls_token", "sep_token", "pad_token")}
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+    (tmp_path / "special_tokens_map.json").write_text(json.dumps(special_tokens), encoding="utf-8")
+
+    tokenizer: FastTokenizer = FastTokenizer(tmp_path)
+
+    assert (tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id) == (0, 2, 1)
+
+
+@pytest.mark.skipif(
+    not (MODEL_PATH / "onnx" / "encoder.onnx").exists(),
+    reason=f"no exported model in {MODEL_PATH / 'onnx'}, run export_onnx.py first",
+)
+def test_onnx_matches_torch() -> None:
+    model: BertForLyrics = BertForLyrics.load_model(
+        path=MODEL_PATH,
+        config=BertForLyricsConfig(model_name=MODEL_NAME, num_labels=NUM_LABELS, chunk_size=510, stride=256),
+        device=torch.device("cpu"),
+    )
+
+    parity: dict[str, float] = onnx_parity(model, MODEL_PATH, load_lyrics(CSV_DIR, 10))
+
+    assert parity["embeddings"] <= MAX_ABS_DIFF
+    assert parity["logits"] <= MAX_ABS_DIFF
+    assert parity["label_agreement"] == 1.0
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from collections.abc import Callable
+from contextlib import nullcontext
 from pathlib import Path
 
 import torch
@@ -8,27 +9,41 @@ from torch.nn import Dropout, Linear
 from transformers import (
     BertModel,
     BertTokenizer,
+    BertTokenizerFast,
     DistilBertModel,
     DistilBertTokenizer,
+    DistilBertTokenizerFast,
     XLMRobertaModel,
     XLMRobertaTokenizer,
+    XLMRobertaTokenizerFast,
     PreTrainedTokenizerBase,
     PreTrainedModel,
 )
 from transformers.modeling_outputs import BaseModelOutputWithPoolingAndCrossAttentions
 
+from utils.bert_for_lyrics_config import BertForLyricsConfig, InferenceMode
+from utils.chunking import split_into_chunks
+from utils.token_cache import TokenCache, tokenize_with_cache, tokenizer_cache_name
 
-@dataclass
-class BertForLyricsConfig:
-    num_labels: int
-    model_name: str
-    chunk_size: int
-    stride: int  # overlab between the chunks
-    use_max_pooling: bool = True
 
-type TokenizerType = BertTokenizer | DistilBertTokenizer | XLMRobertaTokenizer | PreTrainedTokenizerBase
+type TokenizerType = (
+    BertTokenizer | BertTokenizerFast
+    | DistilBertTokenizer | DistilBertTokenizerFast
+    | XLMRobertaTokenizer | XLMRobertaTokenizerFast
+    | PreTrainedTokenizerBase
+)
 type ModelType = BertModel | DistilBertModel | XLMRobertaModel | PreTrainedModel
 
+class _CLSEncoder(nn.Module):
+    """encoder wrapper for the onnx export, only the [CLS] vectors leave the graph"""
+
+    def __init__(self, bert: ModelType):
+        super().__init__()
+        self.bert: ModelType = bert
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.bert(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0, :]
+
 # todo: pretraining on other song labels
 class BertForLyrics(nn.Module):
     def __init__(
@@ -43,70 +58,52 @@ class BertForLyrics(nn.Module):
         self.dropout: Dropout = nn.Dropout(0.3)
         self.classifier: Linear
         self.config: BertForLyricsConfig = config
+        self.token_cache: TokenCache | None = None
+        self.inference_mode: InferenceMode = "fp32"
+
+        fast: bool = self.config.use_fast_tokenizer
 
         match self.config.model_name:
             case "distilbert-base-multilingual-cased":
                 self.bert = DistilBertModel.from_pretrained(self.config.model_name)
-                self.tokenizer = DistilBertTokenizer.from_pretrained(self.config.model_name)
+                tokenizer_cls = DistilBertTokenizerFast if fast else DistilBertTokenizer
+                self.tokenizer = tokenizer_cls.from_pretrained(self.config.model_name)
             case " bert-base-multilingual-cased":
                 self.bert = BertModel.from_pretrained(self.config.model_name)
-                self.tokenizer = BertTokenizer.from_pretrained(self.config.model_name)
+                tokenizer_cls = BertTokenizerFast if fast else BertTokenizer
+                self.tokenizer = tokenizer_cls.from_pretrained(self.config.model_name)
             case "xlm-roberta-base" | "xlm-roberta-large":
                 self.bert = XLMRobertaModel.from_pretrained(self.config.model_name)
-                self.tokenizer = XLMRobertaTokenizer.from_pretrained(self.config.model_name)
+                tokenizer_cls = XLMRobertaTokenizerFast if fast else XLMRobertaTokenizer
+                self.tokenizer = tokenizer_cls.from_pretrained(self.config.model_name)
             case _:
                 raise ModuleNotFoundError(f"model name {self.config.model_name} is not supported")
 
         hidden_size: int = self.bert.config.hidden_size # most time 768
         self.classifier = nn.Linear(hidden_size, self.config.num_labels)
+        self._init_token_cache()
 
     def forward(self, texts: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
-        all_embeddings: list[torch.Tensor] = []
-
         if self.config.chunk_size > self.tokenizer.model_max_length - 2:  # -2 cause of the [CLS] and [SEP] token
             raise ValueError(f"chunk size {self.config.chunk_size} is too large")
 
-        for text in texts:
-            tokens: list[str] = self.tokenizer.tokenize(text)
-            input_ids: list[int] = self.tokenizer.convert_tokens_to_ids(tokens)
-
-            chunk_embeddings: list[torch.Tensor] = []
-
-            for start in range(0, len(input_ids), self.config.stride):
-                chunk_ids: list[int] = input_ids[start:start + self.config.chunk_size]
-
-                if len(chunk_ids) == 0:
-                    continue
-
-                chunk_ids = (
-                        [self.tokenizer.cls_token_id]
-                        + chunk_ids
-                        + [self.tokenizer.sep_token_id]
-                )
-
-                attention_mask: list[int] = [1] * len(chunk_ids)
+        chunks_per_text: list[list[list[int]]] = [
+            self._split_into_chunks(input_ids)
+            for input_ids in self.tokenize_texts(texts)
+        ]
 
-                chunk_ids: torch.Tensor = (
-                    torch.tensor(chunk_ids)
-                    .unsqueeze(0)
-                    .to(self.device)
-                )
-                attention_mask: torch.Tensor = (
-                    torch.tensor(attention_mask)
-                    .unsqueeze(0).
-                    to(self.device)
-                )
-
-                outputs: BaseModelOutputWithPoolingAndCrossAttentions = self.bert( # BaseModelOutputWithPoolingAndCrossAttentions is just the type for the xlm-roberta output
-                    input_ids=chunk_ids,
-                    attention_mask=attention_mask
-                )
-
-                cls: torch.Tensor = outputs.last_hidden_state[:, 0, :]
-                chunk_embeddings.append(cls)
+        chunk_embeddings_per_text: list[torch.Tensor]
+        if self.config.use_batched_forward:
+            chunk_embeddings_per_text = self._encode_chunks_batched(chunks_per_text)
+        else:
+            chunk_embeddings_per_text = [
+                self._encode_chunks(chunks)
+                for chunks in chunks_per_text
+            ]
 
-            chunk_embeddings: torch.Tensor = torch.cat(chunk_embeddings, dim=0)
+        all_embeddings: list[torch.Tensor] = []
 
+        for chunk_embeddings in chunk_embeddings_per_text:
             # max pooling or mean pooling over all chunks --> song_embedding = chunk_embeddings.mean(dim=0)
             if self.config.use_max_pooling:
                 song_embedding: torch.Tensor = torch.max(chunk_embeddings, dim=0).values
@@ -121,6 +118,238 @@ class BertForLyrics(nn.Module):
         logits: torch.Tensor = self.classifier(self.dropout(embeddings))
         return logits, embeddings
 
+    def forward_chunks(
+            self,
+            input_ids: torch.Tensor,
+            attention_mask: torch.Tensor,
+            text_index: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        forward pass over already chunked and padded token ids (see utils.lyrics_dataset.collate_chunks),
+        the chunks should be sorted by length, every encoder call is cut to the longest chunk of its rows
+
+        input_ids, attention_mask: (num_chunks, max_len), text_index: (num_chunks,) song of every chunk
+        """
+        input_ids = input_ids.to(self.device, non_blocking=True)
+        attention_mask = attention_mask.to(self.device, non_blocking=True)
+        text_index = text_index.to(self.device, non_blocking=True)
+        lengths: torch.Tensor = attention_mask.sum(dim=1)
+
+        cls_vectors: list[torch.Tensor] = []
+        for start in range(0, len(input_ids), self.config.max_chunks_per_call):
+            end: int = start + self.config.max_chunks_per_call
+            max_len: int = int(lengths[start:end].max())
+            cls_vectors.append(self._encode_cls(input_ids[start:end, :max_len], attention_mask[start:end, :max_len]))
+
+        # (num_chunks, hidden_size)
+        chunk_embeddings: torch.Tensor = torch.cat(cls_vectors)
+        num_texts: int = int(text_index.max()) + 1
+
+        # max pooling or mean pooling over the chunks of every song
+        # (batch_size, hidden_size)
+        embeddings: torch.Tensor = torch.zeros(
+            (num_texts, chunk_embeddings.shape[1]),
+            dtype=chunk_embeddings.dtype,
+            device=chunk_embeddings.device,
+        ).scatter_reduce(
+            0,
+            text_index.unsqueeze(1).expand_as(chunk_embeddings),
+            chunk_embeddings,
+            reduce="amax" if self.config.use_max_pooling else "mean",
+            include_self=False,
+        )
+
+        # (batch_size, num_labels)
+        logits: torch.Tensor = self.classifier(self.dropout(embeddings))
+        return logits, embeddings
+
+    @torch.no_grad()
+    def encode_chunk_features(self, texts: list[str]) -> list[torch.Tensor]:
+        """
+        the [CLS] vectors of all chunks before the pooling, one (num_chunks, hidden_size) tensor per text,
+        with a frozen encoder they only have to be computed once (see utils.chunk_feature_cache)
+        model.eval() is up to the caller
+        """
+        chunks_per_text: list[list[list[int]]] = [
+            self._split_into_chunks(input_ids)
+            for input_ids in self.tokenize_texts(texts)
+        ]
+        return self._encode_chunks_batched(chunks_per_text)
+
+    @torch.no_grad()
+    def predict_batch(
+            self,
+            texts: list[str],
+            batch_size: int = 8,
+            on_progress: Callable[[int, int], None] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        inference over many texts in micro batches, the texts are sorted by their token length first,
+        so the songs in one micro batch have a similar number of chunks and less padding is needed
+        the outputs are returned in the order of the input texts, model.eval() is up to the caller
+        on_progress is called after every micro batch with (done texts, total texts)
+
+        Returns:
+        - logits (num_texts, num_labels)
+        - embeddings (num_texts, hidden_size)
+        """
+        if not texts:
+            raise ValueError("No texts to predict")
+
+        lengths: list[int] = [len(input_ids) for input_ids in self.tokenize_texts(texts)]
+        order: list[int] = sorted(range(len(texts)), key=lambda i: lengths[i])
+
+        all_logits: list[torch.Tensor] = []
+        all_embeddings: list[torch.Tensor] = []
+
+        for start in range(0, len(order), batch_size):
+            batch_indices: list[int] = order[start:start + batch_size]
+            logits, embeddings = self([texts[i] for i in batch_indices])
+            all_logits.append(logits)
+            all_embeddings.append(embeddings)
+
+            if on_progress is not None:
+                on_progress(start + len(batch_indices), len(texts))
+
+        # position of every input text in the sorted outputs
+        inverse: torch.Tensor = torch.empty(len(order), dtype=torch.long)
+        inverse[torch.tensor(order)] = torch.arange(len(order))
+        inverse = inverse.to(self.device)
+
+        return torch.cat(all_logits)[inverse], torch.cat(all_embeddings)[inverse]
+
+    def _init_token_cache(self) -> None:
+        if self.config.token_cache_dir is None:
+            self.token_cache = None
+            return
+
+        # the ids depend on the vocabulary, so every tokenizer gets its own cache directory
+        self.token_cache = TokenCache(self.config.token_cache_dir, tokenizer_cache_name(self.tokenizer))
+
+    def tokenize_texts(self, texts: list[str]) -> list[list[int]]:
+        """token ids without special tokens for every text, cached texts skip the tokenizer completely"""
+        return tokenize_with_cache(self.tokenizer, texts, self.token_cache)
+
+    def _split_into_chunks(self, input_ids: list[int]) -> list[list[int]]:
+        return split_into_chunks(
+            input_ids,
+            chunk_size=self.config.chunk_size,
+            stride=self.config.stride,
+            cls_token_id=self.tokenizer.cls_token_id,
+            sep_token_id=self.tokenizer.sep_token_id,
+        )
+
+    def _encode_cls(self, chunk_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """one encoder call, returns the [CLS] vectors (batch_size, hidden_size) in fp32"""
+        # no autocast context for the other modes, so a surrounding autocast of the training loop stays active
+        autocast = (
+            torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+            if self.inference_mode == "bf16"
+            else nullcontext()
+        )
+        with autocast:
+            outputs: BaseModelOutputWithPoolingAndCrossAttentions = self.bert( # BaseModelOutputWithPoolingAndCrossAttentions is just the type for the xlm-roberta output
+                input_ids=chunk_ids,
+                attention_mask=attention_mask
+            )
+
+        # pooling and the classifier always run in fp32
+        return outputs.last_hidden_state[:, 0, :].float()
+
+    def set_inference_mode(self, mode: InferenceMode) -> None:
+        """
+        switches the encoder to bf16 autocast or dynamic int8 quantization for faster cpu inference,
+        the quantization replaces the Linear layers of the encoder, so it can not be undone and is only meant for serving
+        """
+        match mode:
+            case "fp32" | "bf16":
+                if self.inference_mode == "int8":
+                    raise ValueError("an int8 quantized model can not be switched back, load it again")
+            case "int8":
+                if self.device.type != "cpu":
+                    raise ValueError("dynamic int8 quantization is only supported on cpu")
+                if self.inference_mode != "int8":
+                    self.bert = torch.ao.quantization.quantize_dynamic(
+                        self.bert,
+                        {nn.Linear},
+                        dtype=torch.qint8,
+                    )
+            case _:
+                raise ValueError(f"inference mode {mode} is not supported")
+
+        self.inference_mode = mode
+
+    def _encode_chunks(self, chunks: list[list[int]]) -> torch.Tensor:
+        """one encoder call per chunk with batch size 1, returns (num_chunks, hidden_size)"""
+        chunk_embeddings: list[torch.Tensor] = []
+
+        for chunk in chunks:
+            attention_mask: list[int] = [1] * len(chunk)
+
+            chunk_ids: torch.Tensor = (
+                torch.tensor(chunk)
+                .unsqueeze(0)
+                .to(self.device)
+            )
+            attention_mask: torch.Tensor = (
+                torch.tensor(attention_mask)
+                .unsqueeze(0)
+                .to(self.device)
+            )
+
+            cls: torch.Tensor = self._encode_cls(chunk_ids, attention_mask)
+            chunk_embeddings.append(cls)
+
+        return torch.cat(chunk_embeddings, dim=0)
+
+    def _encode_chunks_batched(self, chunks_per_text: list[list[list[int]]]) -> list[torch.Tensor]:
+        """
+        encodes the chunks of all texts together in padded batches of at most max_chunks_per_call chunks
+        and scatters the [CLS] vectors back to their texts, returns one (num_chunks, hidden_size) tensor per text
+        """
+        # (text index, chunk) for every chunk of every text
+        flat_chunks: list[tuple[int, list[int]]] = [
+            (text_idx, chunk)
+            for text_idx, chunks in enumerate(chunks_per_text)
+            for chunk in chunks
+        ]
+
+        # chunks with a similar length share one call, so less padding is needed
+        order: list[int] = sorted(range(len(flat_chunks)), key=lambda i: len(flat_chunks[i][1]))
+        cls_vectors: list[torch.Tensor | None] = [None] * len(flat_chunks)
+
+        for start in range(0, len(order), self.config.max_chunks_per_call):
+            batch_indices: list[int] = order[start:start + self.config.max_chunks_per_call]
+            max_len: int = max(len(flat_chunks[i][1]) for i in batch_indices)
+
+            chunk_ids: torch.Tensor = torch.full(
+                (len(batch_indices), max_len),
+                self.tokenizer.pad_token_id,
+                dtype=torch.long,
+            )
+            attention_mask: torch.Tensor = torch.zeros_like(chunk_ids)
+
+            for row, i in enumerate(batch_indices):
+                chunk: list[int] = flat_chunks[i][1]
+                chunk_ids[row, :len(chunk)] = torch.tensor(chunk, dtype=torch.long)
+                attention_mask[row, :len(chunk)] = 1
+
+            cls: torch.Tensor = self._encode_cls(
+                chunk_ids.to(self.device),
+                attention_mask.to(self.device),
+            )
+            for row, i in enumerate(batch_indices):
+                cls_vectors[i] = cls[row]
+
+        chunk_embeddings_per_text: list[list[torch.Tensor]] = [[] for _ in chunks_per_text]
+        for (text_idx, _), cls in zip(flat_chunks, cls_vectors):
+            chunk_embeddings_per_text[text_idx].append(cls)
+
+        return [
+            torch.stack(chunk_embeddings)
+            for chunk_embeddings in chunk_embeddings_per_text
+        ]
+
     def save_model(self, path: Path | str) -> None:
         save_dir: Path = path / self.config.model_name
         save_dir.mkdir(parents=True, exist_ok=True)
@@ -136,12 +365,58 @@ class BertForLyrics(nn.Module):
         )
         print(f"Model saved to {save_dir}")
 
+    def export_onnx(self, output_dir: Path, opset_version: int = 17) -> None:
+        """
+        exports the encoder (chunk ids -> [CLS] vectors) and the classifier head as two onnx graphs
+        with dynamic batch and sequence axes, the chunk pooling between them runs outside of the graphs
+        """
+        if self.inference_mode != "fp32":
+            raise ValueError("only the fp32 model can be exported")
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        self.eval()
+
+        dummy_ids: torch.Tensor = torch.full((2, 16), self.tokenizer.cls_token_id, dtype=torch.long, device=self.device)
+        dummy_mask: torch.Tensor = torch.ones_like(dummy_ids)
+
+        torch.onnx.export(
+            _CLSEncoder(self.bert).eval(),
+            (dummy_ids, dummy_mask),
+            output_dir / "encoder.onnx",
+            input_names=["input_ids", "attention_mask"],
+            output_names=["cls"],
+            dynamic_axes={
+                "input_ids": {0: "chunks", 1: "sequence"},
+                "attention_mask": {0: "chunks", 1: "sequence"},
+                "cls": {0: "chunks"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+        dummy_embeddings: torch.Tensor = torch.zeros((2, self.bert.config.hidden_size), device=self.device)
+        torch.onnx.export(
+            self.classifier,
+            (dummy_embeddings,),
+            output_dir / "classifier.onnx",
+            input_names=["embeddings"],
+            output_names=["logits"],
+            dynamic_axes={
+                "embeddings": {0: "songs"},
+                "logits": {0: "songs"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        print(f"ONNX model exported to {output_dir}")
+
     @classmethod
     def load_model(
             cls,
             path: Path | str,
             config: BertForLyricsConfig,
             device: torch.device,
+            inference_mode: InferenceMode = "fp32",
     ) -> 'BertForLyrics':
 
         if not path.exists():
@@ -157,6 +432,7 @@ class BertForLyrics(nn.Module):
 
         # load tokenizer
         model.tokenizer = model.tokenizer.from_pretrained(path)
+        model._init_token_cache()
 
         # load classifier
         classifier_path: Path = path / "classifier.pt"
@@ -171,6 +447,7 @@ class BertForLyrics(nn.Module):
             print("Warning: classifier.pt not found. Classifier initialized randomly!")
 
         model.to(device)
+        model.set_inference_mode(inference_mode)
 
-        print(f"Model loaded from {path}")
+        print(f"Model loaded from {path} ({inference_mode})")
         return model
\ No newline at end of file
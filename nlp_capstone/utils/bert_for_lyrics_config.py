@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+# no torch or transformers import here, the backend with the onnx runtime only needs the config
+
+
+@dataclass
+class BertForLyricsConfig:
+    num_labels: int
+    model_name: str
+    chunk_size: int
+    stride: int  # overlab between the chunks
+    use_max_pooling: bool = True
+    use_batched_forward: bool = True  # encode the chunks of all texts together instead of one chunk per call
+    max_chunks_per_call: int = 32  # upper bound for the number of chunks in one encoder call
+    use_fast_tokenizer: bool = True  # rust backed tokenizer from the tokenizers library
+    token_cache_dir: Path | None = None  # on-disk cache of the token ids, None disables the cache
+
+
+# fp32: full precision, bf16: autocast of the encoder, int8: dynamic quantization of the encoder Linear layers (cpu only)
+type InferenceMode = Literal["fp32", "bf16", "int8"]
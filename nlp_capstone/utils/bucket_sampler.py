@@ -0,0 +1,85 @@
+import math
+from collections.abc import Iterator
+
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler[list[int]]):
+    """
+    batches of songs with a similar length (e.g. number of chunks), so one long song does not slow down a whole batch
+
+    every epoch the songs are shuffled, split into pools of batch_size * bucket_size_multiplier songs,
+    every pool is sorted by length and cut into batches and finally the order of all batches is shuffled
+    every song is still used exactly once per epoch, only the composition of the batches changes
+
+    for distributed training every rank (of num_replicas) takes every num_replicas-th batch of the same epoch order,
+    the first batches are repeated (cyclically) so that every rank gets the same number of batches
+    """
+
+    def __init__(
+            self,
+            lengths: list[int],
+            batch_size: int,
+            bucket_size_multiplier: int = 20,
+            drop_last: bool = False,
+            seed: int = 42,
+            num_replicas: int = 1,
+            rank: int = 0,
+    ):
+        self.lengths: list[int] = lengths
+        self.batch_size: int = batch_size
+        self.pool_size: int = batch_size * bucket_size_multiplier
+        self.drop_last: bool = drop_last
+        self.seed: int = seed
+        self.num_replicas: int = num_replicas
+        self.rank: int = rank
+        self.epoch: int = 0
+        self.start_batch: int = 0
+        # the epoch was already iterated, the next __iter__ without set_epoch starts a new epoch
+        self._iterated: bool = False
+
+    def set_epoch(self, epoch: int, start_batch: int = 0) -> None:
+        """start_batch: batches of the epoch that are skipped, to resume a run from a checkpoint"""
+        self.epoch = epoch
+        self.start_batch = start_batch
+        self._iterated = False
+
+    def __iter__(self) -> Iterator[list[int]]:
+        # the next epoch gets a new order, even without set_epoch
+        # start_batch stays until then, the DataLoader asks for len() while the (resumed) epoch is running
+        if self._iterated:
+            self.epoch += 1
+            self.start_batch = 0
+        self._iterated = True
+
+        generator: torch.Generator = torch.Generator().manual_seed(self.seed + self.epoch)
+
+        indices: list[int] = torch.randperm(len(self.lengths), generator=generator).tolist()
+        batches: list[list[int]] = []
+
+        for start in range(0, len(indices), self.pool_size):
+            pool: list[int] = sorted(indices[start:start + self.pool_size], key=lambda i: self.lengths[i])
+
+            for batch_start in range(0, len(pool), self.batch_size):
+                batch: list[int] = pool[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        order: list[int] = torch.randperm(len(batches), generator=generator).tolist()
+        # cyclic padding like DistributedSampler, also with fewer batches than processes
+        total: int = math.ceil(len(order) / self.num_replicas) * self.num_replicas
+        if order:
+            order = (order * math.ceil(total / len(order)))[:total]
+
+        for i in order[self.rank::self.num_replicas][self.start_batch:]:
+            yield batches[i]
+
+    def __len__(self) -> int:
+        """batches of this rank that are left in the current epoch"""
+        full_pools, rest = divmod(len(self.lengths), self.pool_size)
+        if self.drop_last:
+            num_batches: int = full_pools * (self.pool_size // self.batch_size) + rest // self.batch_size
+        else:
+            num_batches = full_pools * math.ceil(self.pool_size / self.batch_size) + math.ceil(rest / self.batch_size)
+        return math.ceil(num_batches / self.num_replicas) - self.start_batch
@@ -0,0 +1,184 @@
+import json
+import os
+import random
+import threading
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.optim import Optimizer
+from torch.optim.lr_scheduler import LRScheduler
+
+
+def _to_cpu(obj: Any) -> Any:
+    """copy of all tensors on the cpu, so the training can go on while the copy is written"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state() -> dict:
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def training_state(
+    model: nn.Module,
+    optimizer: Optimizer,
+    scheduler: LRScheduler | None = None,
+    **progress: Any,
+) -> dict:
+    """
+    everything that is needed for an exact resume, progress holds the position of the run
+    (e.g. epoch, batches of the epoch, global step, metrics)
+    """
+    return {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": None if scheduler is None else scheduler.state_dict(),
+        "rng": rng_state(),
+        "progress": progress,
+    }
+
+
+def restore_training_state(
+    state: dict,
+    model: nn.Module,
+    optimizer: Optimizer,
+    scheduler: LRScheduler | None = None,
+) -> dict:
+    """loads a training_state into the objects and returns the progress"""
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    if scheduler is not None and state["scheduler"] is not None:
+        scheduler.load_state_dict(state["scheduler"])
+    set_rng_state(state["rng"])
+    return state["progress"]
+
+
+class CheckpointManager:
+    """
+    writes a checkpoint every save_every steps (and whenever save is called with a validation loss)
+    the state is copied to the cpu in the training thread and written by a background thread, so the
+    training only waits for the copy, at most one write is in flight
+    only the latest checkpoint (for the resume) and the keep_top_k checkpoints with the lowest validation loss are kept,
+    manifest.json lists them and is always written after the checkpoint file
+    without resume the checkpoints of an earlier run in checkpoint_dir are removed, so load_best
+    only returns checkpoints of this run
+    """
+
+    MANIFEST_FILE: str = "manifest.json"
+
+    def __init__(self, checkpoint_dir: Path, save_every: int, keep_top_k: int = 3, resume: bool = True):
+        self.checkpoint_dir: Path = Path(checkpoint_dir)
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        self.save_every: int = save_every
+        self.keep_top_k: int = keep_top_k
+
+        self._thread: threading.Thread | None = None
+        self._error: BaseException | None = None
+        if not resume:
+            self._clear()
+        self.manifest: dict = self._read_manifest()
+
+    def _clear(self) -> None:
+        # the manifest first, a crash afterwards leaves files that no manifest references
+        (self.checkpoint_dir / self.MANIFEST_FILE).unlink(missing_ok=True)
+        for checkpoint_file in self.checkpoint_dir.glob("step_*.pt"):
+            checkpoint_file.unlink(missing_ok=True)
+
+    def _read_manifest(self) -> dict:
+        manifest_path: Path = self.checkpoint_dir / self.MANIFEST_FILE
+        if not manifest_path.exists():
+            return {"latest": None, "checkpoints": []}
+
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def should_save(self, step: int) -> bool:
+        return self.save_every > 0 and step % self.save_every == 0
+
+    def save(self, step: int, state: dict, val_loss: float | None = None) -> None:
+        snapshot: dict = _to_cpu(state)
+
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(step, snapshot, val_loss), daemon=True)
+        self._thread.start()
+
+    def wait(self) -> None:
+        """blocks until the pending write is finished, errors of the writer thread are raised here"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing the checkpoint failed") from error
+
+    def _write(self, step: int, snapshot: dict, val_loss: float | None) -> None:
+        try:
+            file_name: str = f"step_{step:08d}.pt"
+            tmp_path: Path = self.checkpoint_dir / f"{file_name}.{os.getpid()}.tmp"
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, self.checkpoint_dir / file_name)
+
+            checkpoints: list[dict] = [c for c in self.manifest["checkpoints"] if c["file"] != file_name]
+            checkpoints.append({"file": file_name, "step": step, "val_loss": val_loss})
+
+            best: list[dict] = sorted(
+                (c for c in checkpoints if c["val_loss"] is not None),
+                key=lambda c: c["val_loss"],
+            )[:self.keep_top_k]
+            keep: set[str] = {file_name} | {c["file"] for c in best}
+
+            manifest: dict = {
+                "latest": file_name,
+                "checkpoints": [c for c in checkpoints if c["file"] in keep],
+            }
+            tmp_manifest: Path = self.checkpoint_dir / f"{self.MANIFEST_FILE}.{os.getpid()}.tmp"
+            tmp_manifest.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+            os.replace(tmp_manifest, self.checkpoint_dir / self.MANIFEST_FILE)
+            self.manifest = manifest
+
+            # old checkpoints are only removed after the manifest does not reference them anymore
+            for c in checkpoints:
+                if c["file"] not in keep:
+                    (self.checkpoint_dir / c["file"]).unlink(missing_ok=True)
+        except BaseException as error:
+            self._error = error
+
+    def _load(self, file_name: str | None) -> dict | None:
+        if file_name is None:
+            return None
+        # the checkpoints contain the python and numpy rng states, they are our own files
+        return torch.load(self.checkpoint_dir / file_name, map_location="cpu", weights_only=False)
+
+    def load_latest(self) -> dict | None:
+        self.wait()
+        return self._load(self.manifest["latest"])
+
+    def load_best(self) -> dict | None:
+        """checkpoint with the lowest validation loss"""
+        self.wait()
+        scored: list[dict] = [c for c in self.manifest["checkpoints"] if c["val_loss"] is not None]
+        if not scored:
+            return None
+        return self._load(min(scored, key=lambda c: c["val_loss"])["file"])
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.bert_for_lyrics import BertForLyrics
+from utils.hashing import lyrics_hash
+
+
+def feature_cache_fingerprint(model_source: str | Path, model: BertForLyrics) -> str:
+    """
+    the features depend on the encoder weights and the chunking, not on the head
+    for a local model directory the weight files are identified by name, size and modification time,
+    so a retrained model (e.g. a new DAPT run into the same directory) gets new features
+    """
+    h = hashlib.sha1(f"{model_source}|{model.config.chunk_size}|{model.config.stride}".encode("utf-8"))
+
+    model_dir: Path = Path(model_source)
+    if model_dir.is_dir():
+        for file in sorted(file for file in model_dir.iterdir() if file.is_file()):
+            stat = file.stat()
+            h.update(f"{file.name}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8"))
+
+    return h.hexdigest()[:16]
+
+
+class ChunkFeatureCache:
+    """
+    [CLS] vectors of every chunk of a frozen encoder, computed once per song
+    features.npy is one memory-mapped (num_chunks, hidden_size) matrix with the chunks of all songs,
+    index.json maps the lyrics hash of a song to its rows [offsets[i], offsets[i + 1])
+    """
+
+    INDEX_FILE: str = "index.json"
+    FEATURES_FILE: str = "features.npy"
+
+    def __init__(self, cache_dir: Path, fingerprint: str):
+        self.cache_dir: Path = Path(cache_dir) / fingerprint
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self.rows: dict[str, int] = {}
+        self.offsets: list[int] = [0]
+        self.features: np.ndarray | None = None
+        self._open()
+
+    def _open(self) -> None:
+        index_path: Path = self.cache_dir / self.INDEX_FILE
+        if not index_path.exists():
+            return
+
+        with open(index_path, "r", encoding="utf-8") as f:
+            index: dict = json.load(f)
+
+        self.rows = index["rows"]
+        self.offsets = index["offsets"]
+        self.features = np.load(self.cache_dir / self.FEATURES_FILE, mmap_mode="r")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, lyrics: str) -> np.ndarray:
+        """Returns the (num_chunks, hidden_size) chunk features of the song"""
+        row: int = self.rows[lyrics_hash(lyrics)]
+        return self.features[self.offsets[row]:self.offsets[row + 1]]
+
+    @torch.no_grad()
+    def build(self, model: BertForLyrics, texts: list[str], batch_size: int = 8) -> None:
+        """encodes the chunks of all songs that are not cached yet, model.eval() is up to the caller"""
+        missing: dict[str, str] = {}
+        for text in texts:
+            key: str = lyrics_hash(text)
+            if key not in self.rows:
+                missing[key] = text
+
+        if not missing:
+            return
+
+        missing_texts: list[str] = list(missing.values())
+        features: list[np.ndarray] = []
+
+        for start in range(0, len(missing_texts), batch_size):
+            chunk_features: list[torch.Tensor] = model.encode_chunk_features(missing_texts[start:start + batch_size])
+            features.extend(f.cpu().numpy() for f in chunk_features)
+            print(f"Chunk features: {min(start + batch_size, len(missing_texts))}/{len(missing_texts)} songs", end="\r")
+        print()
+
+        self._add(list(missing), features)
+
+    def _add(self, keys: list[str], features: list[np.ndarray]) -> None:
+        num_old_chunks: int = self.offsets[-1]
+        new_chunks: np.ndarray = np.concatenate(features).astype(np.float32)
+
+        def write(path: Path) -> None:
+            matrix: np.memmap = np.lib.format.open_memmap(
+                path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(num_old_chunks + len(new_chunks), new_chunks.shape[1]),
+            )
+            if num_old_chunks:
+                matrix[:num_old_chunks] = self.features
+            matrix[num_old_chunks:] = new_chunks
+            matrix.flush()
+            del matrix
+
+        self._atomic_write(self.FEATURES_FILE, write)
+        self.features = np.load(self.cache_dir / self.FEATURES_FILE, mmap_mode="r")
+
+        for key, song_features in zip(keys, features):
+            self.rows[key] = len(self.offsets) - 1
+            self.offsets.append(self.offsets[-1] + len(song_features))
+
+        # the index is written last, a crash before this point leaves the old index with valid rows
+        self._atomic_write(
+            self.INDEX_FILE,
+            lambda path: path.write_text(
+                json.dumps({"rows": self.rows, "offsets": self.offsets}),
+                encoding="utf-8",
+            ),
+        )
+
+    def _atomic_write(self, file_name: str, write: Callable[[Path], None]) -> None:
+        target: Path = self.cache_dir / file_name
+        tmp_path: Path = target.with_name(f"{target.stem}.{os.getpid()}.tmp{target.suffix}")
+        write(tmp_path)
+        os.replace(tmp_path, target)
+
+    def pooled(self, texts: list[str], use_max_pooling: bool) -> torch.Tensor:
+        """(num_texts, hidden_size) song embeddings, max or mean pooled over the cached chunk features"""
+        song_embeddings: list[np.ndarray] = [
+            self.get(text).max(axis=0) if use_max_pooling else self.get(text).mean(axis=0)
+            for text in texts
+        ]
+        return torch.from_numpy(np.stack(song_embeddings))
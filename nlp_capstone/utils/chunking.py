@@ -0,0 +1,23 @@
+def split_into_chunks(
+    input_ids: list[int],
+    chunk_size: int,
+    stride: int,
+    cls_token_id: int,
+    sep_token_id: int,
+) -> list[list[int]]:
+    """sliding window over the token ids, every chunk is wrapped with [CLS] and [SEP]"""
+    chunks: list[list[int]] = []
+
+    for start in range(0, len(input_ids), stride):
+        chunk_ids: list[int] = input_ids[start:start + chunk_size]
+
+        if len(chunk_ids) == 0:
+            continue
+
+        chunks.append(
+            [cls_token_id]
+            + chunk_ids
+            + [sep_token_id]
+        )
+
+    return chunks
@@ -0,0 +1,54 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed() -> tuple[int, int]:
+    """
+    starts the gloo process group when the script is launched with torchrun (WORLD_SIZE > 1),
+    every process gets an equal share of the cpu cores, torchrun would otherwise limit every process to 1 thread
+
+    Returns the rank and the world size, (0, 1) without torchrun
+    """
+    world_size: int = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend="gloo")
+
+    local_world_size: int = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+    return dist.get_rank(), dist.get_world_size()
+
+
+def rank_and_world_size() -> tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def is_main_process() -> bool:
+    return rank_and_world_size()[0] == 0
+
+
+def all_reduce_sum(values: list[float]) -> list[float]:
+    """element wise sum over all processes, unchanged without a process group"""
+    if rank_and_world_size()[1] == 1:
+        return values
+
+    tensor: torch.Tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def barrier() -> None:
+    if rank_and_world_size()[1] > 1:
+        dist.barrier()
+
+
+def cleanup_distributed() -> None:
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from utils.lyrics_fetcher import TokenBucket
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    server: "_StubHTTPServer"
+
+    def do_GET(self) -> None:
+        stub: GeniusStubServer = self.server.stub
+        url = urlparse(self.path)
+        if url.path != "/search":
+            self._send(404, {"error": "not found"})
+            return
+
+        stub.count("requests")
+
+        wait_seconds: float = stub.limiter.try_acquire()
+        if wait_seconds > 0:
+            stub.count("rate_limited")
+            self._send(429, {"error": "rate limited"}, {"Retry-After": str(max(1, math.ceil(wait_seconds)))})
+            return
+
+        if stub.random_error():
+            stub.count("errors")
+            self._send(503, {"error": "unavailable"})
+            return
+
+        time.sleep(stub.latency_s)
+        params: dict[str, list[str]] = parse_qs(url.query)
+        artist: str = params.get("artist", [""])[0]
+        track: str = params.get("track", [""])[0]
+        self._send(200, {"lyrics": stub.lyrics(artist, track)})
+
+    def _send(self, status: int, body: dict, headers: dict[str, str] | None = None) -> None:
+        data: bytes = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    stub: "GeniusStubServer"
+
+
+class GeniusStubServer:
+    """
+    local stand-in for genius in tests and benchmarks of the LyricsFetcher (client: HttpLyricsSource)
+    GET /search?artist=...&track=... answers {"lyrics": ...} after latency_s, every miss_every-th song has no lyrics
+    more than rate_per_sec requests (burst at once) get a 429 with a Retry-After header like genius,
+    error_rate of the other requests fail with a 503
+
+    with GeniusStubServer(rate_per_sec=5) as stub:
+        source = HttpLyricsSource(stub.url)
+    """
+
+    def __init__(
+        self,
+        rate_per_sec: float = 10.0,
+        burst: int = 10,
+        latency_s: float = 0.2,
+        miss_every: int = 5,
+        error_rate: float = 0.0,
+        seed: int = 42,
+    ):
+        self.limiter: TokenBucket = TokenBucket(rate_per_sec, burst)
+        self.latency_s: float = latency_s
+        self.miss_every: int = miss_every
+        self.error_rate: float = error_rate
+
+        self.stats: dict[str, int] = {"requests": 0, "rate_limited": 0, "errors": 0}
+        self._random: random.Random = random.Random(seed)
+        self._lock: threading.Lock = threading.Lock()
+
+        self._server: _StubHTTPServer = _StubHTTPServer(("127.0.0.1", 0), _StubHandler)
+        self._server.stub = self
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def random_error(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def lyrics(self, artist: str, track: str) -> str | None:
+        """deterministic per song, so repeated searches give the same answer"""
+        song_hash: int = int(hashlib.sha1(f"{artist}|{track}".encode("utf-8")).hexdigest(), 16)
+        if self.miss_every > 0 and song_hash % self.miss_every == 0:
+            return None
+        return "\n".join(f"{track} by {artist}, line {i}" for i in range(20 + song_hash % 40))
+
+    def start(self) -> "GeniusStubServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "GeniusStubServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
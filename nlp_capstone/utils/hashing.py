@@ -0,0 +1,6 @@
+import hashlib
+
+
+def lyrics_hash(lyrics: str) -> str:
+    """content hash of a lyrics text, used as key for the on-disk caches"""
+    return hashlib.sha1(lyrics.encode("utf-8")).hexdigest()
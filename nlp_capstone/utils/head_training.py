@@ -0,0 +1,124 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.utils.class_weight import compute_class_weight
+from torch.optim import AdamW
+
+
+@dataclass
+class HeadTrainingConfig:
+    lr: float = 1e-3
+    epochs: int = 100
+    batch_size: int = 32
+    use_class_weights: bool = True  # balanced class weights in the cross entropy loss
+    dropout: float = 0.3  # the same dropout as BertForLyrics in front of the classifier
+    seed: int = 42
+
+
+def train_head(
+        x_train: torch.Tensor,
+        y_train: torch.Tensor,
+        x_val: torch.Tensor,
+        y_val: torch.Tensor,
+        num_labels: int,
+        config: HeadTrainingConfig,
+) -> tuple[nn.Linear, dict[str, dict[str, list[float]]]]:
+    """
+    trains only the classifier on the pooled song embeddings of a frozen encoder (see ChunkFeatureCache.pooled),
+    the returned Linear layer has the shape of BertForLyrics.classifier and can be loaded into it
+
+    Returns:
+    - classifier
+    - metrics per epoch, the same layout as in bert_train.py
+    """
+    torch.manual_seed(config.seed)
+
+    classifier: nn.Linear = nn.Linear(x_train.shape[1], num_labels)
+    dropout: nn.Dropout = nn.Dropout(config.dropout)
+    optimizer: AdamW = AdamW(classifier.parameters(), lr=config.lr)
+
+    class_weights: torch.Tensor | None = None
+    if config.use_class_weights:
+        # only the labels of the train split get a balanced weight, labels that are missing there keep 1
+        present: np.ndarray = np.unique(y_train.numpy())
+        weights: np.ndarray = np.ones(num_labels)
+        weights[present] = compute_class_weight(
+            class_weight="balanced",
+            classes=present,
+            y=y_train.numpy(),
+        )
+        class_weights = torch.tensor(weights, dtype=torch.float)
+    loss_fn: nn.Module = nn.CrossEntropyLoss(weight=class_weights)
+
+    metrics: dict[str, dict[str, list[float]]] = {
+        "train": {"loss": [], "acc": []},
+        "val": {"loss": [], "acc": []},
+    }
+
+    for _ in range(config.epochs):
+        classifier.train()
+        total_loss: float = 0.0
+        correct: int = 0
+
+        for batch_indices in torch.randperm(len(x_train)).split(config.batch_size):
+            optimizer.zero_grad()
+            logits: torch.Tensor = classifier(dropout(x_train[batch_indices]))
+            loss: torch.Tensor = loss_fn(logits, y_train[batch_indices])
+            loss.backward()
+            optimizer.step()
+
+            total_loss += loss.item() * len(batch_indices)
+            correct += (logits.argmax(dim=1) == y_train[batch_indices]).sum().item()
+
+        classifier.eval()
+        with torch.no_grad():
+            val_logits: torch.Tensor = classifier(x_val)
+
+        metrics["train"]["loss"].append(total_loss / len(x_train))
+        metrics["train"]["acc"].append(correct / len(x_train))
+        metrics["val"]["loss"].append(loss_fn(val_logits, y_val).item())
+        metrics["val"]["acc"].append((val_logits.argmax(dim=1) == y_val).float().mean().item())
+
+    return classifier, metrics
+
+
+def sweep_heads(
+        x_train_per_pooling: dict[bool, torch.Tensor],
+        y_train: torch.Tensor,
+        x_val_per_pooling: dict[bool, torch.Tensor],
+        y_val: torch.Tensor,
+        num_labels: int,
+        learning_rates: list[float],
+        use_class_weights: list[bool],
+        epochs: int = 100,
+) -> list[dict]:
+    """
+    grid search over learning rate, pooling (use_max_pooling, the keys of the pooled embeddings) and class weights,
+    one result row per combination with the best validation epoch
+    """
+    results: list[dict] = []
+
+    for use_max_pooling, x_train in x_train_per_pooling.items():
+        for lr in learning_rates:
+            for class_weights in use_class_weights:
+                config: HeadTrainingConfig = HeadTrainingConfig(lr=lr, epochs=epochs, use_class_weights=class_weights)
+
+                start: float = time.perf_counter()
+                _, metrics = train_head(x_train, y_train, x_val_per_pooling[use_max_pooling], y_val, num_labels, config)
+                best_epoch: int = int(np.argmin(metrics["val"]["loss"]))
+
+                results.append({
+                    "lr": lr,
+                    "use_max_pooling": use_max_pooling,
+                    "use_class_weights": class_weights,
+                    "best_epoch": best_epoch + 1,
+                    "val_loss": metrics["val"]["loss"][best_epoch],
+                    "val_acc": metrics["val"]["acc"][best_epoch],
+                    "train_acc": metrics["train"]["acc"][best_epoch],
+                    "seconds": time.perf_counter() - start,
+                })
+
+    return results
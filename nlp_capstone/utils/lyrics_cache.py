@@ -0,0 +1,75 @@
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+def normalize_text(s: str) -> str:
+    s = s.lower()
+    s = re.sub(r"\(.*?\)", "", s)      # (feat. ..), (remastered)
+    s = re.sub(r"\[.*?\]", "", s)
+    s = re.sub(r"[-–—].*$", "", s)     # - live, - remastered
+    s = s.replace("’", "'")
+    s = re.sub(r"[^\w\s']", "", s)
+    return s.strip()
+
+
+class LyricsCache:
+    """
+    persistent sqlite cache of the genius searches, keyed by the (artist, track) exactly as they were searched,
+    so a query is only answered by the same query (normalize the names before searching, see normalize_text)
+    songs without lyrics are stored as misses (NULL), so they are not searched again in the next run
+    the fetcher threads share one connection, every access holds the lock
+    """
+
+    def __init__(self, db_path: Path | str):
+        self.db_path: Path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock: threading.Lock = threading.Lock()
+        self._connection: sqlite3.Connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        # the write ahead log keeps readers (e.g. a second script) from blocking the fetcher
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # the former "lyrics" table was keyed by the normalized names of possibly different queries, it is not read
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS searches ("
+            "artist TEXT NOT NULL, "
+            "track TEXT NOT NULL, "
+            "lyrics TEXT, "
+            "fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (artist, track))"
+        )
+        self._connection.commit()
+
+    def get(self, artist: str, track: str) -> tuple[bool, str | None]:
+        """
+        Returns:
+        - True when the song was searched before
+        - the lyrics, None for a miss
+        """
+        with self._lock:
+            row: tuple | None = self._connection.execute(
+                "SELECT lyrics FROM searches WHERE artist = ? AND track = ?",
+                (artist, track),
+            ).fetchone()
+
+        if row is None:
+            return False, None
+        return True, row[0]
+
+    def put(self, artist: str, track: str, lyrics: str | None) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO searches (artist, track, lyrics, fetched_at) VALUES (?, ?, ?, ?)",
+                (artist, track, lyrics, time.time()),
+            )
+            self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
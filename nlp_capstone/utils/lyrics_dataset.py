@@ -1,5 +1,11 @@
+from pathlib import Path
+
 import torch
 from torch.utils.data import Dataset
+from transformers import PreTrainedTokenizerBase
+
+from utils.chunking import split_into_chunks
+from utils.token_cache import TokenCache, tokenize_with_cache, tokenizer_cache_name
 
 
 # Dataset (RAW TEXT)
@@ -15,4 +21,90 @@ class LyricsDataset(Dataset):
         return {
             "text": self.texts[idx],
             "label": torch.tensor(self.labels[idx], dtype=torch.long)
-        }
\ No newline at end of file
+        }
+
+
+# Dataset (CHUNKED TOKEN IDS)
+class TokenizedLyricsDataset(LyricsDataset):
+    """
+    tokenization and chunking run in __getitem__, so with num_workers > 0 they happen in the DataLoader workers
+    and the training process only receives the padded chunk tensors of collate_chunks
+    """
+
+    def __init__(
+            self,
+            texts,
+            labels,
+            tokenizer: PreTrainedTokenizerBase,
+            chunk_size: int,
+            stride: int,
+            token_cache_dir: Path | None = None,
+    ):
+        super().__init__(texts, labels)
+        self.tokenizer: PreTrainedTokenizerBase = tokenizer
+        self.chunk_size: int = chunk_size
+        self.stride: int = stride
+        self.token_cache: TokenCache | None = (
+            None
+            if token_cache_dir is None
+            else TokenCache(token_cache_dir, tokenizer_cache_name(tokenizer))
+        )
+
+    def _chunks(self, input_ids: list[int]) -> list[list[int]]:
+        return split_into_chunks(
+            input_ids,
+            chunk_size=self.chunk_size,
+            stride=self.stride,
+            cls_token_id=self.tokenizer.cls_token_id,
+            sep_token_id=self.tokenizer.sep_token_id,
+        )
+
+    def num_chunks(self) -> list[int]:
+        """number of chunks of every song, one batched tokenizer call for all songs that are not cached yet"""
+        return [
+            len(self._chunks(input_ids))
+            for input_ids in tokenize_with_cache(self.tokenizer, self.texts, self.token_cache)
+        ]
+
+    def __getitem__(self, idx):
+        input_ids: list[int] = tokenize_with_cache(self.tokenizer, [self.texts[idx]], self.token_cache)[0]
+        return {
+            "chunks": self._chunks(input_ids),
+            "label": self.labels[idx],
+        }
+
+
+def collate_chunks(batch: list[dict], pad_token_id: int) -> dict[str, torch.Tensor]:
+    """
+    pads the chunks of all songs of a batch into one tensor, sorted by chunk length,
+    so the encoder calls of BertForLyrics.forward_chunks need as little padding as possible
+
+    Returns:
+    - input_ids (num_chunks, max_len)
+    - attention_mask (num_chunks, max_len)
+    - text_index (num_chunks,) index of the song of every chunk in the batch
+    - label (batch_size,)
+    """
+    flat_chunks: list[tuple[int, list[int]]] = sorted(
+        (
+            (text_idx, chunk)
+            for text_idx, item in enumerate(batch)
+            for chunk in item["chunks"]
+        ),
+        key=lambda text_chunk: len(text_chunk[1]),
+    )
+    max_len: int = max(len(chunk) for _, chunk in flat_chunks)
+
+    input_ids: torch.Tensor = torch.full((len(flat_chunks), max_len), pad_token_id, dtype=torch.long)
+    attention_mask: torch.Tensor = torch.zeros_like(input_ids)
+
+    for row, (_, chunk) in enumerate(flat_chunks):
+        input_ids[row, :len(chunk)] = torch.tensor(chunk, dtype=torch.long)
+        attention_mask[row, :len(chunk)] = 1
+
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "text_index": torch.tensor([text_idx for text_idx, _ in flat_chunks], dtype=torch.long),
+        "label": torch.tensor([item["label"] for item in batch], dtype=torch.long),
+    }
@@ -0,0 +1,264 @@
+import json
+import random
+import re
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Protocol
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import lyricsgenius
+from lyricsgenius.types import Song
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+
+from utils.lyrics_cache import LyricsCache
+
+
+class RateLimitError(Exception):
+    """the lyrics source answered with 429, retry_after in seconds if the response had a Retry-After header"""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after: float | None = retry_after
+
+
+class TransientFetchError(Exception):
+    """timeouts, connection errors and 5xx responses, the request is retried"""
+
+
+class LyricsSource(Protocol):
+    def search(self, artist: str, track: str) -> str | None:
+        """the lyrics of the song, None if the source has no lyrics for it"""
+        ...
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:  # http date instead of seconds
+        return None
+
+
+class GeniusLyricsSource:
+    """
+    genius via lyricsgenius, every fetcher thread gets its own client (requests sessions are not thread safe)
+    the sleeps and retries of lyricsgenius are turned off, the LyricsFetcher does the rate limiting and the retries
+    """
+
+    def __init__(self, genius_token: str, timeout: int = 15):
+        self.genius_token: str = genius_token
+        self.timeout: int = timeout
+        self._local: threading.local = threading.local()
+
+    def _client(self) -> lyricsgenius.Genius:
+        if not hasattr(self._local, "genius"):
+            self._local.genius = lyricsgenius.Genius(
+                self.genius_token,
+                skip_non_songs=True,
+                remove_section_headers=True,
+                verbose=False,
+                timeout=self.timeout,
+                retries=0,
+                sleep_time=0,
+            )
+        return self._local.genius
+
+    def search(self, artist: str, track: str) -> str | None:
+        try:
+            song: Song | None = self._client().search_song(track, artist)
+        except (Timeout, RequestsConnectionError) as e:
+            raise TransientFetchError(str(e)) from e
+        except Exception as e:
+            err_msg: str = str(e)
+            # lyricsgenius only passes the status code and the response headers on in the message
+            if "429" in err_msg or "error code: 1015" in err_msg:
+                retry_after: re.Match | None = re.search(r"Retry-After': '(\d+)'", err_msg)
+                raise RateLimitError(err_msg, parse_retry_after(retry_after and retry_after.group(1))) from e
+            if re.search(r"status code: 5\d\d", err_msg) or (e.args and isinstance(e.args[0], int) and e.args[0] >= 500):
+                raise TransientFetchError(err_msg) from e
+            raise
+
+        if song and song.lyrics and song.lyrics.strip():
+            return song.lyrics.strip()
+        return None
+
+
+class HttpLyricsSource:
+    """client of the json api of utils/genius_stub_server.py (GET /search?artist=...&track=...)"""
+
+    def __init__(self, base_url: str, timeout: float = 15.0):
+        self.base_url: str = base_url.rstrip("/")
+        self.timeout: float = timeout
+
+    def search(self, artist: str, track: str) -> str | None:
+        url: str = f"{self.base_url}/search?{urlencode({'artist': artist, 'track': track})}"
+        try:
+            with urlopen(url, timeout=self.timeout) as response:
+                return json.load(response)["lyrics"]
+        except HTTPError as e:
+            if e.code == 429:
+                raise RateLimitError(str(e), parse_retry_after(e.headers.get("Retry-After"))) from e
+            if e.code >= 500:
+                raise TransientFetchError(str(e)) from e
+            raise
+        except (URLError, TimeoutError, ConnectionError) as e:
+            raise TransientFetchError(str(e)) from e
+
+
+class TokenBucket:
+    """
+    thread safe token bucket, rate tokens per second up to burst tokens
+    block_for stops all threads at once, e.g. for the Retry-After of a 429
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate: float = rate
+        self.burst: int = burst
+
+        self._tokens: float = float(burst)
+        self._updated: float = time.monotonic()
+        self._blocked_until: float = 0.0
+        self._lock: threading.Lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """takes a token if there is one, Returns 0 or the seconds until the next token"""
+        with self._lock:
+            now: float = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        while (wait_seconds := self.try_acquire()) > 0:
+            time.sleep(wait_seconds)
+
+    def block_for(self, seconds: float) -> None:
+        with self._lock:
+            # no tokens pile up while the bucket is blocked
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._blocked_until
+
+
+@dataclass
+class FetchResult:
+    index: int  # position of the song in the songs passed to LyricsFetcher.fetch
+    artist: str
+    track: str
+    lyrics: str | None  # None --> no lyrics (or the search failed, see error)
+    from_cache: bool = False
+    error: str | None = None  # set when every retry failed, failed songs are not cached and searched again in the next run
+
+
+class LyricsFetcher:
+    """
+    searches the lyrics of many songs concurrently
+    - max_workers threads share one token bucket of requests_per_sec (burst songs at once)
+    - a 429 blocks the bucket for the Retry-After of the response (all threads wait), without header for the backoff
+    - timeouts / 5xx are retried with exponential backoff and full jitter, at most max_retries times
+    - every answered search (lyrics or miss) is written to the LyricsCache, so a restarted crawl skips it
+    """
+
+    def __init__(
+        self,
+        source: LyricsSource,
+        cache: LyricsCache,
+        max_workers: int = 8,
+        requests_per_sec: float = 2.0,
+        burst: int = 4,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.source: LyricsSource = source
+        self.cache: LyricsCache = cache
+        self.max_workers: int = max_workers
+        self.limiter: TokenBucket = TokenBucket(requests_per_sec, burst)
+        self.max_retries: int = max_retries
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _search(self, artist: str, track: str) -> str | None:
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                lyrics: str | None = self.source.search(artist, track)
+            except RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after: float = e.retry_after if e.retry_after is not None else self._backoff(attempt)
+                print(f"Rate limit reached! Retry after {retry_after:.0f} seconds")
+                self.limiter.block_for(retry_after)
+                continue
+            except TransientFetchError:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+
+            self.cache.put(artist, track, lyrics)
+            return lyrics
+
+    def fetch(self, songs: Iterable[tuple[str, str]]) -> Iterator[FetchResult]:
+        """
+        results for (artist, track) pairs in the order they are finished, cached songs are answered without a request
+        songs is consumed lazily, at most 2 * max_workers songs are in flight, so the caller can stop early
+        a song that is already in flight (same artist and track) is not searched twice,
+        the pairs are searched and cached exactly as given, callers normalize them before (e.g. normalize_text)
+        """
+        pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # future --> the songs that wait for it
+        in_flight: dict[Future, list[tuple[int, str, str]]] = {}
+        future_per_key: dict[tuple[str, str], Future] = {}
+
+        def finished(return_when: str) -> Iterator[FetchResult]:
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                error: BaseException | None = future.exception()
+                for index, artist, track in in_flight.pop(future):
+                    future_per_key.pop((artist, track), None)
+                    yield FetchResult(
+                        index=index,
+                        artist=artist,
+                        track=track,
+                        lyrics=None if error is not None else future.result(),
+                        error=None if error is None else repr(error),
+                    )
+
+        try:
+            for index, (artist, track) in enumerate(songs):
+                found, lyrics = self.cache.get(artist, track)
+                if found:
+                    yield FetchResult(index=index, artist=artist, track=track, lyrics=lyrics, from_cache=True)
+                    continue
+
+                key: tuple[str, str] = (artist, track)
+                if key in future_per_key:
+                    in_flight[future_per_key[key]].append((index, artist, track))
+                    continue
+
+                future: Future = pool.submit(self._search, artist, track)
+                future_per_key[key] = future
+                in_flight[future] = [(index, artist, track)]
+
+                while len(in_flight) >= 2 * self.max_workers:
+                    yield from finished(FIRST_COMPLETED)
+
+            while in_flight:
+                yield from finished(FIRST_COMPLETED)
+        finally:
+            # searches that are already running still end up in the cache
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,78 @@
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+
+
+def _drop_partial_line(path: Path) -> None:
+    """a crash during a write leaves a line without newline, it is cut off so the next line does not continue it"""
+    if not path.exists():
+        return
+
+    with open(path, "rb+") as f:
+        end: int = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return
+
+        # only the tail of the file is read, backwards in blocks until the last complete line
+        position: int = end
+        while position > 0:
+            start: int = max(0, position - 65536)
+            f.seek(start)
+            newline: int = f.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            position = start
+        f.truncate(0)
+
+
+class LyricsResultLog:
+    """
+    append-only JSONL log of the lyrics crawl, one line per searched song ({"row": 12, "lyrics": "..." | null})
+    every line is flushed when it is written, so a crash loses at most the song that was being written
+    the log is replayed onto the dataset on a resume and compacted into the csv (see pre_training_bert.py)
+    """
+
+    def __init__(self, path: Path):
+        self.path: Path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        _drop_partial_line(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, row: int, lyrics: str | None) -> None:
+        self._file.write(json.dumps({"row": row, "lyrics": lyrics}) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "LyricsResultLog":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def read_lyrics_results(path: Path) -> pd.DataFrame:
+    """
+    the latest result per row, indexed by row
+    a half written last line (crash during the write) is skipped
+    """
+    records: list[dict] = []
+    if Path(path).exists():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                records.append(json.loads(line))
+
+    if not records:
+        return pd.DataFrame({"lyrics": pd.Series(dtype=object)}, index=pd.Index([], name="row"))
+
+    return pd.DataFrame(records).drop_duplicates("row", keep="last").set_index("row")
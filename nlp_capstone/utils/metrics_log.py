@@ -0,0 +1,84 @@
+import json
+import time
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+import torch
+
+# file name of the log in the model / output directory
+METRICS_LOG_FILE: str = "metrics.jsonl"
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+
+    try:
+        import resource
+    except ImportError:  # windows
+        return float("nan")
+
+    # peak resident set size of the whole process, linux reports it in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MetricsLog:
+    """
+    append-only JSONL log of a training run, one record per line (e.g. {"event": "train_step", "step": 12, "loss": ...})
+    every line is flushed when it is written, so plot_metrics.py can follow the file while the run is going
+    a resumed run appends to the same file, steps after the last checkpoint are then logged twice (read_metrics_log keeps the last)
+    """
+
+    def __init__(self, path: Path):
+        self.path: Path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def log(self, event: str, **values: Any) -> None:
+        record: dict = {"event": event, "time": time.time(), **values}
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "MetricsLog":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class MetricsLogTail:
+    """incremental reader of a MetricsLog, read_new only parses the lines that were appended since the last call"""
+
+    def __init__(self, path: Path):
+        self.path: Path = Path(path)
+        self.offset: int = 0
+
+    def read_new(self) -> list[dict]:
+        if not self.path.exists():
+            return []
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data: bytes = f.read()
+
+        # the last line can still be in the middle of being written, it is read with the next call
+        complete: int = data.rfind(b"\n") + 1
+        self.offset += complete
+        return [json.loads(line) for line in data[:complete].splitlines() if line.strip()]
+
+
+def metrics_frame(records: list[dict]) -> pd.DataFrame:
+    """one row per record ordered by step, for repeated steps of a resumed run only the last record is kept"""
+    frame: pd.DataFrame = pd.DataFrame(records)
+    if frame.empty or "step" not in frame:
+        return frame
+    frame = frame.drop_duplicates(subset=["event", "step"], keep="last")
+    return frame.sort_values("step", kind="stable").reset_index(drop=True)
+
+
+def read_metrics_log(path: Path) -> pd.DataFrame:
+    return metrics_frame(MetricsLogTail(path).read_new())
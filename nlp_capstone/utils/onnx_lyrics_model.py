@@ -0,0 +1,165 @@
+import json
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+from tokenizers import Tokenizer
+
+from utils.chunking import split_into_chunks
+from utils.token_cache import TokenCache, tokenize_with_cache, tokenizer_cache_name
+
+# no torch or transformers import here, the onnx backend only needs onnxruntime, numpy and the tokenizers library
+
+
+class FastTokenizer:
+    """
+    the rust tokenizer (tokenizer.json) that save_pretrained writes next to the model, without transformers
+    it has the parts of PreTrainedTokenizerBase that tokenize_with_cache and the chunking use,
+    the token ids are the same as the ones of the transformers fast tokenizer
+    """
+
+    def __init__(self, model_dir: Path):
+        self.name_or_path: str = str(model_dir)
+        self.tokenizer: Tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        # the lyrics are chunked, never truncated or padded by the tokenizer
+        self.tokenizer.no_truncation()
+        self.tokenizer.no_padding()
+
+        special_tokens: dict = {}
+        for file_name in ("special_tokens_map.json", "tokenizer_config.json"):
+            if (model_dir / file_name).exists():
+                with open(model_dir / file_name, "r", encoding="utf-8") as f:
+                    special_tokens.update(json.load(f))
+
+        self.cls_token_id: int = self._token_id(special_tokens, "cls_token")
+        self.sep_token_id: int = self._token_id(special_tokens, "sep_token")
+        self.pad_token_id: int = self._token_id(special_tokens, "pad_token")
+
+    def _token_id(self, special_tokens: dict, name: str) -> int:
+        token: str | dict | None = special_tokens.get(name)
+        if isinstance(token, dict):
+            token = token["content"]
+        token_id: int | None = None if token is None else self.tokenizer.token_to_id(token)
+        if token_id is None:
+            raise ValueError(f"{name} of the tokenizer in {self.name_or_path} is missing")
+        return token_id
+
+    def __call__(self, texts: list[str], add_special_tokens: bool = True, verbose: bool = True) -> dict[str, list[list[int]]]:
+        encodings = self.tokenizer.encode_batch(texts, add_special_tokens=add_special_tokens)
+        return {"input_ids": [encoding.ids for encoding in encodings]}
+
+
+class OnnxLyricsModel:
+    """
+    runs the graphs from BertForLyrics.export_onnx with the onnx runtime cpu execution provider,
+    chunking, padding and the max/mean pooling over the chunks are done in numpy
+    """
+
+    def __init__(
+        self,
+        model_dir: Path,
+        chunk_size: int,
+        stride: int,
+        use_max_pooling: bool = True,
+        max_chunks_per_call: int = 32,
+        token_cache_dir: Path | None = None,
+        onnx_dir_name: str = "onnx",
+    ):
+        self.chunk_size: int = chunk_size
+        self.stride: int = stride
+        self.use_max_pooling: bool = use_max_pooling
+        self.max_chunks_per_call: int = max_chunks_per_call
+
+        onnx_dir: Path = model_dir / onnx_dir_name
+        if not (onnx_dir / "encoder.onnx").exists():
+            raise FileNotFoundError(f"No exported ONNX model in {onnx_dir}, run export_onnx.py first")
+
+        self.tokenizer: FastTokenizer = FastTokenizer(model_dir)
+        self.token_cache: TokenCache | None = None
+        if token_cache_dir is not None:
+            self.token_cache = TokenCache(token_cache_dir, tokenizer_cache_name(self.tokenizer))
+
+        providers: list[str] = ["CPUExecutionProvider"]
+        self.encoder: ort.InferenceSession = ort.InferenceSession(str(onnx_dir / "encoder.onnx"), providers=providers)
+        self.classifier: ort.InferenceSession = ort.InferenceSession(str(onnx_dir / "classifier.onnx"), providers=providers)
+
+    def tokenize_texts(self, texts: list[str]) -> list[list[int]]:
+        return tokenize_with_cache(self.tokenizer, texts, self.token_cache)
+
+    def __call__(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        chunks_per_text: list[list[list[int]]] = [
+            split_into_chunks(
+                input_ids,
+                chunk_size=self.chunk_size,
+                stride=self.stride,
+                cls_token_id=self.tokenizer.cls_token_id,
+                sep_token_id=self.tokenizer.sep_token_id,
+            )
+            for input_ids in self.tokenize_texts(texts)
+        ]
+
+        flat_chunks: list[list[int]] = [chunk for chunks in chunks_per_text for chunk in chunks]
+        order: list[int] = sorted(range(len(flat_chunks)), key=lambda i: len(flat_chunks[i]))
+        cls_vectors: np.ndarray | None = None
+
+        for start in range(0, len(order), self.max_chunks_per_call):
+            batch_indices: list[int] = order[start:start + self.max_chunks_per_call]
+            max_len: int = max(len(flat_chunks[i]) for i in batch_indices)
+
+            chunk_ids: np.ndarray = np.full((len(batch_indices), max_len), self.tokenizer.pad_token_id, dtype=np.int64)
+            attention_mask: np.ndarray = np.zeros_like(chunk_ids)
+            for row, i in enumerate(batch_indices):
+                chunk_ids[row, :len(flat_chunks[i])] = flat_chunks[i]
+                attention_mask[row, :len(flat_chunks[i])] = 1
+
+            cls: np.ndarray = self.encoder.run(["cls"], {"input_ids": chunk_ids, "attention_mask": attention_mask})[0]
+            if cls_vectors is None:
+                cls_vectors = np.empty((len(flat_chunks), cls.shape[1]), dtype=np.float32)
+            cls_vectors[batch_indices] = cls
+
+        embeddings: list[np.ndarray] = []
+        offset: int = 0
+        for chunks in chunks_per_text:
+            chunk_embeddings: np.ndarray = cls_vectors[offset:offset + len(chunks)]
+            offset += len(chunks)
+
+            if self.use_max_pooling:
+                embeddings.append(chunk_embeddings.max(axis=0))
+            else:
+                embeddings.append(chunk_embeddings.mean(axis=0))
+
+        song_embeddings: np.ndarray = np.stack(embeddings)
+        logits: np.ndarray = self.classifier.run(["logits"], {"embeddings": song_embeddings})[0]
+        return logits, song_embeddings
+
+    def predict_batch(
+        self,
+        texts: list[str],
+        batch_size: int = 8,
+        on_progress: Callable[[int, int], None] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """same contract as BertForLyrics.predict_batch, returns numpy arrays (logits, embeddings)"""
+        if not texts:
+            raise ValueError("No texts to predict")
+
+        lengths: list[int] = [len(input_ids) for input_ids in self.tokenize_texts(texts)]
+        order: np.ndarray = np.argsort(lengths, kind="stable")
+
+        logits: np.ndarray | None = None
+        embeddings: np.ndarray | None = None
+
+        for start in range(0, len(order), batch_size):
+            batch_indices: np.ndarray = order[start:start + batch_size]
+            batch_logits, batch_embeddings = self([texts[i] for i in batch_indices])
+
+            if logits is None:
+                logits = np.empty((len(texts), batch_logits.shape[1]), dtype=np.float32)
+                embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+            logits[batch_indices] = batch_logits
+            embeddings[batch_indices] = batch_embeddings
+
+            if on_progress is not None:
+                on_progress(start + len(batch_indices), len(texts))
+
+        return logits, embeddings
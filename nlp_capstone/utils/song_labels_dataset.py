@@ -0,0 +1,111 @@
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+from utils.hashing import lyrics_hash
+
+# one dataset per csv directory (e.g. cache/song_labels/processed.arrow), rebuilt when a csv file changes
+SONG_LABELS_CACHE_DIR: Path = Path("cache/song_labels")
+SOURCES_METADATA_KEY: bytes = b"song_labels_sources"
+
+
+def _csv_sources(csv_dir: Path) -> list[dict]:
+    csv_files: list[Path] = sorted(Path(csv_dir).glob("*.csv"))
+    if not csv_files:
+        raise RuntimeError(f"No CSV files found in {csv_dir}")
+
+    return [
+        {"file": csv_file.name, "size": csv_file.stat().st_size, "mtime_ns": csv_file.stat().st_mtime_ns}
+        for csv_file in csv_files
+    ]
+
+
+def _annotator(csv_file: Path) -> str:
+    """songs_paul_processed.csv --> paul"""
+    return csv_file.stem.removeprefix("songs_").removesuffix("_processed")
+
+
+def default_dataset_path(csv_dir: Path) -> Path:
+    return SONG_LABELS_CACHE_DIR / f"{Path(csv_dir).name}.arrow"
+
+
+def build_song_labels_dataset(csv_dir: Path, dataset_path: Path | None = None) -> Path:
+    """
+    parses the per annotator csv files (lyrics in quoted multi line cells) once and writes one arrow ipc file,
+    next to the csv columns it has:
+    - annotator: name from the csv file name
+    - lyrics_hash: hash of the stripped lyrics (same key as the embedding store), "" without lyrics
+    - lyrics_length / num_words: computed from the lyrics
+    - is_duplicate: the lyrics were already in an earlier row (the rows drop_duplicates(subset=["lyrics"]) drops)
+    the file is uncompressed, so readers can memory-map it and only touch the columns they select
+    """
+    csv_dir = Path(csv_dir)
+    dataset_path = dataset_path or default_dataset_path(csv_dir)
+    sources: list[dict] = _csv_sources(csv_dir)
+
+    dfs: list[pd.DataFrame] = []
+    for source in sources:
+        df: pd.DataFrame = pd.read_csv(csv_dir / source["file"])
+        df["annotator"] = _annotator(csv_dir / source["file"])
+        dfs.append(df)
+
+    df = pd.concat(dfs, ignore_index=True)
+
+    lyrics: pd.Series = df["lyrics"].fillna("").astype(str)
+    stripped: pd.Series = lyrics.str.strip()
+    df["lyrics"] = lyrics
+    df["lyrics_available"] = df["lyrics_available"].eq(True)
+    df["lyrics_length"] = lyrics.str.len()
+    df["num_words"] = stripped.str.split().str.len().fillna(0).astype(int)
+    df["lyrics_hash"] = stripped.map(lambda text: lyrics_hash(text) if text else "")
+    df["is_duplicate"] = stripped.ne("") & lyrics.duplicated()
+
+    table: pa.Table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        SOURCES_METADATA_KEY: json.dumps(sources).encode("utf-8"),
+    })
+
+    dataset_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path: Path = dataset_path.with_name(f"{dataset_path.name}.{os.getpid()}.tmp")
+    with pa.OSFile(str(tmp_path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, dataset_path)
+
+    print(f"Song labels dataset: {len(df)} rows from {len(sources)} csv files --> {dataset_path}")
+    return dataset_path
+
+
+def _is_up_to_date(dataset_path: Path, csv_dir: Path) -> bool:
+    if not dataset_path.exists():
+        return False
+
+    with pa.memory_map(str(dataset_path), "r") as source:
+        metadata: dict[bytes, bytes] = pa.ipc.open_file(source).schema.metadata or {}
+
+    return SOURCES_METADATA_KEY in metadata and json.loads(metadata[SOURCES_METADATA_KEY]) == _csv_sources(csv_dir)
+
+
+def read_song_labels(
+    csv_dir: Path,
+    columns: list[str] | None = None,
+    dataset_path: Path | None = None,
+) -> pd.DataFrame:
+    """
+    the rows of all annotator csv files, only the selected columns (None --> all)
+    the dataset is memory-mapped, so e.g. the labels are read without the lyrics, it is (re)built when the csv files changed
+    """
+    csv_dir = Path(csv_dir)
+    dataset_path = dataset_path or default_dataset_path(csv_dir)
+    if not _is_up_to_date(dataset_path, csv_dir):
+        build_song_labels_dataset(csv_dir, dataset_path)
+
+    with pa.memory_map(str(dataset_path), "r") as source:
+        table: pa.Table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
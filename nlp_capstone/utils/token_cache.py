@@ -0,0 +1,88 @@
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from utils.hashing import lyrics_hash
+
+# only for the annotations, the onnx backend uses the cache without transformers (FastTokenizer)
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizerBase
+
+
+class TokenCache:
+    """
+    persistent cache of the token ids of lyrics, keyed by the lyrics hash and the tokenizer name
+    every entry is a single .npy file, so the cache can be shared between training runs and the backend
+    """
+
+    def __init__(self, cache_dir: Path | str, tokenizer_name: str):
+        self.cache_dir: Path = Path(cache_dir) / tokenizer_name
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._memory: dict[str, np.ndarray] = {}
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.npy"
+
+    def get(self, lyrics: str) -> np.ndarray | None:
+        key: str = lyrics_hash(lyrics)
+
+        if key in self._memory:
+            return self._memory[key]
+
+        path: Path = self._entry_path(key)
+        if not path.exists():
+            return None
+
+        input_ids: np.ndarray = np.load(path)
+        self._memory[key] = input_ids
+        return input_ids
+
+    def put(self, lyrics: str, input_ids: list[int]) -> np.ndarray:
+        key: str = lyrics_hash(lyrics)
+        array: np.ndarray = np.asarray(input_ids, dtype=np.uint32)
+
+        # write to a temp file first, so a crash never leaves a half written entry
+        tmp_path: Path = self.cache_dir / f"{key}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, self._entry_path(key))
+
+        self._memory[key] = array
+        return array
+
+
+def tokenizer_cache_name(tokenizer: "PreTrainedTokenizerBase") -> str:
+    return f"{type(tokenizer).__name__}_{Path(tokenizer.name_or_path).name}"
+
+
+def tokenize_with_cache(
+    tokenizer: "PreTrainedTokenizerBase",
+    texts: list[str],
+    token_cache: TokenCache | None,
+) -> list[list[int]]:
+    """token ids without special tokens for every text, cached texts skip the tokenizer completely"""
+    input_ids: list[list[int] | None] = [None] * len(texts)
+    missing: list[int] = []
+
+    for i, text in enumerate(texts):
+        cached = token_cache.get(text) if token_cache is not None else None
+        if cached is None:
+            missing.append(i)
+        else:
+            input_ids[i] = cached.tolist()
+
+    if missing:
+        # one call for all missing texts, the fast tokenizer encodes them in parallel
+        encoded: list[list[int]] = tokenizer(
+            [texts[i] for i in missing],
+            add_special_tokens=False,
+            verbose=False,  # no warning for texts longer than model_max_length, they get chunked anyway
+        )["input_ids"]
+
+        for i, ids in zip(missing, encoded):
+            input_ids[i] = ids
+            if token_cache is not None:
+                token_cache.put(texts[i], ids)
+
+    return input_ids
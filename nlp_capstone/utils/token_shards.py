@@ -0,0 +1,229 @@
+import json
+import os
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+type Split = Literal["train", "val"]
+
+INDEX_FILE: str = "index.json"
+
+# tokenizer of the worker processes, loaded once per process by _init_worker
+_worker_tokenizer: PreTrainedTokenizerBase | None = None
+
+
+def _init_worker(tokenizer_name: str) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _tokenize(lyrics: list[str]) -> np.ndarray:
+    """one token stream for a csv chunk, every song is wrapped with <s> ... </s>"""
+    if not lyrics:
+        return np.zeros(0, dtype=np.uint32)
+
+    input_ids: list[list[int]] = _worker_tokenizer(lyrics, add_special_tokens=True, verbose=False)["input_ids"]
+    return np.concatenate([np.asarray(ids, dtype=np.uint32) for ids in input_ids])
+
+
+def _tokenize_splits(train_lyrics: list[str], val_lyrics: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """separate token streams for the train and the validation songs of a csv chunk"""
+    return _tokenize(train_lyrics), _tokenize(val_lyrics)
+
+
+def _read_index(shard_dir: Path) -> dict | None:
+    index_path: Path = shard_dir / INDEX_FILE
+    if not index_path.exists():
+        return None
+
+    with open(index_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_index(shard_dir: Path, index: dict) -> None:
+    tmp_path: Path = shard_dir / f"{INDEX_FILE}.{os.getpid()}.tmp"
+    tmp_path.write_text(json.dumps(index, indent=2), encoding="utf-8")
+    os.replace(tmp_path, shard_dir / INDEX_FILE)
+
+
+def build_token_shards(
+    csv_file: Path,
+    shard_dir: Path,
+    tokenizer_name: str,
+    text_column: str = "text",
+    min_length: int = 50,
+    songs_per_shard: int = 2000,
+    val_every: int = 20,
+    num_workers: int | None = None,
+) -> dict:
+    """
+    streams the csv in chunks of songs_per_shard rows, tokenizes the chunks in a process pool and writes
+    every chunk as two uint32 token shards, one of the training songs (train_00000.npy, ...)
+    and one of the validation songs (val_00000.npy, ...), index.json lists the finished shards
+    every val_every-th csv row is a validation song, whole songs are held out, so no block of the
+    validation stream contains tokens of a training song
+    the ram usage is bounded by the number of chunks in flight, not by the size of the csv
+    a rerun only tokenizes the chunks that are missing in the index, a finished corpus is not touched at all
+
+    Returns the index
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    # every setting that changes the shards, a directory of other settings is never reused
+    settings: dict = {
+        "tokenizer": tokenizer_name,
+        "csv_file": str(csv_file),
+        "text_column": text_column,
+        "min_length": min_length,
+        "songs_per_shard": songs_per_shard,
+        "val_every": val_every,
+    }
+    index: dict = _read_index(shard_dir) or {**settings, "complete": False, "shards": []}
+    if {key: index.get(key) for key in settings} != settings:
+        raise ValueError(f"{shard_dir} was built with other settings, use another shard directory")
+    if index["complete"]:
+        return index
+
+    done: set[int] = {shard["chunk"] for shard in index["shards"]}
+    num_workers = num_workers or os.cpu_count() or 1
+    in_flight: deque[tuple[int, dict[Split, int], Future]] = deque()
+
+    def finish(chunk_idx: int, num_songs: dict[Split, int], future: Future) -> None:
+        shard: dict = {"chunk": chunk_idx}
+        for split, tokens in zip(("train", "val"), future.result()):
+            file_name: str = f"{split}_{chunk_idx:05d}.npy"
+            tmp_path: Path = shard_dir / f"{split}_{chunk_idx:05d}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, tokens)
+            os.replace(tmp_path, shard_dir / file_name)
+            shard[split] = {"file": file_name, "num_songs": num_songs[split], "num_tokens": len(tokens)}
+
+        # the index is updated after every shard, so an interrupted run resumes at the next missing chunk
+        index["shards"].append(shard)
+        index["shards"].sort(key=lambda shard: shard["chunk"])
+        _write_index(shard_dir, index)
+        print(
+            f"Shard {chunk_idx}: {num_songs['train']} train songs ({shard['train']['num_tokens']} tokens), "
+            f"{num_songs['val']} val songs ({shard['val']['num_tokens']} tokens)"
+        )
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+        csv_chunks = pd.read_csv(csv_file, usecols=[text_column], chunksize=songs_per_shard)
+
+        for chunk_idx, chunk in enumerate(csv_chunks):
+            if chunk_idx in done:
+                continue
+
+            texts: pd.Series = chunk[text_column]
+            texts = texts[texts.notna() & (texts.str.len() > min_length)]
+            # the csv row decides the split, so it does not depend on songs_per_shard or the filter
+            is_val: np.ndarray = texts.index.to_numpy() % val_every == 0
+            train_lyrics: list[str] = texts[~is_val].tolist()
+            val_lyrics: list[str] = texts[is_val].tolist()
+            in_flight.append((
+                chunk_idx,
+                {"train": len(train_lyrics), "val": len(val_lyrics)},
+                pool.submit(_tokenize_splits, train_lyrics, val_lyrics),
+            ))
+
+            # at most two chunks per worker are in memory
+            if len(in_flight) >= 2 * num_workers:
+                finish(*in_flight.popleft())
+
+        while in_flight:
+            finish(*in_flight.popleft())
+
+    index["complete"] = True
+    _write_index(shard_dir, index)
+    return index
+
+
+class TokenShardDataset(IterableDataset):
+    """
+    packed MLM blocks of block_size tokens read from the memory-mapped token shards of build_token_shards,
+    split selects the token stream of the training or the held-out validation songs
+    the shard order and the block order within a shard are shuffled per epoch (set_epoch),
+    state_dict / load_state_dict store the epoch and the number of consumed blocks, so a run resumes mid epoch
+    """
+
+    def __init__(
+        self,
+        shard_dir: Path,
+        block_size: int,
+        split: Split = "train",
+        shuffle: bool = True,
+        seed: int = 42,
+    ):
+        index: dict | None = _read_index(shard_dir)
+        if index is None:
+            raise FileNotFoundError(f"No token shards in {shard_dir}, run build_token_shards first")
+
+        self.shard_dir: Path = shard_dir
+        # the train or val part of every shard
+        self.shards: list[dict] = [shard[split] for shard in index["shards"]]
+        self.block_size: int = block_size
+        self.split: Split = split
+        self.shuffle: bool = shuffle
+        self.seed: int = seed
+        self.epoch: int = 0
+        self.start_block: int = 0  # blocks of the current epoch that were already consumed
+
+    def _blocks_of_shard(self, shard: dict) -> np.ndarray:
+        return np.arange(shard["num_tokens"] // self.block_size)
+
+    def __len__(self) -> int:
+        """blocks that are left in the current epoch"""
+        return sum(len(self._blocks_of_shard(shard)) for shard in self.shards) - self.start_block
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.start_block = 0
+
+    def state_dict(self, consumed_blocks: int) -> dict:
+        """consumed_blocks: blocks of the current epoch that were trained on, including the skipped ones of a resume"""
+        return {"epoch": self.epoch, "start_block": consumed_blocks}
+
+    def load_state_dict(self, state: dict) -> None:
+        self.epoch = state["epoch"]
+        self.start_block = state["start_block"]
+
+    def _epoch_order(self) -> Iterator[tuple[dict, int]]:
+        """(shard, block index) of all blocks of the epoch in the (shuffled) epoch order"""
+        rng: np.random.Generator = np.random.default_rng(self.seed + self.epoch)
+        shard_order: np.ndarray = rng.permutation(len(self.shards)) if self.shuffle else np.arange(len(self.shards))
+
+        for i in shard_order:
+            shard: dict = self.shards[i]
+            blocks: np.ndarray = self._blocks_of_shard(shard)
+            if self.shuffle:
+                blocks = rng.permutation(blocks)
+            for block_idx in blocks:
+                yield shard, int(block_idx)
+
+    def __iter__(self) -> Iterator[dict]:
+        worker_info = get_worker_info()
+        worker_id: int = 0 if worker_info is None else worker_info.id
+        num_workers: int = 1 if worker_info is None else worker_info.num_workers
+
+        tokens_per_shard: dict[str, np.ndarray] = {}
+
+        for position, (shard, block_idx) in enumerate(self._epoch_order()):
+            # resume: skip the consumed blocks, every DataLoader worker takes every num_workers-th block
+            if position < self.start_block or position % num_workers != worker_id:
+                continue
+
+            if shard["file"] not in tokens_per_shard:
+                # only the memory map of the current shard is kept open
+                tokens_per_shard = {shard["file"]: np.load(self.shard_dir / shard["file"], mmap_mode="r")}
+
+            start: int = block_idx * self.block_size
+            block: np.ndarray = tokens_per_shard[shard["file"]][start:start + self.block_size]
+            yield {"input_ids": torch.from_numpy(block.astype(np.int64))}